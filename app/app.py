@@ -6,7 +6,7 @@ from flask            import Flask
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.wsgi    import SharedDataMiddleware
 
-from config import STATIC_ROOT, STORE_PATH
+from config import STATIC_ROOT
 
 app = Flask(__name__)
 db = SQLAlchemy(app)
@@ -14,10 +14,10 @@ db = SQLAlchemy(app)
 app.config.from_object('config')
 isdevmode = app.config['TESTING'] or app.config['DEBUG']
 
+# Archived files are served by `views.download_file`, at `/dl`.
 app.wsgi_app = SharedDataMiddleware(
     app.wsgi_app,
-    {'/'   : STATIC_ROOT,
-     '/dl' : STORE_PATH})
+    {'/' : STATIC_ROOT})
 
 # Please use a sane timezone for log entries so that we don't have to jump
 # through daylight savings hoops.
@@ -65,8 +65,13 @@ try:
 
     # Load "leaf" modules.  These may depend only on `app.app` which has now
     # been initialised
+    import database
+    import file
     import models
 
+    file.FileProcessor.configure(app.config['FILE_READ_BLOCKSIZE'],
+                                 app.config['FILE_READ_MODE'])
+
     # Lead "middleware" modules.  These may depend on both leaf modules and on
     # `app.app`.
     import sampleresolver
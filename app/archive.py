@@ -0,0 +1,265 @@
+"""
+Strategies for moving a file from the upload area into the archive.
+
+Uploads are staged under `UPLOAD_PATH`, which normally lives on the same
+filesystem as `STORE_PATH`.  In that case the archived file can simply be a
+hard link to the uploaded one, and no data needs to be copied at all.  When
+the two are on different filesystems the copy is done in the kernel, using
+`copy_file_range` or `sendfile`, if possible; copying through a userspace
+buffer is the last resort.
+
+The strategies are tried in the order given by the `ARCHIVE_STRATEGIES`
+configuration value, and the one that was used is reported, along with the
+time that it took, so that its performance can be monitored.
+
+If the checksum of the file is known, a copy is verified against it as the
+data pass through userspace on their way to the archive, so that verifying
+the copy costs no more I/O than making it.  The copies made in the kernel
+can't be verified in this way, and so are only used when the checksum is not
+known.  A link needs no verification, since it is the file that was verified
+when its upload was completed.
+
+Optionally, archived files can be deduplicated: each distinct file is kept
+once, as a blob named by its checksum, and every copy of it in the archive is
+a hard link to the blob, so that uploading the same data again costs neither
+space nor copying.
+"""
+
+import collections
+import ctypes
+import ctypes.util
+import errno
+import os
+import sys
+import time
+import uuid
+
+import checksum
+import file
+
+
+# The largest number of bytes that we ask the kernel to copy in one call.
+KERNEL_COPY_BLOCKSIZE = 64 * 1024 * 1024
+
+# Blobs are kept in this directory of the store.
+BLOB_DIR = '.blobs'
+
+# Blobs are named by the checksums of their contents, and so only checksums
+# that are practically free of collisions can be used to deduplicate files.
+DEDUPLICATION_METHODS = ['sha256', 'sha256-tree', 'blake2b']
+
+
+class ArchiveResult(collections.namedtuple('ArchiveResult', ['strategy', 'size', 'elapsed'])):
+
+    @property
+    def rate(self):
+        """
+        The rate at which the file was archived, in bytes per second.
+        """
+        if self.elapsed > 0:
+            return self.size / self.elapsed
+        else:
+            return float('inf')
+
+
+def _load_sendfile_():
+    """
+    Python 3 provides `os.sendfile`; on Python 2 we call the Linux system call
+    directly.  Returns `None` if `sendfile` is not available.
+    """
+    sendfile = getattr(os, 'sendfile', None)
+    if sendfile is not None or not sys.platform.startswith('linux'):
+        return sendfile
+    try:
+        libc_sendfile = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).sendfile
+    except (OSError, AttributeError):
+        return None
+    libc_sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                              ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    libc_sendfile.restype  = ctypes.c_ssize_t
+    def sendfile(out_fd, in_fd, offset, count):
+        c_offset = ctypes.c_int64(offset)
+        n = libc_sendfile(out_fd, in_fd, ctypes.byref(c_offset), count)
+        if n < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return n
+    return sendfile
+
+
+_sendfile_        = _load_sendfile_()
+_copy_file_range_ = getattr(os, 'copy_file_range', None)
+
+
+def _same_filesystem_(src, tgt):
+    return os.stat(src).st_dev == os.stat(os.path.dirname(tgt)).st_dev
+
+
+def _link_(src, tgt, expected):
+    os.link(src, tgt)
+
+
+def _copy_via_tmp_(copyfn):
+    """
+    Wrap a function that copies between file descriptors so that the copy is
+    made into a temporary file which is only renamed into place once it is
+    complete, and has been verified against the `expected` checksum (if any).
+    A partially copied, or corrupt, file must never be visible in the archive.
+    """
+    def copy(src, tgt, expected):
+        tmp = tgt + '.tmp'
+        digester = None if expected is None else checksum.get_digester(expected[0])
+        try:
+            with open(src, 'rb') as s:
+                with open(tmp, 'wb') as t:
+                    copyfn(s, t, os.fstat(s.fileno()).st_size, digester)
+            if digester is not None and digester.hexdigest() != expected[1]:
+                raise checksum.ChecksumMismatch(src, expected[0], expected[1], digester.hexdigest())
+            os.rename(tmp, tgt)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+    return copy
+
+
+def _copy_file_range_copy_(s, t, size, digester):
+    copied = 0
+    while copied < size:
+        n = _copy_file_range_(s.fileno(), t.fileno(), min(size - copied, KERNEL_COPY_BLOCKSIZE))
+        if n == 0:
+            break
+        copied += n
+
+
+def _sendfile_copy_(s, t, size, digester):
+    copied = 0
+    while copied < size:
+        n = _sendfile_(t.fileno(), s.fileno(), copied, min(size - copied, KERNEL_COPY_BLOCKSIZE))
+        if n == 0:
+            break
+        copied += n
+
+
+def _buffered_copy_(s, t, size, digester):
+    def consume(data):
+        t.write(data)
+        if digester is not None:
+            digester.update(data)
+    file.FileProcessor(s.name, consume).process()
+
+
+# Each strategy is a pair of functions: a predicate that determines whether the
+# strategy can be used for a given source, target and expected checksum, and
+# the function that archives the file.
+STRATEGIES = collections.OrderedDict([
+    ('link',            (lambda src, tgt, expected: _same_filesystem_(src, tgt),
+                         _link_)),
+    ('copy_file_range', (lambda src, tgt, expected: expected is None and _copy_file_range_ is not None,
+                         _copy_via_tmp_(_copy_file_range_copy_))),
+    ('sendfile',        (lambda src, tgt, expected: expected is None and _sendfile_ is not None,
+                         _copy_via_tmp_(_sendfile_copy_))),
+    ('copy',            (lambda src, tgt, expected: True,
+                         _copy_via_tmp_(_buffered_copy_)))])
+
+
+def archive_file(src, tgt, strategies, logger, expected=None):
+    """
+    Place the file `src` into the archive as `tgt`, using the first of the
+    named `strategies` that is applicable and succeeds.  The target directory
+    must exist.  Returns an `ArchiveResult`.
+
+    If `expected`, a pair of checksum method and value, is given, a copy of
+    the file is verified as it's made, and a `ChecksumMismatch` is raised
+    (and nothing is archived) if it doesn't match.
+
+    Archiving is idempotent: if `tgt` is already a link to `src` (e.g. because
+    a previous sweep was interrupted before it could update the database)
+    nothing is done.
+    """
+    if os.path.exists(tgt) and os.path.samefile(src, tgt):
+        return ArchiveResult('link', os.path.getsize(src), 0.0)
+
+    last_error = None
+    for name in strategies:
+        applies, archivefn = STRATEGIES[name]
+        if not applies(src, tgt, expected):
+            continue
+        start = time.time()
+        try:
+            archivefn(src, tgt, expected)
+        except (IOError, OSError), e:
+            logger.warning('Archive strategy %s failed for %s: %s', name, src, e)
+            last_error = e
+            continue
+        result = ArchiveResult(name, os.path.getsize(tgt), time.time() - start)
+        logger.info('Archived %s -> %s using %s: %d bytes in %.3fs (%.1f MB/s)',
+                    src, tgt, name, result.size, result.elapsed, result.rate / (1024 * 1024))
+        return result
+
+    if last_error is not None:
+        raise last_error
+    raise Exception('No applicable archive strategy for %s in %s' % (src, strategies))
+
+
+def _makedirs_(d):
+    try:
+        os.makedirs(d)
+    except OSError:
+        # Someone else may have created it in the meantime.
+        if not os.path.isdir(d):
+            raise
+
+
+def blob_path(root, method, value):
+    return os.path.join(root, BLOB_DIR, method, value[:2], value[2:4], value)
+
+
+def archive_deduplicated_file(src, tgt, root, strategies, logger, expected):
+    """
+    Place the file `src`, with the checksum `expected`, into the archive as
+    `tgt`, as a hard link to the blob in the store at `root` with the same
+    checksum.  If there is no such blob, `src` is archived as the blob first
+    (cf. `archive_file`); otherwise, nothing is copied, and the result's
+    strategy is `'deduplicated'`.  Returns an `ArchiveResult`.
+    """
+    start = time.time()
+    blob  = blob_path(root, *expected)
+    if os.path.exists(blob):
+        strategy = 'deduplicated'
+    else:
+        # The blob is archived under a name of its own and then linked into
+        # place, so that two identical files that are archived at once don't
+        # interfere with each other.
+        _makedirs_(os.path.dirname(blob))
+        tmp = '%s.%s' % (blob, uuid.uuid4().hex[:8])
+        strategy = archive_file(src, tmp, strategies, logger, expected).strategy
+        try:
+            os.link(tmp, blob)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            strategy = 'deduplicated'
+        finally:
+            os.remove(tmp)
+
+    if not (os.path.exists(tgt) and os.path.samefile(blob, tgt)):
+        # Linked via a temporary name, so that the link replaces anything left
+        # at `tgt` by an interrupted sweep.
+        tmp = tgt + '.tmp'
+        try:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            os.link(blob, tmp)
+        except OSError, e:
+            if e.errno != errno.EMLINK:
+                raise
+            # The blob has as many links as the filesystem allows.
+            logger.warning('Unable to deduplicate %s: %s', src, e)
+            return archive_file(src, tgt, strategies, logger, expected)
+        os.rename(tmp, tgt)
+
+    result = ArchiveResult(strategy, os.path.getsize(tgt), time.time() - start)
+    logger.info('Archived %s -> %s (%s) using %s: %d bytes in %.3fs',
+                src, tgt, blob, strategy, result.size, result.elapsed)
+    return result
@@ -0,0 +1,735 @@
+"""
+Incremental reassembly of files that are uploaded in parts.
+
+Rather than waiting for the client to tell us that all of the parts of a file
+have been uploaded and then concatenating (and checksumming) them in one go,
+each part is appended to the reassembled file as soon as all of the parts that
+precede it have arrived.  Parts that arrive out of order are left where
+`upload_file` saved them until the gap in the sequence has been filled.
+
+Completing an upload is then only a matter of comparing the running digest
+with the checksum supplied by the client and renaming the reassembled file.
+
+Alternatively, if the upload is prepared in advance, the reassembled file is
+allocated at its full size and each part is written directly into it at its
+offset as it is received, so that no part files exist at all.  The running
+digest is then advanced by reading back the parts that are contiguous with
+those that have already been digested.
+
+The digest of every part is checked against the one sent by the client, if
+any, as the part is received, and is recorded in a journal; each part is
+checked against its recorded digest again as it is appended.  The part digests
+are combined into a Merkle root that is stored with the checksum of the file,
+so that parts of the file can later be verified without reading all of it.
+
+The parts of a file may be received by different web server processes, and so
+the state of an assembly is kept on disk, and the upload directory is locked
+(with `flock`) while it is read or changed; cf. `Assembly`.
+"""
+
+import binascii
+import contextlib
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import glob
+import json
+import os
+import sys
+import threading
+import uuid
+
+import checksum
+import file
+import http
+
+
+PART_EXT      = 'part'
+ASSEMBLY_NAME = '.assembly'
+MANIFEST_NAME = '.assembly.json'
+JOURNAL_NAME  = '.assembly.parts'
+
+# The checksum method for which a digest is maintained as the parts are
+# appended.  Clients that use any other method will force a (single) read of
+# the reassembled file when the upload is completed.
+RUNNING_CHECKSUM_METHOD = 'sha256'
+
+# Recorded in the journal in place of the digest of a part that was found to
+# be corrupt, and has to be sent again.
+DISCARDED = '-'
+
+
+class AssemblyError(Exception):
+    status_code = http.HTTP_409_CONFLICT
+
+
+class UnknownAssembly(AssemblyError):
+    status_code = http.HTTP_404_NOT_FOUND
+
+    def __init__(self, part_dir):
+        self.part_dir = part_dir
+        self.message  = 'No parts have been uploaded to %s' % part_dir
+    def __str__(self):
+        return self.message
+
+
+class AssemblyInProgress(AssemblyError):
+    def __init__(self, part_dir):
+        self.part_dir = part_dir
+        self.message  = 'An upload to %s is already in progress' % part_dir
+    def __str__(self):
+        return self.message
+
+
+class InsufficientStorage(AssemblyError):
+    status_code = http.HTTP_507_INSUFFICIENT_STORAGE
+
+    def __init__(self, part_dir, size):
+        self.part_dir = part_dir
+        self.size     = size
+        self.message  = 'Unable to allocate %d bytes in %s' % (size, part_dir)
+    def __str__(self):
+        return self.message
+
+
+class PartSizeMismatch(AssemblyError):
+    status_code = http.HTTP_400_BAD_REQUEST
+
+    def __init__(self, part_dir, part_number, expected_size):
+        self.part_dir      = part_dir
+        self.part_number   = part_number
+        self.expected_size = expected_size
+        self.message       = 'Part %d of upload %s must be %d bytes long' % (part_number, part_dir, expected_size)
+    def __str__(self):
+        return self.message
+
+
+class IncompleteAssembly(AssemblyError):
+    def __init__(self, part_dir, next_part, total_parts):
+        self.part_dir    = part_dir
+        self.next_part   = next_part
+        self.total_parts = total_parts
+        self.message     = 'Upload %s is incomplete; part %d of %d has not been received' % (part_dir, next_part, total_parts)
+    def __str__(self):
+        return self.message
+
+
+def part_filename(part_number, total_parts):
+    """
+    Parts are saved into files with names of the form 00.part.  The number of
+    leading zeroes depends on the number of parts.
+    """
+    fmtstr = '%%0%dd' % len(str(total_parts))
+    return '.'.join([(fmtstr % int(part_number)), PART_EXT])
+
+
+def _load_posix_fallocate_():
+    """
+    Python 3 provides `os.posix_fallocate`; on Python 2 we call the C library
+    function directly.  Returns `None` if it is not available.
+    """
+    fallocate = getattr(os, 'posix_fallocate', None)
+    if fallocate is not None or not sys.platform.startswith('linux'):
+        return fallocate
+    try:
+        libc_fallocate = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).posix_fallocate64
+    except (OSError, AttributeError):
+        return None
+    libc_fallocate.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    libc_fallocate.restype  = ctypes.c_int
+    def fallocate(fd, offset, length):
+        # Unusually, the error number is the return value.
+        e = libc_fallocate(fd, offset, length)
+        if e != 0:
+            raise OSError(e, os.strerror(e))
+    return fallocate
+
+
+_posix_fallocate_ = _load_posix_fallocate_()
+
+
+def _preallocate_(path, size):
+    """
+    Create the file `path`, `size` bytes long.  The space for the file is
+    reserved if the filesystem supports it, so that an upload that won't fit
+    is refused before any of it is sent; otherwise the file is sparse.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0644)
+    try:
+        os.ftruncate(fd, size)
+        if _posix_fallocate_ is not None and size > 0:
+            try:
+                _posix_fallocate_(fd, 0, size)
+            except OSError, e:
+                if e.errno == errno.ENOSPC:
+                    raise InsufficientStorage(os.path.dirname(path), size)
+    except:
+        os.close(fd)
+        os.remove(path)
+        raise
+    os.close(fd)
+
+
+def _remove_if_exists_(path):
+    try:
+        os.remove(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+@contextlib.contextmanager
+def _locked_(part_dir):
+    """
+    Hold an exclusive lock on the upload `part_dir` for the duration of the
+    context.  The lock is taken on the directory itself, with `flock`, and so
+    excludes the other threads of this process as well as other processes.
+    """
+    fd = os.open(part_dir, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+class Assembly(object):
+    """
+    The state of the reassembly of a single uploaded file.
+
+    The parts of a file may be received by any number of web server processes,
+    and so the state of record is on disk: the manifest, the journal of the
+    parts that have been received, and the reassembled file, from whose size
+    the number of parts that have been appended follows.  An instance is only
+    a cache of that state, which is brought up to date (cf. `sync`) whenever
+    the assembly is used, with the upload directory locked.  The running
+    digest, which can't be shared, covers only the data that this process has
+    seen, and is caught up with the rest of the file when it is needed.
+    """
+
+    def __init__(self, part_dir, total_parts, chunk_size, total_size, preallocated=False):
+        self.part_dir     = part_dir
+        self.total_parts  = int(total_parts)
+        self.chunk_size   = int(chunk_size)
+        self.total_size   = int(total_size)
+        self.preallocated = preallocated
+        self.method      = RUNNING_CHECKSUM_METHOD
+        self.digester    = checksum.get_digester(self.method)
+        self.digested    = 0
+        self.next_part   = 1
+        self.parts       = {}
+        self.journal_end = 0
+        self.manifest_id = None
+
+    @property
+    def target_path(self):
+        return os.path.join(self.part_dir, ASSEMBLY_NAME)
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.part_dir, MANIFEST_NAME)
+
+    @property
+    def journal_path(self):
+        return os.path.join(self.part_dir, JOURNAL_NAME)
+
+    @property
+    def is_complete(self):
+        return self.next_part > self.total_parts
+
+    def part_path(self, part_number):
+        return os.path.join(self.part_dir, part_filename(part_number, self.total_parts))
+
+    def part_offset(self, part_number):
+        return self.chunk_size * (part_number - 1)
+
+    def part_size(self, part_number):
+        """
+        The size that part `part_number` should be.  Every part is
+        `chunk_size` bytes long, except the last, which takes the remainder
+        (and so may be longer than `chunk_size`).
+        """
+        if part_number < self.total_parts:
+            return self.chunk_size
+        else:
+            return self.total_size - (self.chunk_size * (self.total_parts - 1))
+
+    def part_end(self, part_number):
+        """
+        The offset of the end of part `part_number`; 0 for part 0.
+        """
+        if part_number == 0:
+            return 0
+        return self.part_offset(part_number) + self.part_size(part_number)
+
+    def save_manifest(self):
+        # Written under a temporary name, so that no process ever reads a
+        # partially written manifest.
+        with open(self.manifest_path + '.tmp', 'w') as mf:
+            json.dump({'total_parts' : self.total_parts,
+                       'chunk_size'  : self.chunk_size,
+                       'total_size'  : self.total_size,
+                       'preallocated': self.preallocated},
+                      mf)
+        os.rename(self.manifest_path + '.tmp', self.manifest_path)
+        self.manifest_id = self._manifest_id_()
+
+    def _manifest_id_(self):
+        # Identifies the manifest, and so the upload, that the assembly is for:
+        # an upload that is completed and then started again has a new one.
+        try:
+            st = os.stat(self.manifest_path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime)
+
+    @property
+    def is_current(self):
+        return self.manifest_id is not None and self.manifest_id == self._manifest_id_()
+
+    def load_journal(self):
+        """
+        Read the entries that have been added to the journal since it was last
+        read, by this or any other process.  Must be called with the lock held.
+        """
+        if not os.path.isfile(self.journal_path):
+            return
+        with open(self.journal_path, 'r') as jf:
+            jf.seek(self.journal_end)
+            for line in jf:
+                self.journal_end += len(line)
+                fields = line.split()
+                if len(fields) != 3:
+                    # Left by a process that failed as it wrote the entry.
+                    continue
+                part_number, size, digest = fields
+                if digest == DISCARDED:
+                    self.parts.pop(int(part_number), None)
+                else:
+                    self.parts[int(part_number)] = (int(size), digest)
+
+    def _journal_(self, part_number, size, digest):
+        # The journal is only ever appended to, so that recording a part costs
+        # the same regardless of how many parts have been uploaded.  Must be
+        # called with the lock held.
+        with open(self.journal_path, 'a') as jf:
+            jf.write('%d %d %s\n' % (part_number, size, digest))
+
+    def sync(self):
+        """
+        Bring the state of the assembly up to date with what is on disk.  Must
+        be called with the lock held.
+        """
+        if not self.is_current:
+            raise UnknownAssembly(self.part_dir)
+        self.load_journal()
+        self.recover()
+
+    def save_part(self, part_number, stream, blocksize=file.FileProcessor.DEFAULT_READ_BLOCKSIZE,
+                  expected_digest=None):
+        """
+        Save the part `part_number` from `stream`, recording its size and
+        digest in the journal.  The part is written to a temporary file of its
+        own, so that neither a concurrent `advance` nor another copy of the
+        part that is received at the same time can see it partially written;
+        or, if the assembly is preallocated, directly into the reassembled file,
+        in which case the part is only recorded once it has been written in
+        full.
+
+        The part is checked as it is received, so that a bad part is refused
+        on the request that sent it: it must be the size given by `part_size`
+        (or it would displace the parts that follow it), and have the digest
+        `expected_digest`, if the client sent one.  A part that has already
+        been assembled is not written again, but must be the same as before.
+        """
+        part_number = int(part_number)
+        with _locked_(self.part_dir):
+            self.sync()
+            assembled = self._is_assembled_(part_number)
+        if assembled:
+            # E.g. the response to the part was lost, and the client sent it
+            # again.
+            size, digest = self._copy_part_(stream, lambda buf: None, blocksize,
+                                            self.part_size(part_number))
+            self._check_part_(part_number, size, digest, expected_digest)
+            recorded = self.parts.get(part_number)
+            if recorded is not None and recorded[1] != digest:
+                raise checksum.ChecksumMismatch(
+                    self.part_path(part_number), self.method, recorded[1], digest)
+            return
+        part_path = self.part_path(part_number)
+        if self.preallocated:
+            size, digest = self._write_part_(part_number, stream, blocksize)
+            try:
+                self._check_part_(part_number, size, digest, expected_digest)
+            except checksum.ChecksumMismatch:
+                # The part was written into place, over any copy of it that
+                # was received in the meantime.
+                with _locked_(self.part_dir):
+                    self.sync()
+                    if part_number in self.parts:
+                        del self.parts[part_number]
+                        self._journal_(part_number, 0, DISCARDED)
+                raise
+        else:
+            tmp_path = '%s.%s.tmp' % (part_path, uuid.uuid4().hex)
+            try:
+                with open(tmp_path, 'wb') as pf:
+                    size, digest = self._copy_part_(stream, pf.write, blocksize,
+                                                    self.part_size(part_number))
+                self._check_part_(part_number, size, digest, expected_digest)
+            except:
+                _remove_if_exists_(tmp_path)
+                raise
+        with _locked_(self.part_dir):
+            self.sync()
+            if not self.preallocated:
+                if self._is_assembled_(part_number):
+                    # Appended in the meantime, from another copy of the part.
+                    _remove_if_exists_(tmp_path)
+                    return
+                os.rename(tmp_path, part_path)
+            self.parts[part_number] = (size, digest)
+            self._journal_(part_number, size, digest)
+
+    def _is_assembled_(self, part_number):
+        # Must be called with the lock held.
+        if self.preallocated:
+            return part_number in self.parts
+        else:
+            return part_number < self.next_part
+
+    def _check_part_(self, part_number, size, digest, expected_digest):
+        if size != self.part_size(part_number):
+            raise PartSizeMismatch(self.part_dir, part_number, self.part_size(part_number))
+        if expected_digest is not None and expected_digest.lower() != digest:
+            raise checksum.ChecksumMismatch(
+                self.part_path(part_number), self.method, expected_digest, digest)
+
+    def _copy_part_(self, stream, write, blocksize, limit=None):
+        digester = checksum.get_digester(self.method)
+        size     = 0
+        buf = stream.read(blocksize)
+        while len(buf) > 0:
+            size += len(buf)
+            if limit is not None and size > limit:
+                return size, None
+            write(buf)
+            digester.update(buf)
+            buf = stream.read(blocksize)
+        return size, digester.hexdigest()
+
+    def _write_part_(self, part_number, stream, blocksize):
+        # Every part is written through a descriptor of its own, so parts can
+        # be received concurrently.  No more than the size of the part is
+        # written, so that a part that is too long can't overwrite its
+        # neighbour.
+        fd = os.open(self.target_path, os.O_WRONLY)
+        try:
+            os.lseek(fd, self.part_offset(part_number), os.SEEK_SET)
+            def write(buf):
+                while len(buf) > 0:
+                    buf = buf[os.write(fd, buf):]
+            return self._copy_part_(stream, write, blocksize, self.part_size(part_number))
+        finally:
+            os.close(fd)
+
+    def has_part(self, part_number, size=None, digest=None):
+        """
+        Determine whether part `part_number` has been received, and, if `size`
+        or `digest` is given, whether it was the same size and had the same
+        digest (computed using `method`).  This is answered from the state of
+        the assembly, so that a client resuming an upload can probe every part
+        without us having to look at the part files: parts that have already
+        been appended are accounted for by `next_part`, and only a part that is
+        still waiting to be appended is checked for on disk.
+        """
+        part_number = int(part_number)
+        with _locked_(self.part_dir):
+            self.sync()
+            recorded = self.parts.get(part_number)
+            if part_number < self.next_part:
+                pass
+            elif recorded is None:
+                return False
+            elif not self.preallocated and not os.path.isfile(self.part_path(part_number)):
+                return False
+            if size is not None:
+                recorded_size = recorded[0] if recorded is not None else self.part_size(part_number)
+                if recorded_size != int(size):
+                    return False
+            if digest is not None:
+                # Parts appended before the journal was kept have no recorded
+                # digest, and so can't be verified; have them sent again.
+                if recorded is None or recorded[1] != digest.lower():
+                    return False
+            return True
+
+    def parts_root(self):
+        """
+        Returns the Merkle root of the digests of all of the parts, or `None`
+        if any of them was not recorded.
+        """
+        parts = range(1, self.total_parts + 1)
+        if not all(n in self.parts for n in parts):
+            return None
+        return checksum.merkle_root(
+            [binascii.unhexlify(self.parts[n][1]) for n in parts], self.method)
+
+    def recover(self):
+        """
+        Work out how many parts have been appended to the reassembled file,
+        which may have been done by another process, or before the service was
+        restarted.  The parts are appended in order, and each is the size given
+        by `part_size`, so the parts that have been appended in full are those
+        that end within the file.  Anything beyond the end of the last of
+        them was left by an append that didn't finish, and is truncated; the
+        source of a part is only removed once it has been appended in full (and
+        is removed here if that was not done).
+        Must be called with the lock held.
+
+        The file of a preallocated assembly is always full size; the parts
+        that have been received are those in the journal, and those that have
+        been digested are those that this process has digested.
+        """
+        if self.preallocated or not os.path.isfile(self.target_path):
+            return
+        size = os.path.getsize(self.target_path)
+        if size >= self.total_size:
+            appended = self.total_parts
+        else:
+            appended = min(size // self.chunk_size, self.total_parts - 1)
+        end = self.part_end(appended)
+        if size > end:
+            with open(self.target_path, 'r+b') as f:
+                f.truncate(end)
+        elif appended > 0 and os.path.isfile(self.part_path(appended)):
+            # Appended in full, but not removed.
+            os.remove(self.part_path(appended))
+        self.next_part = appended + 1
+
+    def _catch_up_(self):
+        # Feed the running digest the parts that other processes appended.
+        # Must be called with the lock held.
+        end = self.part_end(self.next_part - 1)
+        if self.digested < end:
+            file.FileProcessor(self.target_path, self.digester.update,
+                               offset=self.digested,
+                               length=end - self.digested).process()
+            self.digested = end
+
+    def advance(self):
+        """
+        Append to the reassembled file every part that is contiguous with its
+        end.  Returns the number of the next part that is needed.
+        """
+        with _locked_(self.part_dir):
+            self.sync()
+            if self.preallocated:
+                while not self.is_complete and self.next_part in self.parts:
+                    if not self._digest_():
+                        break
+                    self.next_part += 1
+                return self.next_part
+            with open(self.target_path, 'ab') as target:
+                while not self.is_complete:
+                    part_path = self.part_path(self.next_part)
+                    if not os.path.isfile(part_path):
+                        break
+                    if not self._append_(target, part_path):
+                        break
+                    os.remove(part_path)
+                    self.next_part += 1
+            return self.next_part
+
+    def _append_(self, target, part_path):
+        # The running digest can't be rewound, so a part is fed to a copy of
+        # it which only replaces the original once the part has been checked
+        # against its recorded digest.  A part that fails the check (having
+        # been corrupted since it was received) is discarded, and forgotten,
+        # so that the client is asked for it again.  Returns whether the part
+        # was appended.  If the running digest is behind the file, it is left
+        # to `_catch_up_`.
+        target.seek(0, os.SEEK_END)
+        offset = target.tell()
+        running_digester = self.digester.copy() if self.digested == offset else None
+        part_digester    = checksum.get_digester(self.method)
+        def consume(data):
+            target.write(data)
+            if running_digester is not None:
+                running_digester.update(data)
+            part_digester.update(data)
+        file.FileProcessor(part_path, consume).process()
+        target.flush()
+        recorded = self.parts.get(self.next_part)
+        if recorded is not None and recorded[1] != part_digester.hexdigest():
+            target.truncate(offset)
+            os.remove(part_path)
+            del self.parts[self.next_part]
+            self._journal_(self.next_part, 0, DISCARDED)
+            return False
+        if running_digester is not None:
+            self.digester = running_digester
+            self.digested = target.tell()
+        return True
+
+    def _digest_(self):
+        # The preallocated counterpart of `_append_`: the part is already in
+        # place, so it need only be read back and checked.  A part that fails
+        # the check is forgotten, so that the client is asked for it again.
+        recorded = self.parts[self.next_part]
+        running_digester = self.digester.copy()
+        part_digester    = checksum.get_digester(self.method)
+        def consume(data):
+            running_digester.update(data)
+            part_digester.update(data)
+        file.FileProcessor(self.target_path, consume,
+                           offset=self.part_offset(self.next_part),
+                           length=recorded[0]).process()
+        if recorded[1] != part_digester.hexdigest():
+            del self.parts[self.next_part]
+            self._journal_(self.next_part, 0, DISCARDED)
+            return False
+        self.digester = running_digester
+        return True
+
+    def finalize(self, method):
+        """
+        Make sure that every part has been appended and return the checksum of
+        the reassembled file, computed using `method`.  Raises an
+        `IncompleteAssembly` error if any part is missing.
+        """
+        self.advance()
+        with _locked_(self.part_dir):
+            self.sync()
+            if not self.is_complete:
+                raise IncompleteAssembly(self.part_dir, self.next_part, self.total_parts)
+            if method == self.method:
+                if not self.preallocated:
+                    self._catch_up_()
+                return self.digester.hexdigest()
+            elif self._parts_are_leaves_(method):
+                # The parts are exactly the leaves of the tree hash, whose
+                # digests we already have.
+                return self.parts_root()
+            else:
+                return checksum.generate_checksum(self.target_path, method)
+
+    def _parts_are_leaves_(self, method):
+        return checksum.TREE_METHODS.get(method) == self.method and \
+            self.chunk_size == checksum.TREE_LEAF_SIZE and \
+            self.part_size(self.total_parts) <= self.chunk_size and \
+            self.parts_root() is not None
+
+    def commit(self, fname):
+        """
+        Move the reassembled file to its final name, `fname`, and forget about
+        the assembly.
+        """
+        with _locked_(self.part_dir):
+            os.rename(self.target_path, fname)
+            for path in [self.manifest_path, self.journal_path]:
+                if os.path.exists(path):
+                    os.remove(path)
+        _discard_assembly_(self.part_dir)
+
+
+# Assemblies are cached by the processes that use them, for their running
+# digests; cf. `Assembly`.
+_assemblies_      = {}
+_assemblies_lock_ = threading.Lock()
+
+
+def _load_assembly_(part_dir, total_parts, chunk_size, total_size):
+    # Must be called with the lock held.
+    manifest_path = os.path.join(part_dir, MANIFEST_NAME)
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, 'r') as mf:
+            a = Assembly(part_dir, **json.load(mf))
+        a.manifest_id = a._manifest_id_()
+        a.sync()
+        return a
+    elif total_parts is not None:
+        a = Assembly(part_dir, total_parts, chunk_size, total_size)
+    else:
+        # Parts uploaded before incremental reassembly was introduced have no
+        # manifest; assume that the parts on disk are the complete set.
+        parts = sorted(glob.glob(os.path.join(part_dir, '*.' + PART_EXT)))
+        if len(parts) == 0:
+            raise UnknownAssembly(part_dir)
+        a = Assembly(part_dir,
+                     len(parts),
+                     os.path.getsize(parts[0]),
+                     sum(map(os.path.getsize, parts)))
+    a.save_manifest()
+    return a
+
+
+def _cache_assembly_(a):
+    # An assembly that is already cached is kept, along with its running
+    # digest, if it is for the same upload.
+    with _assemblies_lock_:
+        cached = _assemblies_.get(a.part_dir)
+        if cached is not None and cached.manifest_id == a.manifest_id:
+            return cached
+        _assemblies_[a.part_dir] = a
+        return a
+
+
+def _discard_assembly_(part_dir):
+    with _assemblies_lock_:
+        _assemblies_.pop(part_dir, None)
+
+
+def prepare_assembly(part_dir, total_parts, chunk_size, total_size):
+    """
+    Start a preallocated assembly of a file in `part_dir`.  Preparing the same
+    upload again is harmless, but an upload to `part_dir` that has already
+    been started in some other way can't be prepared.
+    """
+    with _locked_(part_dir):
+        if os.path.isfile(os.path.join(part_dir, MANIFEST_NAME)):
+            a = _load_assembly_(part_dir, None, None, None)
+            if not (a.preallocated and
+                    (a.total_parts, a.chunk_size, a.total_size) ==
+                    (int(total_parts), int(chunk_size), int(total_size))):
+                raise AssemblyInProgress(part_dir)
+        else:
+            a = Assembly(part_dir, total_parts, chunk_size, total_size, preallocated=True)
+            _preallocate_(a.target_path, a.total_size)
+            a.save_manifest()
+    return _cache_assembly_(a)
+
+
+def get_assembly(part_dir, total_parts=None, chunk_size=None, total_size=None):
+    """
+    Retrieve the assembly for the file being uploaded into `part_dir`, creating
+    it if necessary.  The size parameters are only needed when the first part
+    of a file is received.
+    """
+    with _assemblies_lock_:
+        a = _assemblies_.get(part_dir)
+    if a is not None and a.is_current:
+        return a
+    with _locked_(part_dir):
+        a = _load_assembly_(part_dir, total_parts, chunk_size, total_size)
+    return _cache_assembly_(a)
+
+
+def find_assembly(part_dir):
+    """
+    Retrieve the assembly for the file being uploaded into `part_dir`, or
+    `None` if there is none.  Unlike `get_assembly`, nothing is created.
+    """
+    with _assemblies_lock_:
+        a = _assemblies_.get(part_dir)
+    if a is not None and a.is_current:
+        return a
+    if not os.path.isfile(os.path.join(part_dir, MANIFEST_NAME)):
+        return None
+    with _locked_(part_dir):
+        if not os.path.isfile(os.path.join(part_dir, MANIFEST_NAME)):
+            return None
+        a = _load_assembly_(part_dir, None, None, None)
+    return _cache_assembly_(a)
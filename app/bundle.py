@@ -0,0 +1,84 @@
+"""
+Bundles of archived files, streamed as tar files.
+
+A bundle is generated on the fly from the files in the store, and is never
+written to disk.  Its layout is deterministic (the members are in the order
+given, with headers derived only from their names, sizes and modification
+times), and so its size is known before it's sent, and any range of it can be
+generated on its own: an interrupted download can be resumed from the byte
+at which it stopped, like that of any other file.
+"""
+
+import bisect
+import datetime
+import hashlib
+import os
+import tarfile
+
+
+class Bundle(object):
+    """
+    A tar file of `members`, which are `(name, path, checksum)` triples: the
+    name of a member in the bundle, the path of the file in the store, and its
+    checksum (which may be `None`), which contributes to the bundle's ETag.
+
+    The bundle is a sequence of segments, each of which is either a string or
+    a range of a file, and whose offsets in the bundle are known; reading a
+    range of the bundle means reading only the segments that overlap it.
+    """
+
+    def __init__(self, members, blocksize=1024*1024):
+        self.blocksize = blocksize
+        self.segments  = []
+        self.offsets   = []
+        self.size      = 0
+        digester = hashlib.sha256()
+        mtime    = 0
+        for name, path, value in members:
+            st = os.stat(path)
+            info = tarfile.TarInfo(name)
+            info.size  = st.st_size
+            info.mtime = int(st.st_mtime)
+            info.mode  = 0644
+            self._add_(info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'strict'))
+            self._add_((path, info.size))
+            self._add_(tarfile.NUL * (-info.size % tarfile.BLOCKSIZE))
+            digester.update((u'%s\0%s\0%d\0%d\0' % (name, value or '', info.size, info.mtime)).encode('utf-8'))
+            mtime = max(mtime, info.mtime)
+        # The end of the archive is marked by two empty blocks.
+        self._add_(tarfile.NUL * 2 * tarfile.BLOCKSIZE)
+        self.etag  = 'tar-' + digester.hexdigest()
+        self.mtime = datetime.datetime.utcfromtimestamp(mtime)
+
+    def _add_(self, segment):
+        length = len(segment) if isinstance(segment, str) else segment[1]
+        if length > 0:
+            self.segments.append(segment)
+            self.offsets.append(self.size)
+            self.size += length
+
+    def read(self, start, stop):
+        """
+        Returns an iterator over the bytes of the bundle from `start` to `stop`.
+        """
+        i = bisect.bisect_right(self.offsets, start) - 1
+        while start < stop and i < len(self.segments):
+            segment = self.segments[i]
+            offset  = start - self.offsets[i]
+            if isinstance(segment, str):
+                data = segment[offset:offset + stop - start]
+                start += len(data)
+                yield data
+            else:
+                path, size = segment
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    remaining = min(size - offset, stop - start)
+                    while remaining > 0:
+                        data = f.read(min(self.blocksize, remaining))
+                        if not data:
+                            raise IOError('%s is shorter than expected' % path)
+                        remaining -= len(data)
+                        start += len(data)
+                        yield data
+            i += 1
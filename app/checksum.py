@@ -1,11 +1,118 @@
 
+import binascii
 import hashlib
+import json
+import mmap
+import multiprocessing
+import os
+import struct
+import zlib
+
+from multiprocessing.pool import ThreadPool
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 import file
 import http
 
 
-DIGESTERS = {'sha256': lambda: hashlib.sha256() }
+# The size of the leaves of the tree hashes (cf. `TreeDigester`).
+TREE_LEAF_SIZE = 64 * 1024 * 1024
+
+# The checksum of an uploaded file is kept alongside it, in a file with this
+# extension.
+SIDECAR_EXT = 'checksum'
+
+
+class _ZlibDigester_(object):
+    """
+    Wraps one of the checksum functions of `zlib` in the interface of a
+    `hashlib` digester.  These are much cheaper to compute than a
+    cryptographic hash, and are intended only for detecting accidental
+    corruption.
+    """
+
+    def __init__(self, fn, value):
+        self.fn    = fn
+        self.value = value
+
+    def update(self, data):
+        self.value = self.fn(data, self.value)
+
+    def digest(self):
+        return struct.pack('>I', self.value & 0xffffffff)
+
+    def hexdigest(self):
+        return '%08x' % (self.value & 0xffffffff)
+
+    def copy(self):
+        return _ZlibDigester_(self.fn, self.value)
+
+
+class TreeDigester(object):
+    """
+    A digester for a tree hash: the data are split into leaves of `leaf_size`
+    bytes, each of which is hashed using `method`, and the digests of the
+    leaves are combined into a Merkle root (cf. `merkle_root`).  Unlike a
+    plain hash, the leaves can be hashed independently, and so in parallel;
+    cf. `generate_checksum`.
+    """
+
+    def __init__(self, method, leaf_size=None):
+        self.method      = method
+        self.leaf_size   = leaf_size or TREE_LEAF_SIZE
+        self.leaves      = []
+        self.leaf        = get_digester(method)
+        self.leaf_filled = 0
+
+    def update(self, data):
+        offset = 0
+        while offset < len(data):
+            n = min(len(data) - offset, self.leaf_size - self.leaf_filled)
+            self.leaf.update(data[offset:offset+n])
+            self.leaf_filled += n
+            offset += n
+            if self.leaf_filled == self.leaf_size:
+                self.leaves.append(self.leaf.digest())
+                self.leaf        = get_digester(self.method)
+                self.leaf_filled = 0
+
+    def _leaf_digests_(self):
+        if self.leaf_filled > 0:
+            return self.leaves + [self.leaf.digest()]
+        else:
+            return self.leaves
+
+    def digest(self):
+        return binascii.unhexlify(self.hexdigest())
+
+    def hexdigest(self):
+        return merkle_root(self._leaf_digests_(), self.method)
+
+    def copy(self):
+        c = TreeDigester(self.method, self.leaf_size)
+        c.leaves      = list(self.leaves)
+        c.leaf        = self.leaf.copy()
+        c.leaf_filled = self.leaf_filled
+        return c
+
+
+DIGESTERS = {'sha256'     : lambda: hashlib.sha256(),
+             'sha256-tree': lambda: TreeDigester('sha256'),
+             'crc32'      : lambda: _ZlibDigester_(zlib.crc32, 0),
+             'adler32'    : lambda: _ZlibDigester_(zlib.adler32, 1)}
+
+# Tree hashes of files are computed in parallel; this maps each tree method to
+# the method used to hash its leaves.
+TREE_METHODS = {'sha256-tree': 'sha256'}
+
+if hasattr(hashlib, 'blake2b'):
+    DIGESTERS['blake2b'] = lambda: hashlib.blake2b()
+if xxhash is not None:
+    DIGESTERS['xxh64'] = lambda: xxhash.xxh64()
 
 
 class ChecksumError(Exception):
@@ -36,18 +143,85 @@ def get_digester(method):
     Retrieve a digester that implements the checksum `method`.  Returns an
     instance of a hashlib digester.
     """
-    digesterfn = DIGESTERS[method]
+    digesterfn = DIGESTERS.get(method)
     if digesterfn is None:
         raise UnsupportedChecksumMethod(method)
     else:
         return digesterfn()
 
 
+def merkle_root(digests, method):
+    """
+    Combine a sequence of (binary) digests into a single Merkle root.  Adjacent
+    pairs of digests are concatenated and hashed using `method`, with an odd
+    digest at the end of a level being promoted unchanged, until only the root
+    remains.  Returns the root as a hex-encoded string.
+    """
+    level = list(digests)
+    if len(level) == 0:
+        return get_digester(method).hexdigest()
+    while len(level) > 1:
+        parents = []
+        for i in range(0, len(level) - 1, 2):
+            digester = get_digester(method)
+            digester.update(level[i] + level[i+1])
+            parents.append(digester.digest())
+        if len(level) % 2 == 1:
+            parents.append(level[-1])
+        level = parents
+    return binascii.hexlify(level[0])
+
+
+def _leaf_digest_(args):
+    mm, offset, size, method = args
+    digester = get_digester(method)
+    # `buffer` avoids copying the leaf out of the map; the digester releases
+    # the GIL while it hashes it.
+    digester.update(buffer(mm, offset, size))
+    return digester.digest()
+
+
+def generate_tree_checksum(f, method, leaf_size=None, workers=None):
+    """
+    Produce a tree hash (cf. `TreeDigester`) of an entire file, hashing its
+    leaves (of `TREE_LEAF_SIZE` bytes, by default) concurrently on `workers`
+    threads (by default, one per CPU).  Returns the digest as a hex-encoded
+    string.
+    """
+    leaf_method = TREE_METHODS[method]
+    if leaf_size is None:
+        leaf_size = TREE_LEAF_SIZE
+    size = os.path.getsize(f)
+    if size == 0:
+        return merkle_root([], leaf_method)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    with open(f, 'rb') as fh:
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            leaves = [(mm, offset, min(leaf_size, size - offset), leaf_method)
+                      for offset in range(0, size, leaf_size)]
+            if workers > 1 and len(leaves) > 1:
+                pool = ThreadPool(min(workers, len(leaves)))
+                try:
+                    digests = pool.map(_leaf_digest_, leaves)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                digests = map(_leaf_digest_, leaves)
+        finally:
+            mm.close()
+    return merkle_root(digests, leaf_method)
+
+
 def generate_checksum(f, method):
     """
     A convenience function to produce a checksum for an entire file.
     Returns the digest as a hex-encoded string.
     """
+    if method in TREE_METHODS:
+        return generate_tree_checksum(f, method)
     digester = get_digester(method)
     file.FileProcessor(f, lambda data: digester.update(data)).process()
     return digester.hexdigest()
@@ -63,3 +237,30 @@ def validate_checksum(f, method, received):
     computed = generate_checksum(f, method)
     if computed != received:
         raise ChecksumMismatch(f, method, received, computed)
+
+
+def sidecar_path(f):
+    return '.'.join([f, SIDECAR_EXT])
+
+
+def write_sidecar(f, method, value, **kw):
+    """
+    Record the checksum of `f` (and anything else in `kw`) alongside it.
+    """
+    sidecar = dict(kw)
+    sidecar.update({'method': method, 'value': value})
+    with open(sidecar_path(f), 'w') as cf:
+        json.dump(sidecar, cf)
+
+
+def read_sidecar(f):
+    """
+    Returns the checksum method and value recorded alongside `f`, or `None` if
+    there is no record.
+    """
+    try:
+        with open(sidecar_path(f), 'r') as cf:
+            sidecar = json.load(cf)
+    except IOError:
+        return None
+    return (sidecar['method'], sidecar['value'])
@@ -0,0 +1,85 @@
+"""
+Tuning of the database connections.
+
+The web app, the sweeper daemon and the cron jobs all share a single SQLite
+database.  With SQLite's default (rollback) journal, a writer excludes every
+reader, and a connection that finds the database locked fails at once.  Every
+new connection is therefore configured with the `SQLITE_PRAGMAS`: by default
+the write-ahead log, which lets readers and a writer proceed concurrently; a
+busy timeout, so that a connection waits for a lock rather than failing; and
+more generous caching.
+
+A transaction that reads before it writes may still find that another
+process has written in the meantime, which SQLite reports as the database
+being locked however long the timeout.  Such transactions must be retried;
+cf. `retry_on_busy`.
+
+The app can also use PostgreSQL (cf. `SQLALCHEMY_DATABASE_URI`), which allows
+any number of concurrent writers.  Timestamps are stored with their timezone
+and are generated in SQL by `models.utcnow`.  PostgreSQL sessions are set to UTC, so
+that the naive UTC timestamps that the app passes to the database are
+interpreted as such.
+"""
+
+import random
+import sqlite3
+import time
+
+from sqlalchemy        import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc    import OperationalError
+
+from app import app
+
+
+def apply_pragmas(dbapi_connection, pragmas):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in pragmas:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+    finally:
+        cursor.close()
+
+
+@event.listens_for(Engine, 'connect')
+def configure_connection(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        apply_pragmas(dbapi_connection, app.config['SQLITE_PRAGMAS'])
+    elif type(dbapi_connection).__module__.startswith('psycopg2'):
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute("SET TIME ZONE 'UTC'")
+        finally:
+            cursor.close()
+        dbapi_connection.commit()
+
+
+def is_busy(e):
+    """
+    Returns true if `e`, an `OperationalError`, means that the database was
+    locked by another connection.
+    """
+    message = str(getattr(e, 'orig', e))
+    return 'database is locked' in message or 'database is busy' in message
+
+
+def retry_on_busy(f, retries=None, backoff=None, sleep=time.sleep):
+    """
+    Call `f` until it doesn't fail because the database is busy, up to
+    `retries` more times, waiting for a random period of up to `backoff`
+    seconds, doubled with each attempt, in between.  Returns the result of `f`.
+    """
+    if retries is None:
+        retries = app.config['DB_BUSY_RETRIES']
+    if backoff is None:
+        backoff = app.config['DB_BUSY_BACKOFF']
+    attempt = 0
+    while True:
+        try:
+            return f()
+        except OperationalError, e:
+            if attempt >= retries or not is_busy(e):
+                raise
+            app.logger.warning('Database busy (attempt %d of %d): %s', attempt + 1, retries + 1, e)
+            sleep(random.uniform(0, backoff * 2 ** attempt))
+            attempt += 1
@@ -0,0 +1,187 @@
+"""
+Serving archived files.
+
+Files are served with support for conditional and partial requests, so that
+clients can cache them, resume interrupted downloads and read parts of large
+files without fetching them whole.  A file's ETag is derived from the checksum
+that was verified when it was uploaded, and so is strong: it changes if, and
+only if, the contents of the file do.
+
+Where possible, the data are not copied through Python at all.  The serving of
+a file can be handed off to the web server in front of the app, with an
+`X-Sendfile` or `X-Accel-Redirect` header (cf. `OFFLOAD_HEADERS`); failing
+that, a whole file is given to the WSGI server's `wsgi.file_wrapper`, which
+servers generally implement with `sendfile`.  Only ranges of files are read in
+the app.
+"""
+
+import datetime
+import mimetypes
+import os
+import uuid
+
+from werkzeug.http     import http_date, is_resource_modified, parse_date, parse_range_header, \
+                              unquote_etag
+from werkzeug.wrappers import Response
+from werkzeug.wsgi     import wrap_file
+
+import http
+
+
+# The headers that hand the serving of a file off to the web server, by the
+# name of the offload method.
+OFFLOAD_HEADERS = {'x-sendfile'       : 'X-Sendfile',
+                   'x-accel-redirect' : 'X-Accel-Redirect'}
+
+
+def etag(method, value):
+    return '%s-%s' % (method, value)
+
+
+def byte_ranges(header, size):
+    """
+    Parse the `Range` header of a request for a file of `size` bytes.  Returns
+    a list of `(start, stop)` pairs, sorted, with overlapping and adjacent
+    ranges merged, or `None` if the header is absent or invalid (in which case
+    the whole file is to be sent).  The list is empty if none of the ranges can
+    be satisfied.
+    """
+    r = parse_range_header(header)
+    if r is None or r.units != 'bytes':
+        return None
+    ranges = []
+    for start, stop in r.ranges:
+        if start < 0:
+            start, stop = max(size + start, 0), size
+        elif stop is None or stop > size:
+            stop = size
+        if start < stop:
+            ranges.append((start, stop))
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(stop, merged[-1][1]))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def _range_applies_(environ, tag, mtime):
+    """
+    A range is only sent if the file hasn't changed since the client fetched
+    the rest of it, as identified by `If-Range`.
+    """
+    if_range = environ.get('HTTP_IF_RANGE')
+    if if_range is None:
+        return True
+    if tag is not None:
+        value, weak = unquote_etag(if_range)
+        if not weak and value == tag:
+            return True
+    date = parse_date(if_range)
+    return date == mtime
+
+
+def _read_range_(path, start, stop, blocksize):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            data = f.read(min(blocksize, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+
+def _multipart_(read_range, ranges, size, mimetype, boundary):
+    """
+    Returns the body of a `multipart/byteranges` response, and its length.
+    """
+    parts = [('\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n'
+              % (boundary, mimetype, start, stop - 1, size), start, stop)
+             for start, stop in ranges]
+    trailer = '\r\n--%s--\r\n' % boundary
+    def body():
+        for header, start, stop in parts:
+            yield header
+            for data in read_range(start, stop):
+                yield data
+        yield trailer
+    return body(), sum(len(h) + stop - start for h, start, stop in parts) + len(trailer)
+
+
+def send_content(environ, size, mtime, tag, mimetype, read_range, whole=None, headers=None):
+    """
+    Returns a response that sends content of `size` bytes, last modified at
+    `mtime` (a `datetime`, in UTC) and with the (strong) ETag `tag`, if it's
+    known, to the client making the request described by `environ`, honouring
+    its conditional and range headers.
+
+    `read_range(start, stop)` returns an iterable over the bytes of the content
+    in that range, and `whole()` one over the whole content, if that can be
+    done more efficiently.  Any further `headers` are added to the response.
+    """
+    headers = dict(headers or {})
+    headers['Accept-Ranges'] = 'bytes'
+    headers['Last-Modified'] = http_date(mtime)
+    if tag is not None:
+        headers['ETag'] = '"%s"' % tag
+
+    if not is_resource_modified(environ, etag=tag, last_modified=mtime):
+        return Response(status=http.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    ranges = None
+    if _range_applies_(environ, tag, mtime):
+        ranges = byte_ranges(environ.get('HTTP_RANGE'), size)
+
+    head = environ['REQUEST_METHOD'] == 'HEAD'
+    if ranges is None:
+        status = http.HTTP_200_OK
+        length = size
+        body   = [] if head else (whole or (lambda: read_range(0, size)))()
+    elif len(ranges) == 0:
+        headers['Content-Range'] = 'bytes */%d' % size
+        return Response(status=http.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE, headers=headers)
+    elif len(ranges) == 1:
+        start, stop = ranges[0]
+        status = http.HTTP_206_PARTIAL_CONTENT
+        length = stop - start
+        body   = [] if head else read_range(start, stop)
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, size)
+    else:
+        boundary = uuid.uuid4().hex
+        status = http.HTTP_206_PARTIAL_CONTENT
+        body, length = _multipart_(read_range, ranges, size, mimetype, boundary)
+        if head:
+            body = []
+        mimetype = 'multipart/byteranges; boundary=%s' % boundary
+
+    headers['Content-Length'] = str(length)
+    return Response(body, status=status, headers=headers, content_type=mimetype,
+                    direct_passthrough=True)
+
+
+def send_file(environ, path, tag=None, offload=None, offload_path=None, blocksize=1024*1024):
+    """
+    Returns a response that sends the file at `path`; cf. `send_content`.
+
+    If `offload` is one of the `OFFLOAD_HEADERS`, the web server is asked to
+    send the file at `offload_path`, and to deal with any range requested.
+    """
+    st = os.stat(path)
+    mtime = datetime.datetime.utcfromtimestamp(int(st.st_mtime))
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+    if offload is not None:
+        headers = {'Last-Modified' : http_date(mtime)}
+        if tag is not None:
+            headers['ETag'] = '"%s"' % tag
+        if not is_resource_modified(environ, etag=tag, last_modified=mtime):
+            return Response(status=http.HTTP_304_NOT_MODIFIED, headers=headers)
+        headers[OFFLOAD_HEADERS[offload]] = offload_path
+        return Response(headers=headers, content_type=mimetype)
+
+    return send_content(environ, st.st_size, mtime, tag, mimetype,
+                        lambda start, stop: _read_range_(path, start, stop, blocksize),
+                        lambda: wrap_file(environ, open(path, 'rb'), blocksize))
@@ -1,4 +1,8 @@
+import ctypes
+import ctypes.util
+import mmap
 import os
+import sys
 
 def exists(name):
     return os.access(name, os.F_OK)
@@ -35,17 +39,128 @@ def touch(name, dirmode=0777):
     os.makedirs(os.path.dirname(name), dirmode)
     open(name, 'wa').close()
 
+def tree_usage(root):
+    """
+    Returns the space used by the files under `root`, in bytes, and the time at
+    which `root` or anything under it was last modified.  The space is that
+    which is actually allocated, which may be less than the size of a sparse
+    file.
+    """
+    st = os.lstat(root)
+    nbytes = 0
+    mtime  = st.st_mtime
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            try:
+                st = os.lstat(os.path.join(dirpath, name))
+            except OSError:
+                # Removed while we were looking.
+                continue
+            nbytes += getattr(st, 'st_blocks', st.st_size // 512) * 512
+            mtime   = max(mtime, st.st_mtime)
+    return nbytes, mtime
+
+def _load_posix_fadvise_():
+    """
+    Python 3 provides `os.posix_fadvise`; on Python 2 we call the C library
+    function directly.  Returns `None` if it is not available.
+    """
+    fadvise = getattr(os, 'posix_fadvise', None)
+    if fadvise is not None or not sys.platform.startswith('linux'):
+        return fadvise
+    try:
+        libc_fadvise = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).posix_fadvise64
+    except (OSError, AttributeError):
+        return None
+    libc_fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+    libc_fadvise.restype  = ctypes.c_int
+    def fadvise(fd, offset, length, advice):
+        # Unusually, the error number is the return value.
+        e = libc_fadvise(fd, offset, length, advice)
+        if e != 0:
+            raise OSError(e, os.strerror(e))
+    return fadvise
+
+
+_posix_fadvise_ = _load_posix_fadvise_()
+POSIX_FADV_SEQUENTIAL = getattr(os, 'POSIX_FADV_SEQUENTIAL', 2)
+
+
 class FileProcessor(object):
-    DEFAULT_READ_BLOCKSIZE = 65536
+    """
+    Feeds the contents of a file (or of `length` bytes of it, from `offset`)
+    to `fn`, a block at a time.  To avoid allocating a new string for every
+    block, the blocks are read-only views of memory that is reused for the
+    next block: `fn` must have finished with each block (e.g. hashed it or
+    written it) when it returns, and must not keep it.
+
+    In the `READ` mode, the file is read into a single, preallocated, buffer;
+    in the `MMAP` mode, it's mapped into memory and the blocks are slices of
+    the map, so that the data are never copied out of the page cache.  Either
+    way, the kernel is told that the file will be read sequentially, so that
+    it can read ahead aggressively.
+
+    The block size and mode default to those set by `configure`.
+    """
+    READ = 'read'
+    MMAP = 'mmap'
 
-    def __init__(self, fpath, fn, read_blocksize=DEFAULT_READ_BLOCKSIZE):
-        self.fpath = fpath
-        self.fn = fn
-        self.blocksize = read_blocksize
+    DEFAULT_READ_BLOCKSIZE = 1024 * 1024
+
+    read_blocksize = DEFAULT_READ_BLOCKSIZE
+    read_mode      = READ
+
+    @classmethod
+    def configure(cls, read_blocksize, read_mode):
+        if read_mode not in (cls.READ, cls.MMAP):
+            raise ValueError('Unknown FileProcessor mode: %s' % read_mode)
+        cls.read_blocksize = read_blocksize
+        cls.read_mode      = read_mode
+
+    def __init__(self, fpath, fn, read_blocksize=None, mode=None, offset=0, length=None):
+        self.fpath     = fpath
+        self.fn        = fn
+        self.blocksize = read_blocksize or self.read_blocksize
+        self.mode      = mode or self.read_mode
+        self.offset    = offset
+        self.length    = length
+
+    def _advise_(self, f, length):
+        if _posix_fadvise_ is not None:
+            try:
+                _posix_fadvise_(f.fileno(), self.offset, length, POSIX_FADV_SEQUENTIAL)
+            except OSError:
+                # It's only a hint.
+                pass
 
     def process(self):
-        with open(self.fpath, 'r') as f:
-            buf = f.read(self.blocksize)
-            while len(buf) > 0:
-                self.fn(buf)
-                buf = f.read(self.blocksize)
+        with open(self.fpath, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            end  = size if self.length is None else min(size, self.offset + self.length)
+            if end <= self.offset:
+                return
+            self._advise_(f, end - self.offset)
+            if self.mode == self.MMAP:
+                self._process_mmap_(f, end)
+            else:
+                self._process_read_(f, end)
+
+    def _process_read_(self, f, end):
+        buf  = bytearray(self.blocksize)
+        view = memoryview(buf)
+        f.seek(self.offset)
+        remaining = end - self.offset
+        while remaining > 0:
+            n = f.readinto(view[:min(self.blocksize, remaining)])
+            if n == 0:
+                break
+            self.fn(buffer(buf, 0, n))
+            remaining -= n
+
+    def _process_mmap_(self, f, end):
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for offset in xrange(self.offset, end, self.blocksize):
+                self.fn(buffer(mm, offset, min(self.blocksize, end - offset)))
+        finally:
+            mm.close()
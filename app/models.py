@@ -1,32 +1,66 @@
 
+import collections
+import datetime
 import enum
 import hashids
 import json
 import os
 import re
+import stat
 import string
+import time
 
 from flask                     import abort
 from sqlalchemy                import Enum, ForeignKey, Column, String, TIMESTAMP, Text, Integer
-from sqlalchemy                import event
-from sqlalchemy.exc            import OperationalError, IntegrityError
+from sqlalchemy                import BigInteger, Index, bindparam, case
+from sqlalchemy                import event, or_, text
+from sqlalchemy.exc            import OperationalError, IntegrityError, ProgrammingError
+from sqlalchemy.ext.compiler   import compiles
 from sqlalchemy.ext.hybrid     import hybrid_property
-from sqlalchemy.orm            import Session
-from sqlalchemy.orm            import relationship
+from sqlalchemy.orm            import Session, scoped_session
+from sqlalchemy.orm            import joinedload, relationship
 from sqlalchemy.orm.attributes import InstrumentedAttribute
 from sqlalchemy.orm.exc        import NoResultFound, MultipleResultsFound
+from sqlalchemy.sql            import expression
 from sqlalchemy.sql.expression import func
 from urllib                    import quote
 
+import database
+import file
 import http
 
 from app import app, db
 
 
+# The errors with which SQLite and PostgreSQL, respectively, report a query of a
+# table that doesn't exist.
+MISSING_TABLE_ERRORS = (OperationalError, ProgrammingError)
+
+
 BAD_URI_PAT  = re.compile("%.{2}|\/|_")
 COLLAPSE_PAT = re.compile("-{2,}")
 
 
+class utcnow(expression.FunctionElement):
+    """
+    The current time, in UTC.
+    """
+    type = TIMESTAMP(timezone=True)
+    name = 'utcnow'
+
+
+@compiles(utcnow)
+def _compile_utcnow_(element, compiler, **kw):
+    # SQLite's `CURRENT_TIMESTAMP` is in UTC, and PostgreSQL's includes its
+    # timezone.
+    return 'CURRENT_TIMESTAMP'
+
+
+@compiles(utcnow, 'mysql')
+def _compile_utcnow_mysql_(element, compiler, **kw):
+    return 'UTC_TIMESTAMP()'
+
+
 @event.listens_for(Session, 'after_flush_postexec')
 def inject_obfuscated_id_after_flush_postexec(session, flush_context):
     def inject_obfuscated_id(m):
@@ -42,14 +76,46 @@ def with_transaction(session, f):
     transaction is committed, otherwise an error is raised and the transaction
     is rolled back.
 
-    `f` must accept a single argument: the database session instance.
+    If the database is locked by another process, the whole transaction is
+    retried (cf. `database.retry_on_busy`), unless it's nested in another, in
+    which case only the outermost can be.
+
+    `f` must accept a single argument: the database session instance.  As it
+    may be called more than once, it must make all of the changes to be
+    committed itself: the rollback before a retry expires any changes that
+    were made to the objects in the session beforehand.
+    """
+    def attempt():
+        try:
+            f(session)
+            session.commit()
+        except Exception, e:
+            session.rollback()
+            raise e
+    transaction = (session() if isinstance(session, scoped_session) else session).transaction
+    # SQLAlchemy only made the parent of a transaction public in 1.4.
+    if getattr(transaction, 'parent', getattr(transaction, '_parent', None)) is not None:
+        attempt()
+    else:
+        database.retry_on_busy(attempt)
+
+
+def sweeper_wakeup_path():
+    return os.path.join(app.config['UPLOAD_PATH'], app.config['SWEEPER_WAKEUP_NAME'])
+
+
+def notify_sweepers():
+    """
+    Wake the sweeper daemon, if it's running, by touching its wakeup file.
+    Failing to do so is not an error; the daemon will still find the work when
+    it next polls.
     """
+    path = sweeper_wakeup_path()
     try:
-        f(session)
-        session.commit()
-    except Exception, e:
-        session.rollback()
-        raise e
+        with open(path, 'a'):
+            os.utime(path, None)
+    except (IOError, OSError), e:
+        app.logger.warning('Unable to notify sweepers: %s', e)
 
 
 class HashIds(hashids.Hashids):
@@ -126,6 +192,25 @@ def get_resource(q, abort_not_found=True):
         return r
 
 
+def paginate(q, model, after=None, limit=None):
+    """
+    Restrict the query `q` to a page of resources of type `model`, using the
+    primary key as the key for keyset pagination: the page contains at most
+    `limit` resources, in order, starting with the one that follows the
+    resource whose obfuscated ID is `after`.  Unlike `OFFSET`-based
+    pagination, the cost of retrieving a page doesn't depend on how far into
+    the collection it is.
+
+    Signals a 400 if `after` is not a valid ID for `model`.
+    """
+    if after is not None:
+        decoded = model.__hashidgen__.decode(after)
+        if len(decoded) != 1:
+            abort(http.HTTP_400_BAD_REQUEST)
+        q = q.filter(model.id > decoded[0])
+    return q.order_by(model.id).limit(limit)
+
+
 class Project(db.Model):
     __metaclass__ = ResourceMetaClass
     __tablename__ = 'project'
@@ -167,7 +252,9 @@ def add_project(name, sample_mask):
     """
     try:
         _ = Project.query.first()
-    except OperationalError:
+    except MISSING_TABLE_ERRORS:
+        # PostgreSQL won't continue a transaction after an error.
+        db.session.rollback()
         db.create_all()
     p = Project(name=name, sample_mask=sample_mask)
     with_transaction(db.session, lambda session: session.add(p))
@@ -180,7 +267,7 @@ class Sample(db.Model):
     __hashidgen__ = HashIds('Sample')
 
     name = Column(String(80), unique=True)
-    _created_ts = Column("created_ts", TIMESTAMP, server_default=func.now())
+    _created_ts = Column("created_ts", TIMESTAMP(timezone=True), server_default=utcnow())
     # to what project does this sample belong
     _project_id = Column('project_id', Integer, ForeignKey('project.id'))
 
@@ -188,6 +275,9 @@ class Sample(db.Model):
     sample_stages = relationship(
         'SampleStage', backref='sample', lazy='dynamic')
 
+    # The samples of a project are listed in order of ID.
+    __table_args__ = (Index('ix_sample_project_id_id', 'project_id', 'id'),)
+
     @property
     def project_id(self):
         return self.project.obfuscated_id
@@ -199,12 +289,16 @@ def get_sample(sample_filters, abort_not_found=True):
         abort_not_found=abort_not_found)
 
 
-def get_samples(**project_filters):
+def get_samples(after=None, limit=None, **project_filters):
     """
     Returns a list of dicts where each represents summary data of a sample.
+    The results may be paginated using `after` and `limit`; cf. `paginate`.
     """
     p = get_project(**project_filters)
-    return Sample.query.filter_by(_project_id=p.id).all()
+    return paginate(Sample.query
+                          .options(joinedload('project'))
+                          .filter_by(_project_id=p.id),
+                    Sample, after, limit).all()
 
 
 def get_project_sample(project_filters, sample_filters, abort_not_found=True):
@@ -251,7 +345,8 @@ def get_methods():
     """
     try:
         methods = Method.query.all()
-    except OperationalError:
+    except MISSING_TABLE_ERRORS:
+        db.session.rollback()
         return ''
     return methods
 
@@ -264,7 +359,9 @@ def add_method(name, description):
     """Adds a new method."""
     try:
         _ = Method.query.first()
-    except OperationalError:
+    except MISSING_TABLE_ERRORS:
+        # PostgreSQL won't continue a transaction after an error.
+        db.session.rollback()
         db.create_all()
     m = Method(name=name, description=description)
     with_transaction(db.session, lambda session: session.add(m))
@@ -276,7 +373,7 @@ class SampleStage(db.Model):
     __tablename__ = 'sample_stage'
     __hashidgen__ = HashIds('SampleStage')
 
-    _created_ts = Column("created_ts", TIMESTAMP, server_default=func.now())
+    _created_ts = Column("created_ts", TIMESTAMP(timezone=True), server_default=utcnow())
     annotation = Column(Text, unique=False)
     alt_id = Column(Integer, unique=False)
     # relationships
@@ -286,6 +383,10 @@ class SampleStage(db.Model):
     sample_stage_files = relationship(
         'SampleStageFile', backref='sample_stage', lazy='dynamic')
 
+    # The stages of a sample are a sequence, in order of ID.
+    __table_args__ = (Index('ix_sample_stage_sample_id_id', 'sample_id', 'id'),
+                      Index('ix_sample_stage_method_id', 'method_id'))
+
     @property
     def sample_id(self):
         return self.sample.obfuscated_id
@@ -299,33 +400,60 @@ def _sample_stage_token_hashid():
     return hashids.Hashids(salt='SampleStageToken', min_length=5)
 
 
-def get_sample_stages(sample_id):
+def get_sample_stages(sample_id, after=None, limit=None):
     """
-    Returns stages for the designated sample.
+    Returns stages for the designated sample, and the token required to add
+    the next stage.  The stages may be paginated using `after` and `limit`;
+    cf. `paginate`.
     """
     s = get_resource(Sample.query.filter_by(obfuscated_id=sample_id))
     # The order of the stages is significant, since they represent a sequence
-    # of events for a sample.  Results should naturally be ordered by the
-    # primary key, but it doesn't hurt to make sure.
-    stages = SampleStage\
-             .query\
-             .filter_by(_sample_id=s.id)\
-             .order_by(SampleStage.id)\
-             .all()
+    # of events for a sample.  Pagination orders them by the primary key.
+    stages = paginate(SampleStage.query
+                                 .options(joinedload('sample'),
+                                          joinedload('method'))
+                                 .filter_by(_sample_id=s.id),
+                      SampleStage, after, limit).all()
+    # The token is derived from the last stage of the sample, which is not
+    # necessarily the last stage on this page.
+    last_stage = SampleStage\
+                 .query\
+                 .filter_by(_sample_id=s.id)\
+                 .order_by(SampleStage.id.desc())\
+                 .first()
     hashid = _sample_stage_token_hashid()
-    if len(stages) == 0:
+    if last_stage is None:
         token = hashid.encode(0)
     else:
-        token = hashid.encode(stages[-1].id)
+        token = hashid.encode(last_stage.id)
     return stages, token
 
 
+def count_sample_stages_before(sample_id, after):
+    """
+    Returns the number of stages of the designated sample up to and including
+    the one whose obfuscated ID is `after`; i.e. the ordinal position of the
+    last stage on the preceding page.
+    """
+    if after is None:
+        return 0
+    s = get_resource(Sample.query.filter_by(obfuscated_id=sample_id))
+    decoded = SampleStage.__hashidgen__.decode(after)
+    if len(decoded) != 1:
+        abort(http.HTTP_400_BAD_REQUEST)
+    return SampleStage.query\
+                      .filter_by(_sample_id=s.id)\
+                      .filter(SampleStage.id <= decoded[0])\
+                      .count()
+
+
 def get_sample_stage(sample_id, stage_id):
     """
     Returns a particular stage for a particular sample.
     """
     s = get_resource(Sample.query.filter_by(obfuscated_id=sample_id))
-    return get_resource(SampleStage.query.filter_by(_sample_id=s.id))
+    return get_resource(
+        SampleStage.query.filter_by(_sample_id=s.id, obfuscated_id=stage_id))
 
 
 def add_sample_stage(sample_id, method_id, annotation, token, alt_id=None):
@@ -369,6 +497,148 @@ def add_sample_stage(sample_id, method_id, annotation, token, alt_id=None):
         return SampleStage.query.filter_by(id=ss.id).one()
 
 
+# ---------------------------------------------------------- sample search --- #
+#
+# Samples are searched by (case-insensitive) substrings of their names and of
+# the methods and annotations of their stages.  Where the store supports it,
+# this is backed by a full-text index with one row per sample, whose `rowid`
+# is the sample's ID.  The trigram tokenizer makes it possible to answer
+# substring queries from the index, but only for search tokens of at least
+# three characters.
+#
+# The methods and annotations of a sample's stages are joined with a separator
+# that can't be typed into a search, so that no match spans two of them.  The
+# index is kept up to date by triggers, which recompute the row of any sample
+# whose name, project or stages change, or which has a stage whose method is
+# renamed, whichever way the tables are written to.
+
+SEARCH_INDEX_MIN_TOKEN_LENGTH = 3
+
+SEARCH_INDEX_SEPARATOR = u'\x1f'
+
+SEARCH_INDEX_DDL = """
+CREATE VIRTUAL TABLE IF NOT EXISTS sample_search
+USING fts5(name, methods, annotations, project_id UNINDEXED, tokenize='trigram')
+"""
+
+SEARCH_INDEX_ROWS = """
+INSERT INTO sample_search(rowid, name, methods, annotations, project_id)
+SELECT sample.id,
+       sample.name,
+       coalesce(group_concat(method.name, char(31)), ''),
+       coalesce(group_concat(sample_stage.annotation, char(31)), ''),
+       sample.project_id
+FROM sample
+LEFT JOIN sample_stage ON sample_stage.sample_id = sample.id
+LEFT JOIN method ON method.id = sample_stage.method_id
+WHERE %s
+GROUP BY sample.id
+"""
+
+SEARCH_INDEX_POPULATE = SEARCH_INDEX_ROWS % '1'
+
+# The triggers that maintain the index, by name: the event that fires each,
+# and the IDs of the samples whose rows it recomputes.
+SEARCH_INDEX_TRIGGERS = [
+    ('sample_search_sample_insert', 'INSERT ON sample', 'new.id'),
+    ('sample_search_sample_update', 'UPDATE OF name, project_id ON sample', 'old.id, new.id'),
+    ('sample_search_sample_delete', 'DELETE ON sample', 'old.id'),
+    ('sample_search_stage_insert', 'INSERT ON sample_stage', 'new.sample_id'),
+    ('sample_search_stage_update', 'UPDATE OF sample_id, method_id, annotation ON sample_stage',
+     'old.sample_id, new.sample_id'),
+    ('sample_search_stage_delete', 'DELETE ON sample_stage', 'old.sample_id'),
+    ('sample_search_method_update', 'UPDATE OF name ON method',
+     'SELECT sample_id FROM sample_stage WHERE method_id = new.id')]
+
+
+def _search_index_trigger_ddl_(name, when, samples):
+    return 'CREATE TRIGGER IF NOT EXISTS %s AFTER %s BEGIN ' \
+           'DELETE FROM sample_search WHERE rowid IN (%s); %s; END' \
+           % (name, when, samples, SEARCH_INDEX_ROWS % ('sample.id IN (%s)' % samples))
+
+
+def _has_search_index_(connection):
+    return connection.dialect.name == 'sqlite' and \
+        connection.dialect.has_table(connection, 'sample_search')
+
+
+@event.listens_for(db.metadata, 'after_create')
+def create_search_index(target, connection, **kw):
+    if connection.dialect.name != 'sqlite':
+        return
+    try:
+        connection.execute(SEARCH_INDEX_DDL)
+    except OperationalError, e:
+        app.logger.warning('Unable to create the sample search index; searches will scan: %s', e)
+        return
+    for trigger in SEARCH_INDEX_TRIGGERS:
+        connection.execute(_search_index_trigger_ddl_(*trigger))
+
+
+def rebuild_search_index():
+    """
+    (Re)populate the search index from the samples and their stages.
+    """
+    def rebuild(session):
+        session.execute('DELETE FROM sample_search')
+        session.execute(SEARCH_INDEX_POPULATE)
+    with_transaction(db.session, rebuild)
+
+
+def search_samples(project_id, tokens):
+    """
+    Find the IDs of the samples in the project with the (database) ID
+    `project_id` that match the search `tokens`, using the search index.  A
+    token matches a sample if it's a substring of the sample's name, or of the
+    method or annotation of one of its stages.  Tokens that match no sample
+    are ignored, and the result is the set of samples that match all of the
+    others.
+
+    Returns `None` if the search can't be answered from the index, in which
+    case the caller must fall back to scanning the tables.
+    """
+    tokens = filter(lambda t: len(t) > 0, tokens)
+    if len(tokens) == 0 or \
+       any(len(t) < SEARCH_INDEX_MIN_TOKEN_LENGTH or SEARCH_INDEX_SEPARATOR in t
+           for t in tokens):
+        return None
+    if not _has_search_index_(db.session.connection()):
+        return None
+
+    # Fetch every sample that matches any of the tokens in a single indexed
+    # query, and then work out which tokens each of them matched, so that we
+    # can discard the tokens that matched nothing.
+    query = ' OR '.join('"%s"' % t.replace('"', '""') for t in tokens)
+    rows = db.session.execute(
+        text('SELECT rowid, name, methods, annotations FROM sample_search '
+             'WHERE sample_search MATCH :query AND project_id = :project_id'),
+        {'query': query, 'project_id': project_id}).fetchall()
+    matches = []
+    for token in map(lambda t: t.lower(), tokens):
+        matched = set(row[0] for row in rows
+                      if any(token in (col or '').lower() for col in row[1:]))
+        if len(matched) > 0:
+            matches.append(matched)
+    if len(matches) == 0:
+        return []
+    return sorted(reduce(lambda intersection, s: intersection & s, matches))
+
+
+def get_samples_by_id(ids, chunk_size=500):
+    """
+    Retrieve the samples with the given (database) IDs, with their projects,
+    in as few queries as the store's limit on bound parameters permits.
+    """
+    samples = []
+    for i in range(0, len(ids), chunk_size):
+        samples += Sample.query\
+                         .options(joinedload('project'))\
+                         .filter(Sample.id.in_(ids[i:i+chunk_size]))\
+                         .order_by(Sample.id)\
+                         .all()
+    return samples
+
+
 class FileStatus(enum.Enum):
     prepared = 'prepared' # An upload directory and ID has been allocated for
                           # the file
@@ -389,20 +659,37 @@ class SampleStageFile(db.Model):
 
     relative_source_path = Column(Text, unique=True)
     relative_target_path = Column(Text, unique=True)
-    _status = Column('status', Enum(*FileStatus.__members__.keys()))
-    # PORTABILITY WARNING: SQLite renders `now` in UTC, which is what we want.
-    # This behaviour may not be true for all stores and so may need custom type
-    # handling to ensure that timestamps are consistently handled in UTC.
-    _created_ts = Column('created_ts', TIMESTAMP, server_default=func.now())
+    _status = Column('status', Enum(*FileStatus.__members__.keys(), name='file_status'))
+    # Timestamps are in UTC, whatever the store; cf. `utcnow`.
+    _created_ts = Column('created_ts', TIMESTAMP(timezone=True), server_default=utcnow())
     modified_ts = Column(
-        TIMESTAMP,
-        server_default=func.now(),
-        onupdate=func.current_timestamp())
+        TIMESTAMP(timezone=True),
+        server_default=utcnow(),
+        onupdate=utcnow())
+
+    # Sweepers claim files for a limited period (a lease) so that more than one
+    # of them may run at a time without processing the same file twice.
+    claimed_by    = Column(String(64))
+    claimed_until = Column(TIMESTAMP(timezone=True))
+
+    # The checksum of the archived file, as verified when it was archived.
+    checksum_method = Column(String(32))
+    checksum_value  = Column(String(128))
+
+    # When the archived file was last checked against its checksum (cf.
+    # `sweepers.ArchiveScrubber`), and what was wrong with it, if anything.
+    verified_ts  = Column(TIMESTAMP(timezone=True))
+    verify_error = Column(Text)
 
     # relationships
     _sample_stage_id = Column(
         'sample_stage_id', Integer, ForeignKey('sample_stage.id'))
 
+    # The files of a stage are listed in order of ID, and the sweepers' queues
+    # are of files with a given status.
+    __table_args__ = (Index('ix_sample_stage_file_sample_stage_id_id', 'sample_stage_id', 'id'),
+                      Index('ix_sample_stage_file_status_modified_ts', 'status', 'modified_ts'))
+
     @property
     def sample_stage_id(self):
         return self.sample_stage.obfuscated_id
@@ -459,14 +746,19 @@ class SampleStageFile(db.Model):
                    stat=self.status)
 
     def mark_archived(self):
-        self.status = FileStatus.archived
-        return with_transaction(db.session, lambda session: session.add(self))
+        def archive(session):
+            self.status = FileStatus.archived
+            session.add(self)
+        with_transaction(db.session, archive)
+        notify_sweepers()
 
     def mark_cleaned(self):
         # Today, cleaning is the last step in the proces, so we jump straight
         # to `complete`.
-        self.status = FileStatus.complete
-        return with_transaction(db.session, lambda session: session.add(self))
+        def clean(session):
+            self.status = FileStatus.complete
+            session.add(self)
+        return with_transaction(db.session, clean)
 
 def inject_filename_counter(fname, counterval, maxextlen=6):
     """
@@ -503,20 +795,30 @@ def create_archive_filename(root, pathels, fname):
             return (relpath, counter)
 
 
-def get_files(sample_stage_id=None, status=FileStatus.complete):
+def _stage_file_parents_():
+    return joinedload('sample_stage')\
+        .joinedload('sample')\
+        .joinedload('project')
+
+
+def get_files(sample_stage_id=None, status=FileStatus.complete, after=None, limit=None):
 
     """
     Returns a list of dicts where each represents a file that belongs to a
-    sample stage.
+    sample stage.  The results may be paginated using `after` and `limit`;
+    cf. `paginate`.
     """
-    stage_file_q = SampleStageFile.query
+    # The sample stage, sample and project are needed to represent a file, so
+    # load them in the same query rather than lazily, one file at a time.
+    stage_file_q = SampleStageFile.query.options(_stage_file_parents_())
     filters = {}
     if sample_stage_id is not None:
         sample_stage = get_resource(SampleStage.query.filter_by(obfuscated_id=sample_stage_id))
         filters['_sample_stage_id'] = sample_stage.id
     if status is not None:
         filters['status'] = status.value
-    return stage_file_q.filter_by(**filters).all()
+    return paginate(stage_file_q.filter_by(**filters),
+                    SampleStageFile, after, limit).all()
 
 
 def add_file(source_fname, sample_stage_id):
@@ -530,5 +832,368 @@ def add_file(source_fname, sample_stage_id):
     # completion of this process to a sweeper.
     ssf = SampleStageFile(source_fname, ss, status=FileStatus.staged)
     with_transaction(db.session, lambda session: session.add(ssf))
+    notify_sweepers()
 
     return get_resource(SampleStageFile.query.filter_by(id=ssf.id))
+
+
+def _claimable_files_(status, now, limit):
+    """
+    Returns a query for the IDs of up to `limit` files with the given `status`
+    that aren't claimed at time `now`.  On PostgreSQL, the rows are locked, and
+    rows that are already locked by another claimant are skipped, so that
+    concurrent claims can neither overwrite nor wait for each other.  (SQLite
+    only has one writer at a time.)
+    """
+    return db.session.query(SampleStageFile.id)\
+                     .filter(SampleStageFile.status == status.value)\
+                     .filter(or_(SampleStageFile.claimed_until == None,
+                                 SampleStageFile.claimed_until < now))\
+                     .order_by(SampleStageFile.id)\
+                     .limit(limit)\
+                     .statement\
+                     .suffix_with('FOR UPDATE SKIP LOCKED', dialect='postgresql')
+
+
+def claim_files(status, owner, lease, limit=None):
+    """
+    Claim up to `limit` files with the given `status` on behalf of `owner` for
+    `lease` seconds, and return them.  Files that are claimed by someone else
+    are skipped unless their lease has expired.  The claim is made in a single
+    statement, so concurrent claimants never receive the same file.
+    """
+    now = datetime.datetime.utcnow()
+    claimed_until = now + datetime.timedelta(seconds=lease)
+    claimable = _claimable_files_(status, now, limit)
+    def claim(session):
+        session.query(SampleStageFile)\
+               .filter(SampleStageFile.id.in_(claimable))\
+               .update({SampleStageFile.claimed_by   : owner,
+                        SampleStageFile.claimed_until: claimed_until},
+                       synchronize_session=False)
+    with_transaction(db.session, claim)
+    return SampleStageFile.query\
+                          .options(_stage_file_parents_())\
+                          .filter_by(claimed_by=owner, claimed_until=claimed_until)\
+                          .filter(SampleStageFile.status == status.value)\
+                          .order_by(SampleStageFile.id)\
+                          .all()
+
+
+def transition_files(files, status, checksums=None):
+    """
+    Move all of `files` to `status` and release any claims on them, in a
+    single statement and transaction.  `checksums` may map the IDs of some of
+    the files to the (method, value) of their verified checksums, which are
+    recorded in the same transaction.
+    """
+    if len(files) == 0:
+        return
+    ids = [f.id for f in files]
+    def transition(session):
+        session.query(SampleStageFile)\
+               .filter(SampleStageFile.id.in_(ids))\
+               .update({SampleStageFile._status      : status.value,
+                        SampleStageFile.claimed_by   : None,
+                        SampleStageFile.claimed_until: None},
+                       synchronize_session=False)
+        if checksums:
+            table = SampleStageFile.__table__
+            session.execute(
+                table.update()
+                     .where(table.c.id == bindparam('_id'))
+                     .values(checksum_method=bindparam('_method'),
+                             checksum_value=bindparam('_value')),
+                [{'_id': i, '_method': m, '_value': v}
+                 for i, (m, v) in checksums.iteritems()])
+    with_transaction(db.session, transition)
+    if status == FileStatus.archived:
+        notify_sweepers()
+
+
+ARCHIVED_STATUSES = [FileStatus.archived, FileStatus.cleaned, FileStatus.complete]
+
+
+def get_archived_file(relative_target_path):
+    """
+    Returns the archived file at `relative_target_path` in the store, aborting
+    with a 404 if there is no such file.
+    """
+    return get_resource(
+        SampleStageFile.query
+                       .filter(SampleStageFile.relative_target_path == relative_target_path)
+                       .filter(SampleStageFile.status.in_([s.value for s in ARCHIVED_STATUSES])))
+
+
+def get_archived_files(sample_id, sample_stage_id=None):
+    """
+    Returns the archived files of a sample, or of one of its stages, in order
+    of ID.
+    """
+    s = get_resource(Sample.query.filter_by(obfuscated_id=sample_id))
+    q = SampleStageFile.query\
+                       .join(SampleStage)\
+                       .filter(SampleStage._sample_id == s.id)\
+                       .filter(SampleStageFile.status.in_([st.value for st in ARCHIVED_STATUSES]))
+    if sample_stage_id is not None:
+        q = q.filter(SampleStage.obfuscated_id == sample_stage_id)
+    return q.order_by(SampleStageFile.id).all()
+
+
+def get_files_to_verify(after_id=None, limit=None):
+    """
+    Returns the archived files with checksums, in order of ID, starting after
+    the file with the (database) ID `after_id`.
+    """
+    q = SampleStageFile.query\
+                       .filter(SampleStageFile.status.in_([s.value for s in ARCHIVED_STATUSES]))\
+                       .filter(SampleStageFile.checksum_value != None)
+    if after_id is not None:
+        q = q.filter(SampleStageFile.id > after_id)
+    return q.order_by(SampleStageFile.id).limit(limit).all()
+
+
+def record_verification(file_id, error=None):
+    """
+    Record that the file with the (database) ID `file_id` has just been
+    checked against its checksum, with the `error` that was found, if any.
+    """
+    def record(session):
+        session.query(SampleStageFile)\
+               .filter(SampleStageFile.id == file_id)\
+               .update({SampleStageFile.verified_ts : datetime.datetime.utcnow(),
+                        SampleStageFile.verify_error: error},
+                       synchronize_session=False)
+    with_transaction(db.session, record)
+
+
+class UploadSession(db.Model):
+    """
+    An upload that has been prepared by a client: the file that is expected,
+    and the parts of it that have been received so far.
+    """
+    __metaclass__ = ResourceMetaClass
+    __tablename__ = 'upload_session'
+    __hashidgen__ = HashIds('UploadSession')
+
+    # The client's name for the upload, which is also the name of its upload
+    # directory.
+    identifier = Column(String(255), unique=True)
+    total_size = Column(BigInteger)
+    chunk_size = Column(Integer)
+    total_parts = Column(Integer)
+    checksum_method = Column(String(32))
+    # One character per part, '1' if the part has been received and '0'
+    # otherwise, so that a part can be recorded in a single (atomic) UPDATE.
+    received_parts = Column(Text)
+    received_count = Column(Integer)
+    _status = Column('status', Enum(*FileStatus.__members__.keys(), name='file_status'))
+    _created_ts = Column('created_ts', TIMESTAMP(timezone=True), server_default=utcnow())
+    modified_ts = Column(
+        TIMESTAMP(timezone=True),
+        server_default=utcnow(),
+        onupdate=utcnow())
+
+    # relationships
+    _sample_stage_id = Column(
+        'sample_stage_id', Integer, ForeignKey('sample_stage.id'))
+    sample_stage = relationship('SampleStage')
+
+    # Abandoned sessions are found by their status and age.
+    __table_args__ = (Index('ix_upload_session_status_modified_ts', 'status', 'modified_ts'),
+                      Index('ix_upload_session_sample_stage_id', 'sample_stage_id'))
+
+    @property
+    def sample_stage_id(self):
+        return self.sample_stage.obfuscated_id
+
+    @hybrid_property
+    def status(self):
+        return FileStatus(self._status)
+
+    @status.setter
+    def status(self, s):
+        self._status = s.value
+
+    @status.expression
+    def status(cls):
+        return cls._status
+
+    @property
+    def is_complete(self):
+        return self.received_count == self.total_parts
+
+    def has_part(self, part_number):
+        return self.received_parts[part_number - 1] == '1'
+
+
+def get_upload_session(identifier):
+    """
+    Retrieve the session for the upload `identifier`, or `None` if the upload
+    was not prepared.
+    """
+    return UploadSession.query.filter_by(identifier=identifier).one_or_none()
+
+
+def add_upload_session(identifier, sample_stage_id, total_parts, chunk_size, total_size, checksum_method):
+    """
+    Record the preparation of an upload of a file into the sample stage.
+    """
+    ss = get_resource(SampleStage.query.filter_by(obfuscated_id=sample_stage_id))
+    us = UploadSession(identifier=identifier,
+                       sample_stage=ss,
+                       total_parts=int(total_parts),
+                       chunk_size=int(chunk_size),
+                       total_size=int(total_size),
+                       checksum_method=checksum_method,
+                       received_parts='0' * int(total_parts),
+                       received_count=0,
+                       status=FileStatus.prepared)
+    with_transaction(db.session, lambda session: session.add(us))
+    return us
+
+
+def record_upload_part(identifier, part_number):
+    """
+    Mark part `part_number` of the upload `identifier` as received.  The part
+    is recorded in a single statement, so that parts that are received
+    concurrently are all recorded, and recording a part more than once is
+    harmless.
+    """
+    received = UploadSession.received_parts
+    def record(session):
+        session.query(UploadSession)\
+               .filter_by(identifier=identifier)\
+               .update({UploadSession.received_count:
+                            UploadSession.received_count +
+                            case([(func.substr(received, part_number, 1) == '0', 1)], else_=0),
+                        UploadSession.received_parts:
+                            func.substr(received, 1, part_number - 1, type_=Text) + '1' +
+                            func.substr(received, part_number + 1, type_=Text)},
+                       synchronize_session=False)
+    with_transaction(db.session, record)
+
+
+def complete_upload_session(identifier):
+    def complete(session):
+        session.query(UploadSession)\
+               .filter_by(identifier=identifier)\
+               .update({UploadSession._status: FileStatus.staged.value},
+                       synchronize_session=False)
+    with_transaction(db.session, complete)
+
+
+def get_stale_upload_sessions(age):
+    """
+    Returns the sessions of the uploads that were prepared but haven't
+    received a part for `age` seconds.
+    """
+    before = datetime.datetime.utcnow() - datetime.timedelta(seconds=age)
+    return UploadSession.query\
+                        .filter(UploadSession.status == FileStatus.prepared.value)\
+                        .filter(UploadSession.modified_ts < before)\
+                        .order_by(UploadSession.id)\
+                        .all()
+
+
+def remove_upload_sessions(identifiers):
+    """
+    Forget the prepared uploads `identifiers`, e.g. because they were
+    abandoned.  Sessions of uploads that have been completed are kept.
+    """
+    if len(identifiers) == 0:
+        return
+    def remove(session):
+        session.query(UploadSession)\
+               .filter(UploadSession.identifier.in_(identifiers))\
+               .filter(UploadSession.status == FileStatus.prepared.value)\
+               .delete(synchronize_session=False)
+    with_transaction(db.session, remove)
+
+
+UploadDir = collections.namedtuple('UploadDir', ['identifier', 'path', 'bytes', 'mtime'])
+
+
+def get_upload_dirs():
+    """
+    Returns an `UploadDir` for every upload directory in `UPLOAD_PATH`, with
+    the space that it uses and the time at which it was last modified.
+    """
+    upload_path = app.config['UPLOAD_PATH']
+    if not os.path.isdir(upload_path):
+        return []
+    upload_dirs = []
+    for name in sorted(os.listdir(upload_path)):
+        path = os.path.join(upload_path, name)
+        if not os.path.isdir(path):
+            # e.g. the sweepers' wakeup file
+            continue
+        try:
+            nbytes, mtime = file.tree_usage(path)
+        except OSError:
+            continue
+        upload_dirs.append(UploadDir(name, path, nbytes, mtime))
+    return upload_dirs
+
+
+def _pending_upload_dirs_():
+    # The upload directories of files that are still being moved into the
+    # archive.
+    return set(path.split(os.sep)[0] for (path,) in
+               db.session.query(SampleStageFile.relative_source_path)
+                         .filter(SampleStageFile.status != FileStatus.complete.value))
+
+
+def get_abandoned_upload_dirs(age, upload_dirs=None):
+    """
+    Returns the `UploadDir`s (of `upload_dirs`, or of all upload directories)
+    of uploads that haven't been touched for `age` seconds and were never
+    completed.  The directories of files that are still being moved into the
+    archive are never considered abandoned, however old they are.
+    """
+    if upload_dirs is None:
+        upload_dirs = get_upload_dirs()
+    before  = time.time() - age
+    pending = _pending_upload_dirs_()
+    return [d for d in upload_dirs if d.mtime < before and d.identifier not in pending]
+
+
+def get_abandoned_unprepared_upload_dirs(age, chunk_size=500):
+    """
+    Returns the `UploadDir`s of uploads that were never prepared (and so have
+    no session; cf. `get_stale_upload_sessions`), haven't been touched for
+    `age` seconds and were never completed.  Every part of such an upload is
+    saved as a file in its directory, and so the time at which the directory
+    itself was last modified is that of its last part: only the entries of
+    `UPLOAD_PATH` are looked at, and not what is in them, except to add up
+    the space used by the directories that are returned.
+    """
+    upload_path = app.config['UPLOAD_PATH']
+    if not os.path.isdir(upload_path):
+        return []
+    before = time.time() - age
+    stale  = []
+    for name in sorted(os.listdir(upload_path)):
+        try:
+            st = os.stat(os.path.join(upload_path, name))
+        except OSError:
+            continue
+        if stat.S_ISDIR(st.st_mode) and st.st_mtime < before:
+            stale.append(name)
+    excluded = _pending_upload_dirs_()
+    for i in range(0, len(stale), chunk_size):
+        excluded.update(identifier for (identifier,) in
+                        db.session.query(UploadSession.identifier)
+                                  .filter(UploadSession.identifier.in_(stale[i:i+chunk_size])))
+    upload_dirs = []
+    for name in stale:
+        if name in excluded:
+            continue
+        path = os.path.join(upload_path, name)
+        try:
+            nbytes, mtime = file.tree_usage(path)
+        except OSError:
+            continue
+        if mtime < before:
+            upload_dirs.append(UploadDir(name, path, nbytes, mtime))
+    return upload_dirs
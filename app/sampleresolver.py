@@ -1,92 +1,67 @@
-
 import threading
 
-from sqlalchemy.orm import aliased
+from multiprocessing.pool import ThreadPool
+
+from sqlalchemy.orm import aliased, Session
 
 import models
 import app    as sagittariidae
 
-class _HashableSample_(object):
-    """
-    A hashable wrapper for Samples.  Hashing on the instance value makes it
-    possible to exploit Python's `set` functions to ultimately find only those
-    Samples that match all of the specified search tokens.
 
-    Note that this hashing functionality is intentionally not folded into the
-    model.  As a resource, a Sample has neither an `id` nor an `obfuscated_id`
-    until it is written to the table.  Thus this mechanism for computing a hash
-    doesn't return a consistent value for an instance in all circumstances.
-
-    Therefore it is relegated to this wrapper where we can guarantee that the
-    Samples that we're working with will have these values defined.
+class _Resolver_(object):
+    """
+    Finds the IDs of the samples that match a search token in one particular
+    way.  Resolvers are run concurrently on a pool of threads, and since
+    neither SQLite connections nor the models that refer to them can be shared
+    between threads, each resolution uses a session (and connection) of its
+    own, and returns only sample IDs.  The request thread loads the samples
+    themselves once the results have been combined.
     """
 
-    def __init__(self, sample):
-        self.sample = sample
-
-    def __key__(self):
-        return (self.sample.id,
-                self.sample.obfuscated_id,
-                self.sample._project_id)
-
-    def __hash__(self):
-        return hash(self.__key__())
-
-    def __eq__(self, o):
-        return self.__key__() == o.__key__()
-
-    def __repr__(self):
-        return self.sample.__repr__()
-
-
-class _Resolver_(threading.Thread):
-
-    project = None
-    token   = None
-    results = None
-
-    def resolve(self):
+    def query(self, session, token, project_id):
+        """
+        Returns a query that yields the IDs of the matching samples.
+        """
         raise NotImplementedError()
 
-    def run(self):
-        self.results = set()
+    def resolve(self, engine, token, project_id):
+        session = Session(bind=engine)
         try:
-            for sample in self.resolve(self.token, self.project.id):
-                self.results.add(_HashableSample_(sample))
+            return set(row[0] for row in self.query(session, token, project_id))
         except Exception, e:
             sagittariidae.app.logger.error('Unhandled exception in Resolver %s', self, exc_info=e)
+            return set()
+        finally:
+            session.close()
 
 
 class _StageAnnotationResolver_(_Resolver_):
 
-    def resolve(self, token, project_id):
-        q = models.db.session.query(models.SampleStage).\
+    def query(self, session, token, project_id):
+        return session.query(models.SampleStage._sample_id).\
             join(models.Sample.sample_stages).\
             filter(models.Sample._project_id == project_id).\
             filter(models.SampleStage.annotation.ilike(token))
-        return map(lambda s: s.sample, q.all())
 
 
 class _SampleNameResolver_(_Resolver_):
 
-    def resolve(self, token, project_id):
-        q = models.db.session.query(models.Sample).\
+    def query(self, session, token, project_id):
+        return session.query(models.Sample.id).\
             filter(models.Sample._project_id == project_id).\
             filter(models.Sample.name.ilike(token))
-        return q.all()
 
 
 class _StageMethodResolver_(_Resolver_):
 
-    def resolve(self, token, project_id):
+    def query(self, session, token, project_id):
         sample_stage_1 = aliased(models.SampleStage)
-        q = models.db.session.query(models.SampleStage).\
+        return session.query(models.SampleStage._sample_id).\
             join(models.Sample.sample_stages).\
             join(sample_stage_1, models.Method.sample_stages).\
             filter(models.SampleStage.id == sample_stage_1.id).\
             filter(models.Sample._project_id == project_id).\
             filter(models.Method.name.ilike(token))
-        return map(lambda s: s.sample, q.all())
 
 
 _RESOLVER_TYPES_ = [_SampleNameResolver_,
@@ -94,65 +69,68 @@ _RESOLVER_TYPES_ = [_SampleNameResolver_,
                     _StageAnnotationResolver_]
 
 
+_pool_      = None
+_pool_lock_ = threading.Lock()
+
+
+def _resolver_pool_():
+    """
+    The pool of threads on which resolvers are run.  It's shared by all
+    requests, so that the number of concurrent queries stays bounded.
+    """
+    global _pool_
+    with _pool_lock_:
+        if _pool_ is None:
+            _pool_ = ThreadPool(sagittariidae.app.config['RESOLVER_THREADS'])
+        return _pool_
+
+
 class SampleTokenResolver():
 
     def __init__(self, project):
         self.project = project
 
-    def resolve(self, token):
-
-        def make_resolver(cls, token, project):
-            results          = set()
-            resolver         = cls()
-            resolver.project = project
-            resolver.token   = '%%%s%%' % token
-            return resolver
-
-        resolvers = map(lambda t: make_resolver(t, token, self.project), _RESOLVER_TYPES_)
-
-        # FIXME!
-        #
-        # SQLite doesn't allow objects created in one thread to be used in
-        # another, and it looks like SQLAlchemy models maintain references to
-        # implementation objects.  Since models are the way that we communicate
-        # between the persistence and presentation layers, we unfortunately for
-        # now must query using Flask worker thread that is handling the
-        # request.
-        #
-        # One way of working around this is to have resolver threads return
-        # only the sample ID, and then have the presentation layer fetch all
-        # those samples in its own thread.
-        #
-        # For now though, to meet a looming demo deadline, I'm leaving this as
-        # is, and we can explore solutions after the demo.
-
-        # for resolver in resolvers:
-        #     resolver.start()
-        # for resolver in resolvers:
-        #     resolver.join()
-
-        for resolver in resolvers:
-            resolver.run()
-
-        candidate_results = map(lambda r: r.results, resolvers)
-        return reduce(lambda union, s: union | s, candidate_results, set())
+    def jobs(self, token):
+        """
+        Returns the resolutions needed to find the samples that match `token`;
+        the union of their results is the set of matching sample IDs.
+        """
+        return [(cls(), '%%%s%%' % token, self.project.id) for cls in _RESOLVER_TYPES_]
 
 
 class SampleResolver():
 
     def resolve(self, tokens, project_id):
         project = models.get_project(obfuscated_id=project_id)
-        candidate_results = filter(lambda s: len(s) > 0,
-                                   map(lambda t: SampleTokenResolver(project).resolve(t),
-                                       tokens))
+
+        # Use the search index if it can answer the query; the resolvers
+        # below remain for tokens that it can't handle and for stores that
+        # don't support it.
+        ids = models.search_samples(project.id, tokens)
+        if ids is not None:
+            return models.get_samples_by_id(ids)
+
+        # Run every resolver for every token at once, so that the search takes
+        # about as long as the slowest of them.
+        engine = models.db.engine
+        token_jobs = map(lambda t: SampleTokenResolver(project).jobs(t), tokens)
+        results = _resolver_pool_().map(
+            lambda job: job[0].resolve(engine, job[1], job[2]),
+            [job for jobs in token_jobs for job in jobs])
+
+        candidate_results = []
+        for i in range(len(tokens)):
+            per_resolver = results[i*len(_RESOLVER_TYPES_):(i+1)*len(_RESOLVER_TYPES_)]
+            candidate_results.append(reduce(lambda union, s: union | s, per_resolver, set()))
+        candidate_results = filter(lambda s: len(s) > 0, candidate_results)
 
         # `reduce` won't reduce with an empty collection without an inital
         # value.  We don't provide an initial value because the only thing that
         # we possibly could provide is an empty set, which would break our
         # selection of the intersection of the results from the resolvers.
         if len(candidate_results) > 0:
-            return map(lambda hashable: hashable.sample,
-                       reduce(lambda intersection, s: intersection & s,
-                              candidate_results))
+            return models.get_samples_by_id(
+                sorted(reduce(lambda intersection, s: intersection & s,
+                              candidate_results)))
         else:
             return []
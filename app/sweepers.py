@@ -6,14 +6,32 @@ the world to a desired final state.
 
 The sweepers are run as processes separate from the webservice.  They may be
 invoked by name by executing this module, typically from a scheduler such as
-`cron`.
+`cron`:
+
+    python app/sweepers.py StagedFileSweeper
+
+or run together by a resident daemon that sweeps as soon as the webservice
+signals that there is work to be done, and otherwise polls periodically:
+
+    python app/sweepers.py --daemon [StagedFileSweeper ...]
 """
 
+import itertools
 import os
 import shutil
+import signal
+import socket
 import sys
+import threading
+import time
+import uuid
+
+from multiprocessing.pool import ThreadPool
 
 import app as sagittariidae
+import archive
+import checksum
+import file
 import models
 
 
@@ -31,61 +49,334 @@ class Sweeper(object):
             logger.error('Unhandled exception in sweeper %s', self, exc_info=e)
 
 
-class ArchivedFileDirSweeper(Sweeper):
+class SweepStats(object):
+    """
+    Throughput statistics for a single sweep.
+    """
 
-    def _clean_(self, ssf, logger):
-        config   = sagittariidae.app.config
-        src_path = os.path.join(config['UPLOAD_PATH'], ssf.relative_source_path)
-        src_dir  = os.path.dirname(src_path)
+    def __init__(self):
+        self.started  = time.time()
+        self.elapsed  = 0.0
+        self.files    = 0
+        self.failures = 0
+        self.bytes    = 0
+
+    def record(self, nbytes, error):
+        if error is None:
+            self.files += 1
+            self.bytes += nbytes
+        else:
+            self.failures += 1
+        self.elapsed = time.time() - self.started
+
+    def __str__(self):
+        elapsed = max(self.elapsed, 1e-6)
+        return '%d file(s), %d failure(s), %d bytes in %.3fs (%.1f files/s, %.1f MB/s)' % \
+            (self.files, self.failures, self.bytes, self.elapsed,
+             self.files / elapsed, self.bytes / elapsed / (1024 * 1024))
+
+
+class FileSweeper(Sweeper):
+    """
+    A sweeper that moves the files with a given `status` on to `next_status`.
+    Files are claimed in batches (cf. `models.claim_files`), so that several
+    sweepers may safely run at the same time, and the work for each file is
+    split into two steps:
+
+    * `_job_` extracts the plain values that are needed to process the file
+      from its model;
+    * `_process_` does the (I/O bound) work, returning the number of bytes
+      processed and the checksum of the file (a method and value), if it was
+      verified, or `None`.
+
+    When more than one worker is configured, `_process_` is run on a pool of
+    threads.  Models are never passed to the workers, and the database is only
+    ever touched on the coordinating thread, since SQLite connections (and the
+    models that hold references to them) can't be shared between threads.  The
+    files in a batch that were processed successfully are moved on to their
+    next status together, with their verified checksums, in a single
+    transaction.  Those that failed keep
+    their claim until its lease expires, which delays the next attempt.
+    """
+
+    status        = None
+    next_status   = None
+    found_message = None
+    error_message = None
+
+    def __init__(self, workers=None):
+        if workers is None:
+            workers = sagittariidae.app.config['SWEEPER_WORKERS']
+        self.workers = workers
+        self.owner   = ':'.join([socket.gethostname(),
+                                 str(os.getpid()),
+                                 uuid.uuid4().hex[:8]])[-64:]
+
+    def _job_(self, ssf):
+        raise NotImplementedError()
+
+    def _process_(self, job):
+        raise NotImplementedError()
+
+    def _attempt_(self, indexed_job):
+        i, job = indexed_job
+        try:
+            nbytes, verified = self._process_(job)
+            return (i, nbytes, verified, None)
+        except Exception, e:
+            return (i, 0, None, e)
+
+    def _sweep_batch_(self, files, stats):
+        """
+        Process a batch of files, returning those that were successful, and the
+        checksums that were verified (by file ID).
+        """
+        jobs = list(enumerate(self._job_(f) for f in files))
+        done = []
+        checksums = {}
+
+        pool = None
+        if self.workers > 1 and len(jobs) > 1:
+            pool = ThreadPool(min(self.workers, len(jobs)))
+            outcomes = pool.imap_unordered(self._attempt_, jobs)
+        else:
+            outcomes = itertools.imap(self._attempt_, jobs)
+        try:
+            for i, nbytes, verified, error in outcomes:
+                if error is None:
+                    done.append(files[i])
+                    if verified is not None:
+                        checksums[files[i].id] = verified
+                else:
+                    logger.error(self.error_message, files[i], exc_info=error)
+                stats.record(nbytes, error)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return done, checksums
+
+    def run(self):
+        config = sagittariidae.app.config
+        stats  = SweepStats()
+        while True:
+            files = models.claim_files(self.status,
+                                       self.owner,
+                                       config['SWEEPER_LEASE'],
+                                       config['SWEEPER_BATCH_SIZE'])
+            if len(files) == 0:
+                break
+            logger.info(self.found_message, len(files), files)
+            done, checksums = self._sweep_batch_(files, stats)
+            models.transition_files(done, self.next_status, checksums)
+        logger.info('%s swept %s', self.__class__.__name__, stats)
+        return stats
+
+
+class ArchivedFileDirSweeper(FileSweeper):
+
+    status        = models.FileStatus.archived
+    # Today, cleaning is the last step in the process, so we jump straight to
+    # `complete`.
+    next_status   = models.FileStatus.complete
+    found_message = 'Found upload director{y,ies} for %d files(s) that are ready to be cleaned: %s'
+    error_message = 'Error cleaning upload directory for file %s'
+
+    def _job_(self, ssf):
+        config = sagittariidae.app.config
+        return os.path.dirname(
+            os.path.join(config['UPLOAD_PATH'], ssf.relative_source_path))
+
+    def _process_(self, src_dir):
         if os.path.exists(src_dir):
             logger.info('Removing upload directory: %s' % src_dir)
             shutil.rmtree(src_dir)
         else:
             logger.warning('Upload directory doesn\'t exist: %s' % src_dir)
-        # FIXIT: Handle the OperationalError that may result if the database is
-        # locked.  It's not a critical failure, but spurious ERROR messages in
-        # the log is never nice.
-        ssf.mark_cleaned()
+        return 0, None
 
-    def run(self):
-        logger = sagittariidae.app.logger
 
-        files = models.get_files(
-            sample_stage_id=None,
-            status=models.FileStatus.archived)
-        logger.info('Found upload director{y,ies} for %d files(s) that are ready to be cleaned: %s', len(files), files)
-        for f in files:
-            try:
-                self._clean_(f, logger)
-            except Exception, e:
-                logger.error('Error cleaning upload directory for file %s', f, exc_info=e)
+class StagedFileSweeper(FileSweeper):
 
+    status        = models.FileStatus.staged
+    next_status   = models.FileStatus.archived
+    found_message = 'Found %d file(s) that are ready to be moved into place: %s'
+    error_message = 'Error moving file %s'
 
-class StagedFileSweeper(Sweeper):
+    def _job_(self, ssf):
+        config = sagittariidae.app.config
+        return (os.path.join(config['UPLOAD_PATH'], ssf.relative_source_path),
+                os.path.join(config['STORE_PATH'], ssf.relative_target_path))
 
-    def _complete_(self, ssf):
-        config   = sagittariidae.app.config
-        src_path = os.path.join(config['UPLOAD_PATH'], ssf.relative_source_path)
-        tgt_path = os.path.join(config['STORE_PATH'], ssf.relative_target_path)
-        tgt_dir  = os.path.dirname(tgt_path)
+    def _process_(self, paths):
+        config = sagittariidae.app.config
+        src_path, tgt_path = paths
+        tgt_dir = os.path.dirname(tgt_path)
         if not os.path.isdir(tgt_dir):
-            os.makedirs(tgt_dir)
-        shutil.copy(src_path, tgt_path)
-        logger.info('Copied file: %s -> %s', src_path, tgt_path)
-        ssf.mark_archived()
+            try:
+                os.makedirs(tgt_dir)
+            except OSError:
+                # Another worker may have created it in the meantime.
+                if not os.path.isdir(tgt_dir):
+                    raise
+        # The copy is verified against the checksum recorded when the upload
+        # was completed, if there is one, as it's made.  That checksum also
+        # identifies the file if the archive is deduplicated.
+        expected = checksum.read_sidecar(src_path)
+        if config['DEDUPLICATE_ARCHIVE'] and \
+           expected is not None and expected[0] in archive.DEDUPLICATION_METHODS:
+            result = archive.archive_deduplicated_file(
+                src_path, tgt_path, config['STORE_PATH'], config['ARCHIVE_STRATEGIES'], logger, expected)
+        else:
+            result = archive.archive_file(
+                src_path, tgt_path, config['ARCHIVE_STRATEGIES'], logger, expected)
+        return result.size, expected
 
-    def run(self):
-        logger = sagittariidae.app.logger
 
-        files = models.get_files(
-            sample_stage_id=None,
-            status=models.FileStatus.staged)
-        logger.info('Found %d file(s) that are ready to be moved into place: %s', len(files), files)
-        for f in files:
+class AbandonedUploadSweeper(Sweeper):
+    """
+    Removes the upload directories of uploads that were started but never
+    completed.  Prepared uploads are found by their sessions (cf.
+    `models.get_stale_upload_sessions`), which are removed with their
+    directories (or without them, if there are none), and uploads that were
+    never prepared by the age of their directories (cf.
+    `models.get_abandoned_unprepared_upload_dirs`).  The upload directories of
+    completed uploads are removed by the `ArchivedFileDirSweeper`, once their
+    files have been archived.
+    """
+
+    def run(self):
+        stats = SweepStats()
+        config = sagittariidae.app.config
+        sessions = models.get_stale_upload_sessions(config['UPLOAD_ABANDONED_AGE'])
+        abandoned = [models.UploadDir(s.identifier, os.path.join(config['UPLOAD_PATH'], s.identifier), None, None)
+                     for s in sessions]
+        abandoned += models.get_abandoned_unprepared_upload_dirs(config['UPLOAD_ABANDONED_AGE'])
+        if len(abandoned) > 0:
+            logger.info('Found %d abandoned upload(s): %s',
+                        len(abandoned), [d.identifier for d in abandoned])
+        removed = []
+        for upload_dir in abandoned:
             try:
-                self._complete_(f)
-            except Exception, e:
-                logger.error('Error moving file %s', f, exc_info=e)
+                nbytes = upload_dir.bytes or 0
+                if os.path.isdir(upload_dir.path):
+                    if upload_dir.bytes is None:
+                        nbytes = file.tree_usage(upload_dir.path)[0]
+                    logger.info('Removing abandoned upload directory: %s (%d bytes)',
+                                upload_dir.path, nbytes)
+                    shutil.rmtree(upload_dir.path)
+                removed.append(upload_dir.identifier)
+                stats.record(nbytes, None)
+            except OSError, e:
+                logger.error('Error removing abandoned upload directory %s',
+                             upload_dir.path, exc_info=e)
+                stats.record(0, e)
+        models.remove_upload_sessions(removed)
+        logger.info('%s swept %s', self.__class__.__name__, stats)
+        return stats
+
+
+class Throttle(object):
+    """
+    Limits the rate at which data are processed to `rate` bytes per second
+    (or not at all, if `rate` is `None`), by sleeping whenever the processing
+    has got ahead of it.
+    """
+
+    def __init__(self, rate, clock=time.time, sleep=time.sleep):
+        self.rate    = rate
+        self.clock   = clock
+        self.sleep   = sleep
+        self.started = clock()
+        self.nbytes  = 0
+
+    def consume(self, nbytes):
+        self.nbytes += nbytes
+        if self.rate:
+            ahead = (float(self.nbytes) / self.rate) - (self.clock() - self.started)
+            if ahead > 0:
+                self.sleep(ahead)
+
+
+class ArchiveScrubber(Sweeper):
+    """
+    Re-verifies the files in the archive against the checksums that were
+    verified when they were archived, so that files that have since been
+    corrupted are found.  Files are read at no more than `SCRUBBER_RATE` bytes
+    per second, so that the scrubber can run continuously without starving
+    uploads and downloads of I/O.
+
+    A sweep is a single pass over the archive, in order of file ID.  The ID of
+    the last file that was verified is kept in the cursor file (in
+    `UPLOAD_PATH`), so that a pass that is interrupted resumes where it left
+    off, rather than starting again.  The outcome of each verification is
+    recorded on the file; cf. `models.record_verification`.
+    """
+
+    def __init__(self, rate=None):
+        config = sagittariidae.app.config
+        self.rate        = rate or config['SCRUBBER_RATE']
+        self.cursor_path = os.path.join(config['UPLOAD_PATH'], config['SCRUBBER_CURSOR_NAME'])
+
+    def _load_cursor_(self):
+        try:
+            with open(self.cursor_path, 'r') as cf:
+                return int(cf.read().strip())
+        except (IOError, ValueError):
+            return None
+
+    def _save_cursor_(self, file_id):
+        # Replace the cursor atomically, so that it's never found half written.
+        with open(self.cursor_path + '.tmp', 'w') as cf:
+            cf.write('%d\n' % file_id)
+        os.rename(self.cursor_path + '.tmp', self.cursor_path)
+
+    def _verify_(self, path, method, value, throttle):
+        digester = checksum.get_digester(method)
+        def consume(data):
+            digester.update(data)
+            throttle.consume(len(data))
+        file.FileProcessor(path, consume).process()
+        if digester.hexdigest() != value:
+            raise checksum.ChecksumMismatch(path, method, value, digester.hexdigest())
+        return os.path.getsize(path)
+
+    def run(self):
+        config   = sagittariidae.app.config
+        stats    = SweepStats()
+        throttle = Throttle(self.rate)
+        cursor   = self._load_cursor_()
+        if cursor is not None:
+            logger.info('Resuming archive scrub after file %d', cursor)
+        while True:
+            files = models.get_files_to_verify(cursor, config['SWEEPER_BATCH_SIZE'])
+            if len(files) == 0:
+                break
+            # Take what we need from the models, so that we don't hold on to
+            # them (or the session) while the files are read.
+            jobs = [(f.id,
+                     os.path.join(config['STORE_PATH'], f.relative_target_path),
+                     f.checksum_method,
+                     f.checksum_value)
+                    for f in files]
+            models.db.session.remove()
+            for file_id, path, method, value in jobs:
+                try:
+                    nbytes = self._verify_(path, method, value, throttle)
+                    error  = None
+                except (checksum.ChecksumError, IOError, OSError), e:
+                    logger.error('Archived file %s failed verification: %s', path, e)
+                    nbytes = 0
+                    error  = str(e)
+                models.record_verification(file_id, error)
+                stats.record(nbytes, error)
+                self._save_cursor_(file_id)
+                cursor = file_id
+        # The pass is complete; the next one starts from the beginning.
+        if os.path.exists(self.cursor_path):
+            os.remove(self.cursor_path)
+        logger.info('%s swept %s', self.__class__.__name__, stats)
+        return stats
 
 
 def make_sweeper(c):
@@ -98,9 +389,72 @@ def make_sweeper(c):
         else:
             return i
     except Exception, e:
-        logger.error('Invalid sweeper class %s', sys.argv[1], exc_info=e)
+        logger.error('Invalid sweeper class %s', c, exc_info=e)
         raise e
 
 
+class SweeperDaemon(object):
+    """
+    Runs a set of sweepers repeatedly in a single, long-lived, process.  A
+    sweep is started whenever the wakeup file is touched (cf.
+    `models.notify_sweepers`), and otherwise every `SWEEPER_POLL_INTERVAL`
+    seconds.  `SIGTERM` and `SIGINT` stop the daemon once the sweep that is in
+    progress has finished.
+    """
+
+    def __init__(self, sweepers):
+        config = sagittariidae.app.config
+        self.sweepers       = sweepers
+        self.wakeup_path    = models.sweeper_wakeup_path()
+        self.poll_interval  = config['SWEEPER_POLL_INTERVAL']
+        self.check_interval = config['SWEEPER_WAKEUP_CHECK_INTERVAL']
+        self.stopping       = threading.Event()
+
+    def _wakeup_mtime_(self):
+        try:
+            return os.stat(self.wakeup_path).st_mtime
+        except OSError:
+            return None
+
+    def stop(self, *_):
+        logger.info('Sweeper daemon stopping ...')
+        self.stopping.set()
+
+    def sweep(self):
+        for sweeper in self.sweepers:
+            if self.stopping.is_set():
+                break
+            sweeper.sweep()
+        # Don't hold on to the models (or the connection) between sweeps.
+        models.db.session.remove()
+
+    def wait(self, last_mtime):
+        """
+        Wait until the wakeup file is touched, the poll interval has elapsed
+        or the daemon is stopped.  Returns the mtime of the wakeup file.
+        """
+        deadline = time.time() + self.poll_interval
+        while not self.stopping.is_set() and time.time() < deadline:
+            mtime = self._wakeup_mtime_()
+            if mtime != last_mtime:
+                return mtime
+            self.stopping.wait(self.check_interval)
+        return self._wakeup_mtime_()
+
+    def serve(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        logger.info('Sweeper daemon started: %s', self.sweepers)
+        mtime = self._wakeup_mtime_()
+        while not self.stopping.is_set():
+            self.sweep()
+            mtime = self.wait(mtime)
+        logger.info('Sweeper daemon stopped.')
+
+
 if __name__ == '__main__':
-    make_sweeper(globals().get(sys.argv[1])).sweep()
+    if sys.argv[1] == '--daemon':
+        names = sys.argv[2:] or ['StagedFileSweeper', 'ArchivedFileDirSweeper']
+        SweeperDaemon([make_sweeper(globals().get(n)) for n in names]).serve()
+    else:
+        make_sweeper(globals().get(sys.argv[1])).sweep()
@@ -1,5 +1,6 @@
 
 import StringIO
+import datetime
 import glob
 import hashlib
 import json
@@ -7,11 +8,14 @@ import math
 import os
 import re
 
-from flask          import abort, jsonify, redirect, request
+from flask          import abort, jsonify, make_response, redirect, request
 from werkzeug.utils import secure_filename
-from urllib         import quote
+from urllib         import quote, urlencode
 
+import assembler
+import bundle
 import checksum
+import download
 import file
 import http
 
@@ -19,9 +23,6 @@ from app            import app, db, models
 from sampleresolver import SampleResolver
 
 
-PART_EXT = "part"
-CHECKSUM_EXT = "checksum"
-
 # ------------------------------------------------------------ api routes --- #
 
 @app.route('/')
@@ -47,17 +48,18 @@ def get_project_samples(project):
     #
     #   http://.../projects/qwErt/samples?q=P001-B009-...
     #
-    # In the absence of the query parameter we simply return the entire
-    # collection.
-    # FIXME: This should support pagination!
+    # In the absence of the query parameter we return the collection a page at
+    # a time; cf. `page_args`.
     search_terms = request.args.get('q')
     project_id   = as_id(project)
     if search_terms is not None:
         return jsonize(
             SampleResolver().resolve(search_terms.split(' '), project_id))
     else:
-        return jsonize(
-            models.get_samples(obfuscated_id=as_id(project_id)))
+        after, limit = page_args()
+        samples = models.get_samples(
+            after=after, limit=limit+1, obfuscated_id=as_id(project_id))
+        return paginated(samples, limit, jsonize)
 
 
 @app.route('/projects/<project>/samples/<sample>', methods=['GET'])
@@ -70,15 +72,22 @@ def get_project_sample(project, sample):
 
 @app.route('/projects/<_>/samples/<sample>/stages', methods=['GET'])
 def get_project_sample_stages(_, sample):
-    (stages, token) = models.get_sample_stages(as_id(sample))
-    return jsonize({'sample' : sample,
-                    'stages' : stages,
-                    'token'  : token})
+    after, limit = page_args()
+    (stages, token) = models.get_sample_stages(
+        as_id(sample), after=after, limit=limit+1)
+    # Stages are identified by their ordinal position, which on any page but
+    # the first doesn't start at 1.
+    offset = models.count_sample_stages_before(as_id(sample), after)
+    return paginated(stages, limit,
+                     lambda page: jsonize({'sample' : sample,
+                                           'stages' : page,
+                                           'token'  : token},
+                                          sample_stage_offset=offset))
 
 
 @app.route('/projects/<_>/samples/<sample>/stages/<stage>', methods=['GET'])
 def get_project_sample_stage(_, sample, stage):
-    return jsonize(models.get_sample_stages(as_id(sample), as_id(stage)))
+    return jsonize(models.get_sample_stage(as_id(sample), as_id(stage)))
 
 
 @app.route('/projects/<project>/samples/<sample>/stages/<stage>', methods=['PUT'])
@@ -94,8 +103,28 @@ def put_project_sample_stage(project, sample, stage):
 
 @app.route('/projects/<project>/samples/<sample>/stages/<stage>/files', methods=['GET'])
 def get_sample_stage_files(project, sample, stage):
-    return jsonize({'stage-id' : stage,
-                    'files'    : models.get_files(sample_stage_id=as_id(stage), status=None)})
+    after, limit = page_args()
+    files = models.get_files(
+        sample_stage_id=as_id(stage), status=None, after=after, limit=limit+1)
+    return paginated(files, limit,
+                     lambda page: jsonize({'stage-id' : stage,
+                                           'files'    : page}))
+
+
+@app.route('/projects/<project>/samples/<sample>/bundle', methods=['GET'])
+def get_sample_bundle(project, sample):
+    s = models.get_project_sample({'obfuscated_id': as_id(project)},
+                                  {'obfuscated_id': as_id(sample)})
+    return send_bundle(models.get_archived_files(s.obfuscated_id), sample)
+
+
+@app.route('/projects/<project>/samples/<sample>/stages/<stage>/bundle', methods=['GET'])
+def get_sample_stage_bundle(project, sample, stage):
+    s = models.get_project_sample({'obfuscated_id': as_id(project)},
+                                  {'obfuscated_id': as_id(sample)})
+    ss = models.get_sample_stage(s.obfuscated_id, as_id(stage))
+    return send_bundle(models.get_archived_files(s.obfuscated_id, ss.obfuscated_id),
+                       '%s-%s' % (sample, stage))
 
 
 @app.route('/methods', methods=['GET'])
@@ -110,7 +139,69 @@ def get_method(method):
 
 @app.route('/prepare-multipart-upload', methods=['POST'])
 def prepare_file_upload():
-    pass
+    # Preparing an upload allocates the reassembled file at its full size, so
+    # that each part can be written straight into place as it's received; the
+    # parts are then sent exactly as they would be otherwise.  This halves
+    # the space needed for an upload that would otherwise be reassembled from
+    # parts received out of order.
+    #
+    # The upload is also recorded in the database, with the sample stage that
+    # it's for and the parts that have been received, against which its parts
+    # and completion are checked.
+    request_data    = json.loads(request.data)
+    file_identifier = request_data['upload-id']
+    sample_stage    = as_id(request_data['sample-stage'])
+    checksum_method = request_data['checksum-method']
+    total_parts     = int(request_data['total-parts'])
+    chunk_size      = int(request_data['chunk-size'])
+    total_size      = int(request_data['total-size'])
+
+    part_upload_dir = upload_dir(file_identifier)
+    upload_session  = models.get_upload_session(file_identifier)
+    if upload_session is None:
+        if checksum_method not in checksum.DIGESTERS:
+            raise checksum.UnsupportedChecksumMethod(checksum_method)
+        upload_session = models.add_upload_session(
+            file_identifier, sample_stage, total_parts, chunk_size, total_size, checksum_method)
+    elif (upload_session.sample_stage_id, upload_session.checksum_method,
+          upload_session.total_parts, upload_session.chunk_size, upload_session.total_size) != \
+         (sample_stage, checksum_method, total_parts, chunk_size, total_size):
+        raise assembler.AssemblyInProgress(part_upload_dir)
+
+    mkdirp(part_upload_dir)
+    assembler.prepare_assembly(part_upload_dir, total_parts, chunk_size, total_size)
+
+    return (json.dumps({'identifier'     : file_identifier,
+                        'sample-stage'   : upload_session.sample_stage_id,
+                        'checksum-method': checksum_method,
+                        'total-parts'    : total_parts,
+                        'chunk-size'     : chunk_size,
+                        'total-size'     : total_size}),
+            http.HTTP_201_CREATED)
+
+
+def receive_part(file_identifier, part_number, total_number_parts, chunk_size, total_size, stream, blocksize,
+                 part_checksum):
+    # A part of a prepared upload must agree with what was prepared.
+    upload_session = models.get_upload_session(file_identifier)
+    if upload_session is not None:
+        if (int(total_number_parts), int(chunk_size), int(total_size)) != \
+           (upload_session.total_parts, upload_session.chunk_size, upload_session.total_size) or \
+           not 1 <= int(part_number) <= upload_session.total_parts:
+            abort(http.HTTP_400_BAD_REQUEST)
+
+    part_upload_dir = upload_dir(file_identifier)
+    mkdirp(part_upload_dir)
+
+    # Save the part, checking it against its digest (if the client sent one)
+    # and recording it, and append it (and any buffered parts that follow it)
+    # to the file that is being reassembled, so that there is nothing left to
+    # do but verify the checksum when the upload is completed.
+    assembly = assembler.get_assembly(part_upload_dir, total_number_parts, chunk_size, total_size)
+    assembly.save_part(part_number, stream, blocksize, part_checksum)
+    if upload_session is not None:
+        models.record_upload_part(file_identifier, int(part_number))
+    assembly.advance()
 
 
 @app.route('/upload-part', methods=['POST'])
@@ -124,15 +215,52 @@ def upload_file():
 
     # file_identifier = request.form['upload-id']
     file_identifier = request.form['resumableIdentifier']
-    part_upload_dir = upload_dir(file_identifier)
-    mkdirp(part_upload_dir)
 
-    # Save the part into a file with a name of the form 00.part.  The number of
-    # leading zeroes depends on the number of parts.
-    fmtstr = "%%0%dd" % len(total_number_parts)
-    part_filename = '.'.join([(fmtstr % int(part_number)), PART_EXT])
-    part_filepath = os.path.join(part_upload_dir, part_filename)
-    part.save(part_filepath)
+    receive_part(file_identifier,
+                 part_number,
+                 total_number_parts,
+                 request.form['resumableChunkSize'],
+                 request.form['resumableTotalSize'],
+                 part.stream,
+                 app.config['UPLOAD_WRITE_BLOCKSIZE'],
+                 request.form.get('chunk-checksum'))
+
+    return json.dumps(
+        {'identifier': file_identifier,
+         'part': part_number,
+         'total_parts': total_number_parts})
+
+
+@app.route('/upload-parameters', methods=['GET'])
+def get_upload_parameters():
+    return json.dumps(
+        {'chunk-size'      : app.config['UPLOAD_CHUNK_SIZE'],
+         'max-part-size'   : app.config['MAX_PART_CONTENT_LENGTH'],
+         'checksum-method' : assembler.RUNNING_CHECKSUM_METHOD,
+         'checksum-methods': sorted(checksum.DIGESTERS.keys()),
+         'tree-leaf-size'  : checksum.TREE_LEAF_SIZE})
+
+
+@app.route('/upload-part/<file_identifier>/<int:part_number>', methods=['PUT'])
+def stream_upload_file(file_identifier, part_number):
+    # The part is the body of the request, which is written to the part file
+    # as it's received; unlike a part sent as form data, it isn't parsed or
+    # spooled to a temporary file first.  The remaining parameters of the
+    # upload are the same as those sent by Resumable.js, in the query string.
+    if request.content_length is None:
+        abort(http.HTTP_411_LENGTH_REQUIRED)
+    if request.content_length > app.config['MAX_PART_CONTENT_LENGTH']:
+        abort(http.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+    total_number_parts = request.args['resumableTotalChunks']
+    receive_part(file_identifier,
+                 part_number,
+                 total_number_parts,
+                 request.args['resumableChunkSize'],
+                 request.args['resumableTotalSize'],
+                 request.stream,
+                 app.config['UPLOAD_WRITE_BLOCKSIZE'],
+                 request.args.get('chunk-checksum'))
 
     return json.dumps(
         {'identifier': file_identifier,
@@ -140,6 +268,80 @@ def upload_file():
          'total_parts': total_number_parts})
 
 
+@app.route('/upload-usage', methods=['GET'])
+def get_upload_usage():
+    # The space used by uploads, and the space left for them, so that we can be
+    # warned before the store fills up.
+    upload_path = app.config['UPLOAD_PATH']
+    if not os.path.isdir(upload_path):
+        upload_path = app.config['STORE_PATH']
+    fs          = os.statvfs(upload_path)
+    upload_dirs = models.get_upload_dirs()
+    abandoned   = models.get_abandoned_upload_dirs(app.config['UPLOAD_ABANDONED_AGE'], upload_dirs)
+    return json.dumps(
+        {'filesystem': {'total-bytes'    : fs.f_blocks * fs.f_frsize,
+                        'free-bytes'     : fs.f_bavail * fs.f_frsize},
+         'uploads'   : {'count'          : len(upload_dirs),
+                        'bytes'          : sum(d.bytes for d in upload_dirs),
+                        'abandoned'      : len(abandoned),
+                        'abandoned-bytes': sum(d.bytes for d in abandoned)}})
+
+
+@app.route('/upload-part', methods=['GET'])
+def probe_upload_part():
+    # Resumable.js (with `testChunks` enabled) asks whether each part has
+    # already been received before it sends it, so that an interrupted upload
+    # can be resumed without sending the parts again.  A 200 tells it that the
+    # part is here; any other success status that it should send the part.
+    # Clients may additionally send the digest of the part, in which case the
+    # part that was received must match it.
+    try:
+        file_identifier = request.args['resumableIdentifier']
+        part_number     = int(request.args['resumableChunkNumber'])
+        part_size       = request.args.get('resumableCurrentChunkSize')
+        if part_size is not None:
+            part_size = int(part_size)
+    except (KeyError, ValueError):
+        abort(http.HTTP_400_BAD_REQUEST)
+    part_upload_dir = upload_dir(file_identifier)
+    if not os.path.isdir(part_upload_dir):
+        return ('', http.HTTP_204_NO_CONTENT)
+    upload_session = models.get_upload_session(file_identifier)
+    if upload_session is not None and \
+       not (1 <= part_number <= upload_session.total_parts and upload_session.has_part(part_number)):
+        return ('', http.HTTP_204_NO_CONTENT)
+
+    # Probing a part must not start the upload.
+    assembly = assembler.find_assembly(part_upload_dir)
+    if assembly is None:
+        return ('', http.HTTP_204_NO_CONTENT)
+    if assembly.has_part(part_number, part_size, request.args.get('chunk-checksum')):
+        return ('', http.HTTP_200_OK)
+    else:
+        return ('', http.HTTP_204_NO_CONTENT)
+
+
+@app.route('/dl/<path:path>', methods=['GET'])
+def download_file(path):
+    ssf = models.get_archived_file(path)
+    tag = None
+    if ssf.checksum_value is not None:
+        tag = download.etag(ssf.checksum_method, ssf.checksum_value)
+    offload = app.config['DOWNLOAD_OFFLOAD']
+    if offload == 'x-accel-redirect':
+        offload_path = app.config['DOWNLOAD_ACCEL_PREFIX'] + quote(path)
+    else:
+        offload_path = os.path.join(app.config['STORE_PATH'], path)
+    try:
+        return download.send_file(request.environ,
+                                  os.path.join(app.config['STORE_PATH'], path),
+                                  tag, offload, offload_path,
+                                  app.config['DOWNLOAD_BLOCKSIZE'])
+    except OSError:
+        # The file is recorded, but isn't in the store.
+        abort(http.HTTP_404_NOT_FOUND)
+
+
 @app.route('/complete-multipart-upload', methods=['POST'])
 def complete_file_upload():
     request_data    = json.loads(request.data)
@@ -154,27 +356,37 @@ def complete_file_upload():
 
     part_upload_dir = upload_dir(file_identifier)
     reconstituted_file_name = os.path.join(part_upload_dir, file_name)
-    parts = sorted(glob.glob(os.path.join(part_upload_dir, '*.part')))
-
-    part_digester = checksum.get_digester(req_checksum_method)
-    with open(reconstituted_file_name, 'w') as target:
-        def consume_part(data):
-            target.write(data)
-            part_digester.update(data)
-        for part_name in parts:
-            file.FileProcessor(part_name, consume_part).process()
-    computed_checksum_value = part_digester.hexdigest()
+
+    # A prepared upload can be checked against its session before the
+    # reassembled file is looked at.
+    upload_session = models.get_upload_session(file_identifier)
+    if upload_session is not None:
+        if (upload_session.sample_stage_id, upload_session.checksum_method) != \
+           (sample_stage, req_checksum_method):
+            abort(http.HTTP_400_BAD_REQUEST)
+        if not upload_session.is_complete:
+            raise assembler.IncompleteAssembly(part_upload_dir,
+                                               upload_session.received_parts.index('0') + 1,
+                                               upload_session.total_parts)
+
+    assembly = assembler.get_assembly(part_upload_dir)
+    computed_checksum_value = assembly.finalize(req_checksum_method)
     if computed_checksum_value != req_checksum_value:
         raise checksum.ChecksumMismatch(
             reconstituted_file_name,
             req_checksum_method,
             req_checksum_value,
             computed_checksum_value)
+    assembly.commit(reconstituted_file_name)
 
-    with open('.'.join([reconstituted_file_name, CHECKSUM_EXT]), 'w') as cf:
-        json.dump({'method': req_checksum_method,
-                   'value' : req_checksum_value},
-                  cf)
+    # Alongside the checksum of the file, keep the Merkle root of the digests
+    # of its parts, which allows the file to be verified a part at a time.
+    checksum.write_sidecar(reconstituted_file_name,
+                           req_checksum_method,
+                           req_checksum_value,
+                           parts={'method'    : assembly.method,
+                                  'chunk-size': assembly.chunk_size,
+                                  'root'      : assembly.parts_root()})
 
     logmsg = 'Successfully reconsitituted file: %s (%s=%s)' \
              % (reconstituted_file_name, req_checksum_method, req_checksum_value)
@@ -183,6 +395,8 @@ def complete_file_upload():
         os.path.relpath(
             reconstituted_file_name, app.config['UPLOAD_PATH']),
         sample_stage)
+    if upload_session is not None:
+        models.complete_upload_session(file_identifier)
 
     return (json.dumps({'identifier' : file_identifier,
                         'file-name'  : file_name}),
@@ -198,6 +412,14 @@ def handle_unsupported_checksum_method(e):
             e.status_code)
 
 
+@app.errorhandler(assembler.AssemblyError)
+def handle_assembly_error(e):
+    app.logger.error('Assembly error: %s' % e, exc_info=e)
+    return (json.dumps({'status_code': e.status_code,
+                        'message'    : e.message}),
+            e.status_code)
+
+
 @app.errorhandler(Exception)
 def handle_unhandled_exception(e):
     app.logger.error('Unhandled exception: %s' % e, exc_info=e)
@@ -214,15 +436,27 @@ class DBModelJSONEncoder(json.JSONEncoder):
     BAD_URI_PAT  = re.compile("%.{2}|\/|_")
     COLLAPSE_PAT = re.compile("-{2,}")
 
-    def __init__(self, **kw):
+    # Timestamps are in UTC.  SQLite gives them to us without a timezone, and
+    # PostgreSQL with one, so they're rendered in the same way, to the second,
+    # whatever the database.
+    TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+    def __init__(self, sample_stage_offset=0, **kw):
         super(DBModelJSONEncoder, self).__init__(**kw)
 
         # This is a terrible hack to make it possible to add context to the
         # stages IDs.  The relative ordering of stages is important, and from
         # this we infer the ordinal position values.  Note this that assumes
         # that a new encoder instance is used for each JSON document; do not
-        # cache encoders!
-        self.sample_stage_count = 0
+        # cache encoders!  When the stages are paginated, the ordinal position
+        # of the last stage on the preceding page must be given as
+        # `sample_stage_offset`.
+        self.sample_stage_count = sample_stage_offset
+
+        # The URI names of the parents of the resources being encoded (e.g.
+        # the project of each sample); many resources typically share a
+        # parent.
+        self.parent_uri_names = {}
 
     def _uri_name(self, obfuscated_id, name):
         """
@@ -243,6 +477,19 @@ class DBModelJSONEncoder(json.JSONEncoder):
         # concat with the ID and return
         return '-'.join([obfuscated_id, new_name])
 
+    def _parent_uri_name(self, parent):
+        """
+        The URI name of a parent resource.  The parents should have been
+        eagerly loaded with their children, so this never touches the
+        database; it only saves us from rendering the same name repeatedly.
+        """
+        key = (parent.__class__, parent.id)
+        name = self.parent_uri_names.get(key)
+        if name is None:
+            name = self._uri_name(parent.obfuscated_id, parent.name)
+            self.parent_uri_names[key] = name
+        return name
+
     def _dictify(self, model, exclude={}):
         """
         Return a model as a dictionary. 'Private' attributes are removed and
@@ -254,6 +501,11 @@ class DBModelJSONEncoder(json.JSONEncoder):
         return dict(tr(kv) for kv in iter(model.__dict__.items())
                     if (not (kv[0].startswith('_') or (kv[0] in exclude))))
 
+    def _encodeTimestamp(self, ts):
+        if ts.utcoffset() is not None:
+            ts = (ts - ts.utcoffset()).replace(tzinfo=None)
+        return ts.strftime(self.TIMESTAMP_FORMAT)
+
     def strip_private_fields(self, d):
         del d['obfuscated-id']
         return d
@@ -271,15 +523,15 @@ class DBModelJSONEncoder(json.JSONEncoder):
     def _encodeSample(self, s):
         d = self._dictify(s, {'project'})
         d['id'] = self._uri_name(d['obfuscated-id'], d['name'])
-        d['project'] = self._uri_name(s.project.obfuscated_id, s.project.name)
+        d['project'] = self._parent_uri_name(s.project)
         return self.strip_private_fields(d)
 
     def _encodeSampleStage(self, ss):
         d = self._dictify(ss, {'sample', 'method'})
         self.sample_stage_count += 1
         d['id'] = self._uri_name(d['obfuscated-id'], str(self.sample_stage_count))
-        d['sample'] = self._uri_name(ss.sample.obfuscated_id, ss.sample.name)
-        d['method'] = self._uri_name(ss.method.obfuscated_id, ss.method.name)
+        d['sample'] = self._parent_uri_name(ss.sample)
+        d['method'] = self._parent_uri_name(ss.method)
         return self.strip_private_fields(d)
 
     def _encodeSampleStageFile(self, ssf):
@@ -295,7 +547,7 @@ class DBModelJSONEncoder(json.JSONEncoder):
         return {'id'           : ssf.obfuscated_id + '-' + fname,
                 'file'         : fname,
                 'status'       : status,
-                'mtime'        : ssf.modified_ts.isoformat(),
+                'mtime'        : self._encodeTimestamp(ssf.modified_ts),
                 'uri' : '/dl/' + ssf.relative_target_path}
 
     def _encodeModel(self, m):
@@ -314,12 +566,69 @@ class DBModelJSONEncoder(json.JSONEncoder):
             return self._encodeSampleStageFile(thing)
         if isinstance(thing, db.Model):
             return self._encodeModel(thing)
+        if isinstance(thing, datetime.datetime):
+            return self._encodeTimestamp(thing)
+
+
+def jsonize(x, **kw):
+    return json.dumps(x, cls=DBModelJSONEncoder, **kw)
+
+
+def page_args():
+    """
+    Parse the pagination parameters of a collection request:
+
+      http://.../projects/qwErt/samples?after=OQn6Q&limit=100
+
+    `after` is the ID of the last resource on the previous page, and `limit`
+    the maximum number of resources on this page.  Returns the obfuscated ID
+    of the `after` resource (or `None`) and the limit.
+    """
+    after = request.args.get('after')
+    if after is not None:
+        after = as_id(after)
+    try:
+        limit = int(request.args.get('limit', app.config['PAGE_SIZE']))
+    except ValueError:
+        abort(http.HTTP_400_BAD_REQUEST)
+    if limit < 1 or limit > app.config['MAX_PAGE_SIZE']:
+        abort(http.HTTP_400_BAD_REQUEST)
+    return after, limit
+
+
+def paginated(resources, limit, encodefn):
+    """
+    Build the response for a page of `resources`, which should have been
+    retrieved with a limit of `limit+1`; the extra resource, if there is one,
+    tells us that there is a next page, to which we add a `Link`.
+    """
+    rsp = make_response(encodefn(resources[:limit]))
+    if len(resources) > limit:
+        args = request.args.copy()
+        args['after'] = resources[limit-1].obfuscated_id
+        args['limit'] = limit
+        rsp.headers['Link'] = '<%s?%s>; rel="next"' % (
+            request.base_url, urlencode(list(args.iteritems(multi=True))))
+    return rsp
 
+# ----------------------------------------------------------- utility fns --- #
 
-def jsonize(x):
-    return json.dumps(x, cls=DBModelJSONEncoder)
+def send_bundle(files, name):
+    """
+    Stream a tar file of the archived `files`, named as they are in the store
+    but without the leading project directory, so that bundles of different
+    stages of a sample can be unpacked alongside each other.
+    """
+    store_path = app.config['STORE_PATH']
+    b = bundle.Bundle([(ssf.relative_target_path.split('/', 1)[1],
+                        os.path.join(store_path, ssf.relative_target_path),
+                        ssf.checksum_value)
+                       for ssf in files],
+                      app.config['DOWNLOAD_BLOCKSIZE'])
+    disposition = 'attachment; filename="%s.tar"' % secure_filename(name)
+    return download.send_content(request.environ, b.size, b.mtime, b.etag, 'application/x-tar',
+                                 b.read, headers={'Content-Disposition': disposition})
 
-# ----------------------------------------------------------- utility fns --- #
 
 def mkdirp(p):
     if os.path.exists(p) and os.path.isdir(p):
@@ -343,12 +652,8 @@ def upload_dir(p):
     return os.path.join(*full_path)
 
 
-def hashfile(fn, hasher, blocksize=65536):
-    with open(fn, 'rb') as afile:
-        buf = afile.read(blocksize)
-        while len(buf) > 0:
-            hasher.update(buf)
-            buf = afile.read(blocksize)
+def hashfile(fn, hasher, blocksize=None):
+    file.FileProcessor(fn, hasher.update, blocksize).process()
     return hasher.hexdigest()
 
 
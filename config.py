@@ -19,10 +19,118 @@ STORE_PATH  = '/mnt/adapt'
 # their permanent home.
 UPLOAD_PATH = os.path.join(STORE_PATH, '.upload')
 
+# The ways in which the sweeper may move a staged file into the archive, in
+# order of preference; cf. `app.archive`.  Copies of files with a known
+# checksum are verified as they're made, which the kernel copies
+# (`copy_file_range` and `sendfile`) can't do; they're only used for files
+# without one.
+ARCHIVE_STRATEGIES = ['link', 'copy_file_range', 'sendfile', 'copy']
+
+# If `DEDUPLICATE_ARCHIVE` is set, each distinct file is stored only once, in
+# a directory of blobs named by their checksums (in `STORE_PATH`), to which the
+# files in the archive are hard links; cf. `app.archive`.
+DEDUPLICATE_ARCHIVE = False
+
+# The number of files that each sweeper processes concurrently.  The work done
+# for each file is I/O bound, so this may usefully exceed the number of CPUs.
+SWEEPER_WORKERS = 4
+
+# Sweepers claim files in batches of `SWEEPER_BATCH_SIZE`, for
+# `SWEEPER_LEASE` seconds.  A file that a sweeper fails to process is retried
+# once its lease has expired.
+SWEEPER_BATCH_SIZE = 100
+SWEEPER_LEASE = 600
+
+# The sweeper daemon sweeps whenever the webservice touches the wakeup file (in
+# `UPLOAD_PATH`), which it checks for changes every
+# `SWEEPER_WAKEUP_CHECK_INTERVAL` seconds, and in any case every
+# `SWEEPER_POLL_INTERVAL` seconds.
+SWEEPER_WAKEUP_NAME = '.sweep'
+SWEEPER_WAKEUP_CHECK_INTERVAL = 1
+SWEEPER_POLL_INTERVAL = 60
+
+# The `ArchiveScrubber` reads archived files at no more than `SCRUBBER_RATE`
+# bytes per second.  Its position in the archive is kept in a file named
+# `SCRUBBER_CURSOR_NAME` in `UPLOAD_PATH`.
+SCRUBBER_RATE = 20 * 1024 * 1024
+SCRUBBER_CURSOR_NAME = '.scrub'
+
+# Uploads that are left untouched for `UPLOAD_ABANDONED_AGE` seconds without
+# being completed are considered abandoned, and their upload directories are
+# removed by the `AbandonedUploadSweeper`.
+UPLOAD_ABANDONED_AGE = 7 * 24 * 60 * 60
+
 # The maximum size of a request message.  This is constrained to prevent us
 # from being swamped by clients trying to upload large files in one request.
 MAX_CONTENT_LENGTH = (1 * 1024 * 1024) + (512 * 1024)
 
+# The number of threads on which the queries for a sample search are run.
+# The pool is shared by all requests, so this bounds the number of search
+# queries that are in progress at any one time.
+RESOLVER_THREADS = 6
+
+# Parts that are sent as the raw body of a PUT to `/upload-part/...` are
+# streamed straight to disk, in blocks of `UPLOAD_WRITE_BLOCKSIZE` bytes, and
+# so aren't constrained by `MAX_CONTENT_LENGTH`.  Clients are advised to use
+# parts of `UPLOAD_CHUNK_SIZE` bytes; since the last part of a file also takes
+# the remainder, parts may be up to twice that size.
+UPLOAD_CHUNK_SIZE = 64 * 1024 * 1024
+MAX_PART_CONTENT_LENGTH = 2 * UPLOAD_CHUNK_SIZE
+UPLOAD_WRITE_BLOCKSIZE = 1024 * 1024
+
+# Files are hashed and copied `FILE_READ_BLOCKSIZE` bytes at a time, either by
+# reading them into a buffer (`'read'`) or by mapping them into memory
+# (`'mmap'`); cf. `app.file.FileProcessor`.
+FILE_READ_BLOCKSIZE = 1024 * 1024
+FILE_READ_MODE = 'read'
+
+# Archived files are served at `/dl`.  They may be handed off to the web server
+# in front of the app by setting `DOWNLOAD_OFFLOAD` to `'x-sendfile'` (e.g. for
+# Apache's mod_xsendfile), or to `'x-accel-redirect'` for nginx, in which case
+# `DOWNLOAD_ACCEL_PREFIX` must be an internal location that maps to
+# `STORE_PATH`.  Otherwise the app serves them itself, reading ranges of files
+# `DOWNLOAD_BLOCKSIZE` bytes at a time; cf. `app.download`.
+DOWNLOAD_OFFLOAD = None
+DOWNLOAD_ACCEL_PREFIX = '/store/'
+DOWNLOAD_BLOCKSIZE = 1024 * 1024
+
+# The default and maximum number of resources in a page of a collection.
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
 BASEDIR = os.path.abspath(os.path.dirname(__file__))
-SQLALCHEMY_DATABASE_URI = 'sqlite:////var/db/sagittariidae/sagittariidae.db'
+# The database may be SQLite or, for more than one concurrent writer (e.g. web
+# processes on more than one host), PostgreSQL, e.g.
+# `postgresql://sagittariidae@dbhost/sagittariidae`.
+SQLALCHEMY_DATABASE_URI = os.environ.get(
+    'SAGITTARIIDAE_DATABASE_URI', 'sqlite:////var/db/sagittariidae/sagittariidae.db')
 SQLALCHEMY_MIGRATE_REPO = '/var/db/sagittariidae/db_repository'
+
+# Connections to a database server are pooled, per process.  (SQLite
+# connections aren't, since they can't be shared between threads.)  Each
+# process holds up to `SQLALCHEMY_POOL_SIZE` connections open, and opens up to
+# `SQLALCHEMY_MAX_OVERFLOW` more when they're all in use; connections are
+# reopened after `SQLALCHEMY_POOL_RECYCLE` seconds, so that they survive the
+# server closing idle ones.
+if not SQLALCHEMY_DATABASE_URI.startswith('sqlite'):
+    SQLALCHEMY_POOL_SIZE = 10
+    SQLALCHEMY_MAX_OVERFLOW = 10
+    SQLALCHEMY_POOL_TIMEOUT = 30
+    SQLALCHEMY_POOL_RECYCLE = 3600
+
+# Applied to every new SQLite connection, in order; cf. `app.database`.  The
+# write-ahead log lets readers and a writer use the database at once, and
+# needs only `NORMAL` synchronisation to remain consistent; a connection
+# waits for up to `busy_timeout` milliseconds for a lock.  `mmap_size` is in
+# bytes; a negative `cache_size` is in KiB.
+SQLITE_PRAGMAS = [('journal_mode', 'WAL'),
+                  ('busy_timeout', 10000),
+                  ('synchronous',  'NORMAL'),
+                  ('mmap_size',    256 * 1024 * 1024),
+                  ('cache_size',   -64 * 1024)]
+
+# A transaction that fails because the database is locked is retried up to
+# `DB_BUSY_RETRIES` times, backing off exponentially from `DB_BUSY_BACKOFF`
+# seconds.
+DB_BUSY_RETRIES = 5
+DB_BUSY_BACKOFF = 0.05
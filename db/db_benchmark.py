@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# Measures the throughput of concurrent readers and writers of a scratch SQLite
+# database, with SQLite's default settings and with the `SQLITE_PRAGMAS` that
+# the app applies to its connections (cf. `app.database`).  The readers list
+# files, as the web app does; the writers claim files and update them, as the
+# sweepers do, each in a process of its own.
+#
+#   python db_benchmark.py [readers] [writers] [seconds]
+
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.append('..')
+from config import SQLITE_PRAGMAS
+
+ROWS = 10000
+
+
+def connect(fn, pragmas):
+    conn = sqlite3.connect(fn)
+    for name, value in pragmas:
+        conn.execute('PRAGMA %s = %s' % (name, value))
+    return conn
+
+
+def setup(fn, pragmas):
+    conn = connect(fn, pragmas)
+    conn.execute('CREATE TABLE sample_stage_file '
+                 '(id INTEGER PRIMARY KEY, status TEXT, claimed_by TEXT, modified_ts TIMESTAMP)')
+    conn.executemany('INSERT INTO sample_stage_file (status) VALUES (?)',
+                     [('staged',)] * ROWS)
+    conn.commit()
+    conn.close()
+
+
+def read(conn):
+    conn.execute('SELECT * FROM sample_stage_file WHERE id > ? ORDER BY id LIMIT 100',
+                 (random.randint(0, ROWS),)).fetchall()
+
+
+def write(conn):
+    ids = [r[0] for r in conn.execute(
+        'SELECT id FROM sample_stage_file WHERE id > ? ORDER BY id LIMIT 10',
+        (random.randint(0, ROWS),))]
+    conn.executemany("UPDATE sample_stage_file SET claimed_by = ?, modified_ts = datetime('now') "
+                     'WHERE id = ?', [(str(os.getpid()), i) for i in ids])
+    conn.commit()
+
+
+def worker(args):
+    fn, pragmas, op, seconds = args
+    conn = connect(fn, pragmas)
+    done = errors = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        try:
+            op(conn)
+            done += 1
+        except sqlite3.OperationalError:
+            conn.rollback()
+            errors += 1
+    conn.close()
+    return op.__name__, done, errors
+
+
+def run(pragmas, readers, writers, seconds):
+    d = tempfile.mkdtemp()
+    try:
+        fn = os.path.join(d, 'benchmark.db')
+        setup(fn, pragmas)
+        pool = multiprocessing.Pool(readers + writers)
+        results = pool.map(worker, [(fn, pragmas, read, seconds)] * readers +
+                                   [(fn, pragmas, write, seconds)] * writers)
+        pool.close()
+        totals = {'read': [0, 0], 'write': [0, 0]}
+        for op, done, errors in results:
+            totals[op][0] += done
+            totals[op][1] += errors
+        return totals
+    finally:
+        shutil.rmtree(d)
+
+
+if __name__ == '__main__':
+    readers, writers, seconds = (map(int, sys.argv[1:4]) + [4, 2, 10][len(sys.argv[1:4]):])
+    print('%d readers, %d writers, %d seconds' % (readers, writers, seconds))
+    print('%-8s %12s %12s %12s %12s' % ('', 'reads/s', 'read errors', 'writes/s', 'write errors'))
+    for name, pragmas in [('default', []), ('tuned', SQLITE_PRAGMAS)]:
+        totals = run(pragmas, readers, writers, seconds)
+        print('%-8s %12.1f %12d %12.1f %12d' % (
+            name,
+            totals['read'][0] / float(seconds), totals['read'][1],
+            totals['write'][0] / float(seconds), totals['write'][1]))
@@ -0,0 +1,16 @@
+from sqlalchemy import *
+from migrate import *
+
+
+def upgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    sample_stage_file = Table('sample_stage_file', meta, autoload=True)
+    Column('claimed_by', String(64)).create(sample_stage_file)
+    Column('claimed_until', TIMESTAMP).create(sample_stage_file)
+
+
+def downgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    sample_stage_file = Table('sample_stage_file', meta, autoload=True)
+    sample_stage_file.c.claimed_until.drop()
+    sample_stage_file.c.claimed_by.drop()
@@ -0,0 +1,35 @@
+from sqlalchemy import *
+from sqlalchemy.exc import OperationalError
+from migrate import *
+
+
+def upgrade(migrate_engine):
+    if migrate_engine.dialect.name != 'sqlite':
+        return
+    try:
+        migrate_engine.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS sample_search
+            USING fts5(name, methods, annotations, project_id UNINDEXED, tokenize='trigram')
+            """)
+    except OperationalError:
+        # The trigram tokenizer needs SQLite 3.34, built with FTS5; without
+        # it, there's no index, and searches scan the tables.
+        return
+    migrate_engine.execute("""
+        INSERT INTO sample_search(rowid, name, methods, annotations, project_id)
+        SELECT sample.id,
+               sample.name,
+               coalesce(group_concat(method.name, ' '), ''),
+               coalesce(group_concat(sample_stage.annotation, ' '), ''),
+               sample.project_id
+        FROM sample
+        LEFT JOIN sample_stage ON sample_stage.sample_id = sample.id
+        LEFT JOIN method ON method.id = sample_stage.method_id
+        GROUP BY sample.id
+        """)
+
+
+def downgrade(migrate_engine):
+    if migrate_engine.dialect.name != 'sqlite':
+        return
+    migrate_engine.execute('DROP TABLE IF EXISTS sample_search')
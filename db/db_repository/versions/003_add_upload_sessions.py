@@ -0,0 +1,39 @@
+from sqlalchemy import *
+from migrate import *
+
+
+meta = MetaData()
+
+sample_stage = Table('sample_stage', meta,
+                     Column('id', Integer, primary_key=True))
+
+# The status shares its type with that of `sample_stage_file`, which PostgreSQL
+# requires to be named.  The type belongs to the metadata, rather than to the
+# table, so that it is neither created nor dropped with the table.
+upload_session = Table(
+    'upload_session', meta,
+    Column('id', Integer, primary_key=True),
+    Column('obfuscated_id', String(15), unique=True),
+    Column('identifier', String(255), unique=True),
+    Column('total_size', BigInteger),
+    Column('chunk_size', Integer),
+    Column('total_parts', Integer),
+    Column('checksum_method', String(32)),
+    Column('received_parts', Text),
+    Column('received_count', Integer),
+    Column('status', Enum('prepared', 'staged', 'archived', 'cleaned', 'complete',
+                          name='file_status', metadata=meta)),
+    Column('created_ts', DateTime(timezone=True), server_default=func.now()),
+    Column('modified_ts', DateTime(timezone=True), server_default=func.now()),
+    Column('sample_stage_id', Integer, ForeignKey('sample_stage.id')),
+    Index('ix_upload_session_status_modified_ts', 'status', 'modified_ts'))
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    upload_session.create()
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    upload_session.drop()
@@ -0,0 +1,16 @@
+from sqlalchemy import *
+from migrate import *
+
+
+def upgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    sample_stage_file = Table('sample_stage_file', meta, autoload=True)
+    Column('checksum_method', String(32)).create(sample_stage_file)
+    Column('checksum_value', String(128)).create(sample_stage_file)
+
+
+def downgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    sample_stage_file = Table('sample_stage_file', meta, autoload=True)
+    sample_stage_file.c.checksum_value.drop()
+    sample_stage_file.c.checksum_method.drop()
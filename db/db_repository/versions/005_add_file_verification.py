@@ -0,0 +1,16 @@
+from sqlalchemy import *
+from migrate import *
+
+
+def upgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    sample_stage_file = Table('sample_stage_file', meta, autoload=True)
+    Column('verified_ts', TIMESTAMP).create(sample_stage_file)
+    Column('verify_error', Text).create(sample_stage_file)
+
+
+def downgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    sample_stage_file = Table('sample_stage_file', meta, autoload=True)
+    sample_stage_file.c.verify_error.drop()
+    sample_stage_file.c.verified_ts.drop()
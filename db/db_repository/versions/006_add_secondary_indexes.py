@@ -0,0 +1,27 @@
+from sqlalchemy import *
+from migrate import *
+
+
+INDEXES = [('sample',            'ix_sample_project_id_id',                 ['project_id', 'id']),
+           ('sample_stage',      'ix_sample_stage_sample_id_id',            ['sample_id', 'id']),
+           ('sample_stage',      'ix_sample_stage_method_id',               ['method_id']),
+           ('sample_stage_file', 'ix_sample_stage_file_sample_stage_id_id', ['sample_stage_id', 'id']),
+           ('sample_stage_file', 'ix_sample_stage_file_status_modified_ts', ['status', 'modified_ts']),
+           ('upload_session',    'ix_upload_session_sample_stage_id',       ['sample_stage_id'])]
+
+
+def indexes(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    for table_name, name, columns in INDEXES:
+        table = Table(table_name, meta, autoload=True)
+        yield Index(name, *[table.c[c] for c in columns])
+
+
+def upgrade(migrate_engine):
+    for index in indexes(migrate_engine):
+        index.create()
+
+
+def downgrade(migrate_engine):
+    for index in indexes(migrate_engine):
+        index.drop()
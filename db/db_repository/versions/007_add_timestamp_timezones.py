@@ -0,0 +1,34 @@
+from sqlalchemy import *
+from migrate import *
+
+
+# The timestamps are in UTC, and are stored with their timezone.  SQLite has no
+# timestamp type to change, but on PostgreSQL the columns of a database that
+# was created without the timezone are converted, on the understanding that
+# the timestamps in them are in UTC.
+TIMESTAMPS = [('sample',            ['created_ts']),
+              ('sample_stage',      ['created_ts']),
+              ('sample_stage_file', ['created_ts', 'modified_ts', 'claimed_until', 'verified_ts']),
+              ('upload_session',    ['created_ts', 'modified_ts'])]
+
+
+def convert(migrate_engine, timezone):
+    if migrate_engine.name != 'postgresql':
+        return
+    meta = MetaData(bind=migrate_engine)
+    for table_name, columns in TIMESTAMPS:
+        table = Table(table_name, meta, autoload=True)
+        for name in columns:
+            if table.c[name].type.timezone == timezone:
+                continue
+            migrate_engine.execute(
+                "ALTER TABLE %s ALTER COLUMN %s TYPE TIMESTAMP %s TIME ZONE USING %s AT TIME ZONE 'UTC'"
+                % (table_name, name, 'WITH' if timezone else 'WITHOUT', name))
+
+
+def upgrade(migrate_engine):
+    convert(migrate_engine, True)
+
+
+def downgrade(migrate_engine):
+    convert(migrate_engine, False)
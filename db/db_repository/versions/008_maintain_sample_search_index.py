@@ -0,0 +1,63 @@
+from sqlalchemy import *
+from migrate import *
+
+
+# The search index was only written to as samples and stages were added, and
+# joined the methods and annotations of a sample's stages with spaces.  It's
+# repopulated with the fields joined by a separator that can't be searched for
+# (U+001F), and maintained by triggers from then on.  There's nothing to do if
+# the store doesn't support the index (cf. 002).
+POPULATE = """
+    INSERT INTO sample_search(rowid, name, methods, annotations, project_id)
+    SELECT sample.id,
+           sample.name,
+           coalesce(group_concat(method.name, %(separator)s), ''),
+           coalesce(group_concat(sample_stage.annotation, %(separator)s), ''),
+           sample.project_id
+    FROM sample
+    LEFT JOIN sample_stage ON sample_stage.sample_id = sample.id
+    LEFT JOIN method ON method.id = sample_stage.method_id
+    WHERE %(samples)s
+    GROUP BY sample.id
+    """
+
+TRIGGERS = [
+    ('sample_search_sample_insert', 'INSERT ON sample', 'new.id'),
+    ('sample_search_sample_update', 'UPDATE OF name, project_id ON sample', 'old.id, new.id'),
+    ('sample_search_sample_delete', 'DELETE ON sample', 'old.id'),
+    ('sample_search_stage_insert', 'INSERT ON sample_stage', 'new.sample_id'),
+    ('sample_search_stage_update', 'UPDATE OF sample_id, method_id, annotation ON sample_stage',
+     'old.sample_id, new.sample_id'),
+    ('sample_search_stage_delete', 'DELETE ON sample_stage', 'old.sample_id'),
+    ('sample_search_method_update', 'UPDATE OF name ON method',
+     'SELECT sample_id FROM sample_stage WHERE method_id = new.id')]
+
+
+def repopulate(migrate_engine, separator):
+    migrate_engine.execute('DELETE FROM sample_search')
+    migrate_engine.execute(POPULATE % {'separator' : separator, 'samples' : '1'})
+
+
+def has_index(migrate_engine):
+    return migrate_engine.dialect.name == 'sqlite' and migrate_engine.has_table('sample_search')
+
+
+def upgrade(migrate_engine):
+    if not has_index(migrate_engine):
+        return
+    repopulate(migrate_engine, 'char(31)')
+    for name, when, samples in TRIGGERS:
+        migrate_engine.execute(
+            'CREATE TRIGGER IF NOT EXISTS %s AFTER %s BEGIN '
+            'DELETE FROM sample_search WHERE rowid IN (%s); %s; END'
+            % (name, when, samples,
+               POPULATE % {'separator' : 'char(31)',
+                           'samples'   : 'sample.id IN (%s)' % samples}))
+
+
+def downgrade(migrate_engine):
+    if not has_index(migrate_engine):
+        return
+    for name, _, _ in TRIGGERS:
+        migrate_engine.execute('DROP TRIGGER IF EXISTS %s' % name)
+    repopulate(migrate_engine, "' '")
@@ -25,6 +25,10 @@ def ws(request):
     def fin():
         os.close(fd)
         os.unlink(fn)
+        # The write-ahead log, and its index; cf. `app.database`.
+        for suffix in ['-wal', '-shm']:
+            if os.path.exists(fn + suffix):
+                os.unlink(fn + suffix)
     request.addfinalizer(fin)
     return inst
 
@@ -1,8 +1,21 @@
 
+import contextlib
+import glob
+import hashlib
 import json
+import os
+import pytest
+import tarfile
 
-from app      import models, http
-from fixtures import sample, sample_with_stages, ws
+from sqlalchemy import event
+
+from StringIO import StringIO
+from urllib   import urlencode
+
+import app as sagittariidae
+
+from app      import assembler, checksum, models, http
+from fixtures import sample, sample_with_stages, storepath, tmpdir, ws
 from utils    import decode_json_string
 
 
@@ -121,3 +134,628 @@ def test_get_method(ws, sample_with_stages):
 def test_method_not_found(ws, sample_with_stages):
     rsp = ws.get('/methods/invalid-method')
     assert 404 == rsp.status_code
+
+
+def upload_part(ws, identifier, part_number, chunks, chunk_size, **kw):
+    data = {'file'                 : (StringIO(chunks[part_number-1]), 'blob'),
+            'resumableChunkNumber' : str(part_number),
+            'resumableTotalChunks' : str(len(chunks)),
+            'resumableChunkSize'   : str(chunk_size),
+            'resumableTotalSize'   : str(sum(map(len, chunks))),
+            'resumableIdentifier'  : identifier}
+    data.update(kw)
+    return ws.post('/upload-part', data=data)
+
+
+def complete_upload(ws, identifier, checksum_value, stage, method='sha256'):
+    return ws.post('/complete-multipart-upload',
+                   data=json.dumps({'upload-id'       : identifier,
+                                    'file-name'       : 'data.txrm',
+                                    'project'         : 'PqrX9',
+                                    'sample'          : 'OQn6Q',
+                                    'sample-stage'    : stage,
+                                    'checksum-method' : method,
+                                    'checksum-value'  : checksum_value}),
+                   content_type='application/json')
+
+
+def test_upload_parts_out_of_order(ws, storepath, sample_with_stages):
+    stage = sample_with_stages['stages'][0].obfuscated_id
+    chunks = ['aaaa', 'bbbb', 'cc']
+    upload_dir = os.path.join(storepath, 'upload', 'upload-1')
+    assembly = os.path.join(upload_dir, '.assembly')
+
+    assert http.HTTP_200_OK == upload_part(ws, 'upload-1', 2, chunks, 4).status_code
+    assert 0 == os.path.getsize(assembly)
+    assert http.HTTP_200_OK == upload_part(ws, 'upload-1', 1, chunks, 4).status_code
+    assert 'aaaabbbb' == open(assembly).read()
+    assert not os.path.exists(os.path.join(upload_dir, '1.part'))
+    assert http.HTTP_200_OK == upload_part(ws, 'upload-1', 3, chunks, 4).status_code
+
+    rsp = complete_upload(ws, 'upload-1', hashlib.sha256(''.join(chunks)).hexdigest(), stage)
+    assert http.HTTP_202_ACCEPTED == rsp.status_code
+    assert 'aaaabbbbcc' == open(os.path.join(upload_dir, 'data.txrm')).read()
+    assert not os.path.exists(assembly)
+
+
+def test_complete_upload_with_missing_part(ws, storepath, sample_with_stages):
+    stage = sample_with_stages['stages'][0].obfuscated_id
+    chunks = ['aaaa', 'bbbb', 'cc']
+    upload_part(ws, 'upload-2', 1, chunks, 4)
+    upload_part(ws, 'upload-2', 3, chunks, 4)
+    rsp = complete_upload(ws, 'upload-2', hashlib.sha256(''.join(chunks)).hexdigest(), stage)
+    assert http.HTTP_409_CONFLICT == rsp.status_code
+
+
+def test_complete_upload_with_bad_checksum(ws, storepath, sample_with_stages):
+    stage = sample_with_stages['stages'][0].obfuscated_id
+    chunks = ['aaaa', 'bb']
+    upload_part(ws, 'upload-3', 1, chunks, 4)
+    upload_part(ws, 'upload-3', 2, chunks, 4)
+    rsp = complete_upload(ws, 'upload-3', hashlib.sha256('wrong').hexdigest(), stage)
+    assert http.HTTP_422_UNPROCESSABLE_ENTITY == rsp.status_code
+
+
+def test_complete_upload_after_restart(ws, storepath, sample_with_stages):
+    stage = sample_with_stages['stages'][0].obfuscated_id
+    chunks = ['aaaa', 'bbbb', 'cc']
+    upload_dir = os.path.join(storepath, 'upload', 'upload-4')
+    upload_part(ws, 'upload-4', 1, chunks, 4)
+    upload_part(ws, 'upload-4', 3, chunks, 4)
+    upload_part(ws, 'upload-4', 2, chunks, 4)
+
+    # Forget the in-memory state, as if the service had been restarted.
+    assembler._discard_assembly_(upload_dir)
+
+    rsp = complete_upload(ws, 'upload-4', hashlib.sha256(''.join(chunks)).hexdigest(), stage)
+    assert http.HTTP_202_ACCEPTED == rsp.status_code
+    sidecar = json.load(open(os.path.join(upload_dir, 'data.txrm.checksum')))
+    leaves = [hashlib.sha256(c).digest() for c in chunks]
+    root = hashlib.sha256(hashlib.sha256(leaves[0] + leaves[1]).digest() + leaves[2]).hexdigest()
+    assert root == sidecar['parts']['root']
+
+
+def test_complete_upload_after_interrupted_append(ws, storepath, sample_with_stages):
+    # The last part may be longer than the chunk size, and so a file that ends
+    # on a chunk boundary needn't be complete.
+    stage = sample_with_stages['stages'][0].obfuscated_id
+    chunks = ['aaaa', 'bbbb', 'cccccc']
+    upload_dir = os.path.join(storepath, 'upload', 'upload-14')
+    for n in [1, 2, 3]:
+        upload_part(ws, 'upload-14', n, chunks, 4)
+
+    # As if the service had been restarted part way through appending part 3.
+    with open(os.path.join(upload_dir, '3.part'), 'w') as f:
+        f.write(chunks[2])
+    with open(os.path.join(upload_dir, '.assembly'), 'r+') as f:
+        f.truncate(12)
+    assembler._discard_assembly_(upload_dir)
+
+    rsp = complete_upload(ws, 'upload-14', hashlib.sha256(''.join(chunks)).hexdigest(), stage)
+    assert http.HTTP_202_ACCEPTED == rsp.status_code
+    assert ''.join(chunks) == open(os.path.join(upload_dir, 'data.txrm')).read()
+
+
+def test_assembly_is_shared_between_processes(tmpdir):
+    # Every process has an assembly of its own, and they share its state
+    # through the upload directory.
+    chunks = ['aaaa', 'bbbb', 'cccccc']
+    a = assembler.get_assembly(tmpdir, 3, 4, 14)
+    assembler._discard_assembly_(tmpdir)
+    b = assembler.get_assembly(tmpdir)
+    assert a is not b
+
+    a.save_part(1, StringIO(chunks[0]))
+    assert 2 == a.advance()
+    # Part 1 is retried, and received by the other process.
+    b.save_part(1, StringIO(chunks[0]))
+    assert not os.path.exists(b.part_path(1))
+    b.save_part(2, StringIO(chunks[1]))
+    assert 3 == b.advance()
+    a.save_part(3, StringIO(chunks[2]))
+    assert 4 == a.advance()
+
+    assert ''.join(chunks) == open(a.target_path).read()
+    digest = hashlib.sha256(''.join(chunks)).hexdigest()
+    assert digest == a.finalize('sha256')
+    assert digest == b.finalize('sha256')
+    assert b.has_part(1, 4, hashlib.sha256(chunks[0]).hexdigest())
+
+
+def test_overlapping_copies_of_a_part(tmpdir):
+    # A part is retried while the first copy of it is still being received.
+    chunks = ['aaaa', 'bbbb', 'cccccc']
+    a = assembler.get_assembly(tmpdir, 3, 4, 14)
+
+    class Retried(object):
+        def __init__(self, data):
+            self.stream = StringIO(data)
+            self.retried = False
+        def read(self, n):
+            if not self.retried:
+                self.retried = True
+                a.save_part(2, StringIO(chunks[1]))
+            return self.stream.read(n)
+
+    a.save_part(2, Retried(chunks[1]), blocksize=2)
+    assert [] == glob.glob(os.path.join(tmpdir, '*.tmp'))
+    assert chunks[1] == open(a.part_path(2)).read()
+    a.save_part(1, StringIO(chunks[0]))
+    a.save_part(3, StringIO(chunks[2]))
+    assert 4 == a.advance()
+    assert hashlib.sha256(''.join(chunks)).hexdigest() == a.finalize('sha256')
+
+
+@pytest.mark.parametrize('leaf_size', [4, 3])
+def test_complete_upload_with_tree_checksum(ws, storepath, sample_with_stages, monkeypatch, leaf_size):
+    # When the leaves of the tree hash are the parts, the checksum is computed
+    # from the digests of the parts; otherwise from the file.
+    monkeypatch.setattr(checksum, 'TREE_LEAF_SIZE', leaf_size)
+    stage = sample_with_stages['stages'][0].obfuscated_id
+    chunks = ['aaaa', 'bbbb', 'cc']
+    for n in [1, 2, 3]:
+        upload_part(ws, 'upload-tree-%d' % leaf_size, n, chunks, 4)
+    digester = checksum.TreeDigester('sha256', leaf_size)
+    digester.update(''.join(chunks))
+    rsp = complete_upload(ws, 'upload-tree-%d' % leaf_size, digester.hexdigest(), stage, 'sha256-tree')
+    assert http.HTTP_202_ACCEPTED == rsp.status_code
+
+
+def test_corrupted_part_is_discarded(ws, storepath, sample_with_stages):
+    stage = sample_with_stages['stages'][0].obfuscated_id
+    chunks = ['aaaa', 'bbbb', 'cc']
+    upload_dir = os.path.join(storepath, 'upload', 'upload-5')
+    upload_part(ws, 'upload-5', 2, chunks, 4)
+    with open(os.path.join(upload_dir, '2.part'), 'w') as f:
+        f.write('xxxx')
+
+    # The part that was corrupted after it was received is discarded, without
+    # failing the request for some other part, and has to be sent again.
+    assert http.HTTP_200_OK == upload_part(ws, 'upload-5', 1, chunks, 4).status_code
+    assert 'aaaa' == open(os.path.join(upload_dir, '.assembly')).read()
+    assert not os.path.exists(os.path.join(upload_dir, '2.part'))
+    assert http.HTTP_204_NO_CONTENT == probe_part(ws, 'upload-5', 2, chunks, 4)
+
+    checksum_value = hashlib.sha256(''.join(chunks)).hexdigest()
+    upload_part(ws, 'upload-5', 3, chunks, 4)
+    assert http.HTTP_409_CONFLICT == complete_upload(ws, 'upload-5', checksum_value, stage).status_code
+    upload_part(ws, 'upload-5', 2, chunks, 4)
+    assert http.HTTP_202_ACCEPTED == complete_upload(ws, 'upload-5', checksum_value, stage).status_code
+
+
+def test_part_is_checked_as_it_is_received(ws, storepath, sample_with_stages):
+    chunks = ['aaaa', 'bbbb', 'cc']
+    upload_dir = os.path.join(storepath, 'upload', 'upload-15')
+    digests = [hashlib.sha256(c).hexdigest() for c in chunks]
+
+    rsp = upload_part(ws, 'upload-15', 2, chunks, 4, **{'chunk-checksum': digests[0]})
+    assert http.HTTP_422_UNPROCESSABLE_ENTITY == rsp.status_code
+    assert http.HTTP_200_OK == \
+        upload_part(ws, 'upload-15', 2, chunks, 4, **{'chunk-checksum': digests[1]}).status_code
+    assert http.HTTP_200_OK == upload_part(ws, 'upload-15', 1, chunks, 4).status_code
+    assert 'aaaabbbb' == open(os.path.join(upload_dir, '.assembly')).read()
+
+    # A part that has already been appended isn't saved again, but must be the
+    # same as it was.
+    assert http.HTTP_200_OK == upload_part(ws, 'upload-15', 1, chunks, 4).status_code
+    assert http.HTTP_422_UNPROCESSABLE_ENTITY == \
+        upload_part(ws, 'upload-15', 1, ['xxxx', 'bbbb', 'cc'], 4).status_code
+    assert [] == glob.glob(os.path.join(upload_dir, '*.part*'))
+    assert 'aaaabbbb' == open(os.path.join(upload_dir, '.assembly')).read()
+
+
+def probe_part(ws, identifier, part_number, chunks, chunk_size, **kw):
+    args = {'resumableChunkNumber' : str(part_number),
+            'resumableTotalChunks' : str(len(chunks)),
+            'resumableChunkSize'   : str(chunk_size),
+            'resumableTotalSize'   : str(sum(map(len, chunks))),
+            'resumableIdentifier'  : identifier}
+    args.update(kw)
+    return ws.get('/upload-part?' + urlencode(args)).status_code
+
+
+def test_probe_upload_part(ws, storepath, sample_with_stages):
+    chunks = ['aaaa', 'bbbb', 'cc']
+    assert http.HTTP_204_NO_CONTENT == probe_part(ws, 'upload-6', 1, chunks, 4)
+
+    # Probing an upload doesn't start it.
+    upload_dir = os.path.join(storepath, 'upload', 'upload-6')
+    os.makedirs(upload_dir)
+    assert http.HTTP_204_NO_CONTENT == probe_part(ws, 'upload-6', 1, chunks, 4)
+    assert [] == os.listdir(upload_dir)
+
+    upload_part(ws, 'upload-6', 2, chunks, 4)
+    assert http.HTTP_204_NO_CONTENT == probe_part(ws, 'upload-6', 1, chunks, 4)
+    assert http.HTTP_200_OK == probe_part(ws, 'upload-6', 2, chunks, 4)
+    assert http.HTTP_200_OK == probe_part(ws, 'upload-6', 2, chunks, 4,
+                                          resumableCurrentChunkSize='4')
+    assert http.HTTP_204_NO_CONTENT == probe_part(ws, 'upload-6', 2, chunks, 4,
+                                                  resumableCurrentChunkSize='3')
+    assert http.HTTP_200_OK == probe_part(ws, 'upload-6', 2, chunks, 4,
+                                          **{'chunk-checksum': hashlib.sha256('bbbb').hexdigest()})
+    assert http.HTTP_204_NO_CONTENT == probe_part(ws, 'upload-6', 2, chunks, 4,
+                                                  **{'chunk-checksum': hashlib.sha256('xxxx').hexdigest()})
+
+    # Parts that have been appended to the reassembled file are still here.
+    upload_part(ws, 'upload-6', 1, chunks, 4)
+    assert http.HTTP_200_OK == probe_part(ws, 'upload-6', 1, chunks, 4)
+    assert http.HTTP_200_OK == probe_part(ws, 'upload-6', 2, chunks, 4,
+                                          resumableCurrentChunkSize='4')
+    assert http.HTTP_204_NO_CONTENT == probe_part(ws, 'upload-6', 3, chunks, 4)
+
+
+def test_probe_upload_part_with_bad_arguments(ws, storepath, sample_with_stages):
+    chunks = ['aaaa', 'bbbb', 'cc']
+    upload_part(ws, 'upload-16', 1, chunks, 4)
+    for part_number in ['x', '']:
+        assert http.HTTP_400_BAD_REQUEST == probe_part(ws, 'upload-16', part_number, chunks, 4)
+    assert http.HTTP_400_BAD_REQUEST == probe_part(ws, 'upload-16', 1, chunks, 4,
+                                                   resumableCurrentChunkSize='x')
+    assert http.HTTP_400_BAD_REQUEST == \
+        ws.get('/upload-part?' + urlencode({'resumableIdentifier' : 'upload-16'})).status_code
+    assert http.HTTP_400_BAD_REQUEST == \
+        ws.get('/upload-part?' + urlencode({'resumableChunkNumber' : '1'})).status_code
+
+
+def stream_part(ws, identifier, part_number, chunks, chunk_size):
+    args = {'resumableTotalChunks' : str(len(chunks)),
+            'resumableChunkSize'   : str(chunk_size),
+            'resumableTotalSize'   : str(sum(map(len, chunks)))}
+    return ws.put('/upload-part/%s/%d?%s' % (identifier, part_number, urlencode(args)),
+                  data=chunks[part_number-1],
+                  content_type='application/octet-stream')
+
+
+def test_stream_upload_parts(ws, storepath, sample_with_stages):
+    stage = sample_with_stages['stages'][0].obfuscated_id
+    rsp = ws.get('/upload-parameters')
+    assert http.HTTP_200_OK == rsp.status_code
+    params = decode_json_string(rsp.data)
+    assert params['max-part-size'] >= params['chunk-size']
+
+    # Parts streamed in the body of the request aren't subject to the limit on
+    # the size of form data.
+    chunk_size = sagittariidae.app.app.config['MAX_CONTENT_LENGTH'] + 1
+    chunks = ['a' * chunk_size, 'b' * chunk_size, 'c' * 10]
+    upload_dir = os.path.join(storepath, 'upload', 'upload-7')
+    assert http.HTTP_200_OK == stream_part(ws, 'upload-7', 3, chunks, chunk_size).status_code
+    assert http.HTTP_200_OK == stream_part(ws, 'upload-7', 1, chunks, chunk_size).status_code
+    assert http.HTTP_200_OK == stream_part(ws, 'upload-7', 2, chunks, chunk_size).status_code
+
+    rsp = complete_upload(ws, 'upload-7', hashlib.sha256(''.join(chunks)).hexdigest(), stage)
+    assert http.HTTP_202_ACCEPTED == rsp.status_code
+    assert ''.join(chunks) == open(os.path.join(upload_dir, 'data.txrm')).read()
+
+
+def test_stream_upload_part_too_large(ws, storepath):
+    limit = sagittariidae.app.app.config['MAX_PART_CONTENT_LENGTH']
+    sagittariidae.app.app.config['MAX_PART_CONTENT_LENGTH'] = 4
+    try:
+        rsp = stream_part(ws, 'upload-8', 1, ['aaaaa'], 5)
+        assert http.HTTP_413_REQUEST_ENTITY_TOO_LARGE == rsp.status_code
+    finally:
+        sagittariidae.app.app.config['MAX_PART_CONTENT_LENGTH'] = limit
+
+
+def prepare_upload(ws, identifier, chunks, chunk_size, stage, method='sha256'):
+    return ws.post('/prepare-multipart-upload',
+                   data=json.dumps({'upload-id'       : identifier,
+                                    'sample-stage'    : stage,
+                                    'checksum-method' : method,
+                                    'total-parts'     : len(chunks),
+                                    'chunk-size'      : chunk_size,
+                                    'total-size'      : sum(map(len, chunks))}),
+                   content_type='application/json')
+
+
+def test_prepared_upload(ws, storepath, sample_with_stages):
+    stage = sample_with_stages['stages'][0].obfuscated_id
+    chunks = ['aaaa', 'bbbb', 'cc']
+    upload_dir = os.path.join(storepath, 'upload', 'upload-9')
+    assembly = os.path.join(upload_dir, '.assembly')
+
+    assert http.HTTP_201_CREATED == prepare_upload(ws, 'upload-9', chunks, 4, stage).status_code
+    assert 10 == os.path.getsize(assembly)
+    # Preparing the same upload again is harmless.
+    assert http.HTTP_201_CREATED == prepare_upload(ws, 'upload-9', chunks, 4, stage).status_code
+
+    # Parts are written into place, whatever the order in which they arrive.
+    assert http.HTTP_200_OK == upload_part(ws, 'upload-9', 3, chunks, 4).status_code
+    assert http.HTTP_200_OK == stream_part(ws, 'upload-9', 2, chunks, 4).status_code
+    assert [] == glob.glob(os.path.join(upload_dir, '*.part*'))
+    assert http.HTTP_200_OK == probe_part(ws, 'upload-9', 2, chunks, 4)
+    assert http.HTTP_204_NO_CONTENT == probe_part(ws, 'upload-9', 1, chunks, 4)
+    assert '\0\0\0\0bbbbcc' == open(assembly).read()
+
+    # A part of the wrong size would corrupt its neighbours.
+    rsp = upload_part(ws, 'upload-9', 1, ['aaa', 'bbbb', 'cc'], 4)
+    assert http.HTTP_400_BAD_REQUEST == rsp.status_code
+
+    # The assembly survives a restart.
+    assembler._discard_assembly_(upload_dir)
+    assert http.HTTP_200_OK == upload_part(ws, 'upload-9', 1, chunks, 4).status_code
+    rsp = complete_upload(ws, 'upload-9', hashlib.sha256(''.join(chunks)).hexdigest(), stage)
+    assert http.HTTP_202_ACCEPTED == rsp.status_code
+    assert 'aaaabbbbcc' == open(os.path.join(upload_dir, 'data.txrm')).read()
+
+
+def test_prepare_started_upload(ws, storepath, sample_with_stages):
+    stage = sample_with_stages['stages'][0].obfuscated_id
+    chunks = ['aaaa', 'bbbb', 'cc']
+    upload_part(ws, 'upload-10', 1, chunks, 4)
+    assert http.HTTP_409_CONFLICT == prepare_upload(ws, 'upload-10', chunks, 4, stage).status_code
+
+
+def test_prepared_upload_session(ws, storepath, sample_with_stages):
+    stage, other_stage = [s.obfuscated_id for s in sample_with_stages['stages']]
+    chunks = ['aaaa', 'bbbb', 'cc']
+    assert http.HTTP_201_CREATED == prepare_upload(ws, 'upload-11', chunks, 4, stage).status_code
+    assert http.HTTP_409_CONFLICT == prepare_upload(ws, 'upload-11', chunks, 4, other_stage).status_code
+    assert http.HTTP_422_UNPROCESSABLE_ENTITY == \
+        prepare_upload(ws, 'upload-12', chunks, 4, stage, 'md4').status_code
+    assert None is models.get_upload_session('upload-12')
+
+    # Parts must agree with the session.
+    assert http.HTTP_400_BAD_REQUEST == upload_part(ws, 'upload-11', 1, chunks, 3).status_code
+    assert http.HTTP_400_BAD_REQUEST == upload_part(ws, 'upload-11', 4, chunks + ['d'], 4).status_code
+
+    upload_part(ws, 'upload-11', 2, chunks, 4)
+    upload_part(ws, 'upload-11', 2, chunks, 4)
+    upload_session = models.get_upload_session('upload-11')
+    assert '010' == upload_session.received_parts
+    assert 1 == upload_session.received_count
+    assert http.HTTP_204_NO_CONTENT == probe_part(ws, 'upload-11', 1, chunks, 4)
+    assert http.HTTP_200_OK == probe_part(ws, 'upload-11', 2, chunks, 4)
+
+    checksum_value = hashlib.sha256(''.join(chunks)).hexdigest()
+    rsp = complete_upload(ws, 'upload-11', checksum_value, stage)
+    assert http.HTTP_409_CONFLICT == rsp.status_code
+    assert 'part 1 of 3' in decode_json_string(rsp.data)['message']
+
+    upload_part(ws, 'upload-11', 1, chunks, 4)
+    upload_part(ws, 'upload-11', 3, chunks, 4)
+    rsp = complete_upload(ws, 'upload-11', checksum_value, other_stage)
+    assert http.HTTP_400_BAD_REQUEST == rsp.status_code
+    rsp = complete_upload(ws, 'upload-11', checksum_value, stage)
+    assert http.HTTP_202_ACCEPTED == rsp.status_code
+    assert models.FileStatus.staged == models.get_upload_session('upload-11').status
+
+
+def test_upload_usage(ws, storepath, sample_with_stages):
+    rsp = ws.get('/upload-usage')
+    assert http.HTTP_200_OK == rsp.status_code
+    assert 0 == decode_json_string(rsp.data)['uploads']['count']
+
+    upload_part(ws, 'upload-13', 1, ['aaaa', 'bb'], 4)
+    usage = decode_json_string(ws.get('/upload-usage').data)
+    assert 1 == usage['uploads']['count']
+    assert 0 < usage['uploads']['bytes']
+    assert 0 == usage['uploads']['abandoned']
+    assert 0 < usage['filesystem']['free-bytes'] <= usage['filesystem']['total-bytes']
+
+
+def next_link(rsp):
+    link = rsp.headers.get('Link')
+    if link is None:
+        return None
+    url, rel = link.split('; ')
+    assert 'rel="next"' == rel
+    return url.strip('<>').replace('http://localhost', '')
+
+
+def test_get_samples_paginated(ws, sample):
+    for i in range(2, 6):
+        models.add_sample(project_id='PqrX9', name='sample %d' % i)
+
+    rsp = ws.get('/projects/PqrX9/samples?limit=2')
+    assert ['sample 1', 'sample 2'] == [s['name'] for s in decode_json_string(rsp.data)]
+    rsp = ws.get(next_link(rsp))
+    assert ['sample 3', 'sample 4'] == [s['name'] for s in decode_json_string(rsp.data)]
+    rsp = ws.get(next_link(rsp))
+    assert ['sample 5'] == [s['name'] for s in decode_json_string(rsp.data)]
+    assert next_link(rsp) is None
+
+
+def test_get_samples_bad_page_args(ws, sample):
+    assert http.HTTP_400_BAD_REQUEST == ws.get('/projects/PqrX9/samples?after=xxx').status_code
+    assert http.HTTP_400_BAD_REQUEST == ws.get('/projects/PqrX9/samples?limit=0').status_code
+    assert http.HTTP_400_BAD_REQUEST == ws.get('/projects/PqrX9/samples?limit=x').status_code
+
+
+def test_get_stages_paginated(ws, sample_with_stages):
+    rsp = ws.get('/projects/PqrX9/samples/OQn6Q/stages?limit=1')
+    assert ['Drn1Q-1'] == [s['id'] for s in decode_json_string(rsp.data)['stages']]
+    rsp = ws.get(next_link(rsp))
+    page = decode_json_string(rsp.data)
+    assert ['bQ8bm-2'] == [s['id'] for s in page['stages']]
+    assert 'kyDbw' == page['token']
+    assert next_link(rsp) is None
+
+
+@contextlib.contextmanager
+def count_statements():
+    flask_app = sagittariidae.app.app
+    with flask_app.app_context():
+        engine = models.db.engine
+    statements = []
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+
+
+def add_stages(sample, n):
+    stage_ids = []
+    for i in range(n):
+        method = models.add_method(name='%s method %d' % (sample.name, i), description='')
+        token = models.get_sample_stages(sample.obfuscated_id)[1]
+        stage = models.add_sample_stage(
+            sample.obfuscated_id, method.obfuscated_id, 'Annotation %d' % i, token)
+        stage_ids.append(stage.obfuscated_id)
+    return stage_ids
+
+
+def test_list_endpoints_issue_constant_statements(ws, storepath):
+    # Every list endpoint issues as many statements for twice as many rows.
+    # The parents of the rows are loaded with them, rather than one at a time:
+    # where the rows of a list can have different parents, every row has a
+    # parent of its own, which can't have been loaded with another row.
+    def populate(i, rows):
+        project = models.add_project(name='project %d' % i, sample_mask='p%d-###' % i)
+        project_id = project.obfuscated_id
+        samples = [models.add_sample(project_id=project_id, name='sample %d-%d' % (i, j))
+                   for j in range(rows)]
+        sample_id = samples[0].obfuscated_id
+        # Every stage has a method of its own, and an archived file.
+        stage_ids = add_stages(samples[0], rows)
+        for k, stage_id in enumerate(stage_ids):
+            archive(models.get_sample_stage(sample_id, stage_id), 'file-%d-%d' % (i, k), 'x')
+        for k in range(rows):
+            models.add_file('staged-%d-%d' % (i, k), stage_ids[0])
+        return ['/projects/%s/samples' % project_id,
+                '/projects/%s/samples/%s/stages' % (project_id, sample_id),
+                '/projects/%s/samples/%s/stages/%s/files' % (project_id, sample_id, stage_ids[0]),
+                '/projects/%s/samples/%s/bundle' % (project_id, sample_id)]
+
+    def statements_for(url):
+        with count_statements() as statements:
+            assert http.HTTP_200_OK == ws.get(url).status_code
+        return len(statements)
+
+    for few, many in zip(populate(1, 3), populate(2, 6)):
+        assert statements_for(few) == statements_for(many), many
+
+
+def test_search_samples(ws, sample_with_stages):
+    models.add_sample(project_id='PqrX9', name='sample 2')
+    for q in ['sample+tomography', 'sa+tomography']:
+        rsp = ws.get('/projects/PqrX9/samples?q=' + q)
+        assert ['sample 1'] == [s['name'] for s in decode_json_string(rsp.data)]
+
+
+def test_search_samples_without_index(ws, sample_with_stages):
+    # Tokens that are too short for the search index are resolved by scanning
+    # the tables, concurrently.
+    models.add_sample(project_id='PqrX9', name='sample 2')
+    for q, expected in [('sa', ['sample 1', 'sample 2']),
+                        ('sa+1', ['sample 1']),
+                        ('1+zz', ['sample 1']),
+                        ('zz', [])]:
+        rsp = ws.get('/projects/PqrX9/samples?q=' + q)
+        assert http.HTTP_200_OK == rsp.status_code
+        assert expected == [s['name'] for s in decode_json_string(rsp.data)]
+
+
+def archive(stage, name, data):
+    config = sagittariidae.app.app.config
+    models.add_file(os.path.join('dl', name), stage.obfuscated_id)
+    ssf = models.claim_files(models.FileStatus.staged, 'owner', 60)[0]
+    path = os.path.join(config['STORE_PATH'], ssf.relative_target_path)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(data)
+    checksum_value = hashlib.sha256(data).hexdigest()
+    models.transition_files([ssf], models.FileStatus.complete, {ssf.id: ('sha256', checksum_value)})
+    return '/dl/' + ssf.relative_target_path, '"sha256-%s"' % checksum_value
+
+
+def test_download_file(ws, storepath, sample_with_stages):
+    data = ''.join(chr(i % 256) for i in range(1000))
+    uri, etag = archive(sample_with_stages['stages'][0], 'data.bin', data)
+
+    rsp = ws.get(uri)
+    assert http.HTTP_200_OK == rsp.status_code
+    assert data == rsp.data
+    assert etag == rsp.headers['ETag']
+    assert 'bytes' == rsp.headers['Accept-Ranges']
+
+    rsp = ws.get(uri, headers={'If-None-Match': etag})
+    assert http.HTTP_304_NOT_MODIFIED == rsp.status_code
+
+    rsp = ws.head(uri)
+    assert '1000' == rsp.headers['Content-Length']
+    assert '' == rsp.data
+
+    assert http.HTTP_404_NOT_FOUND == ws.get('/dl/no/such/file').status_code
+
+
+def test_download_file_range(ws, storepath, sample_with_stages):
+    data = ''.join(chr(i % 256) for i in range(1000))
+    uri, etag = archive(sample_with_stages['stages'][0], 'data.bin', data)
+
+    rsp = ws.get(uri, headers={'Range': 'bytes=100-199'})
+    assert http.HTTP_206_PARTIAL_CONTENT == rsp.status_code
+    assert data[100:200] == rsp.data
+    assert 'bytes 100-199/1000' == rsp.headers['Content-Range']
+
+    rsp = ws.get(uri, headers={'Range': 'bytes=-10', 'If-Range': etag})
+    assert data[-10:] == rsp.data
+
+    # The file has changed since the client fetched the rest of it.
+    rsp = ws.get(uri, headers={'Range': 'bytes=100-199', 'If-Range': '"sha256-0"'})
+    assert http.HTTP_200_OK == rsp.status_code
+    assert data == rsp.data
+
+    rsp = ws.get(uri, headers={'Range': 'bytes=1000-'})
+    assert http.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE == rsp.status_code
+    assert 'bytes */1000' == rsp.headers['Content-Range']
+
+
+def test_download_file_multiple_ranges(ws, storepath, sample_with_stages):
+    data = ''.join(chr(i % 256) for i in range(1000))
+    uri, _ = archive(sample_with_stages['stages'][0], 'data.bin', data)
+
+    rsp = ws.get(uri, headers={'Range': 'bytes=0-9,500-509,510-519'})
+    assert http.HTTP_206_PARTIAL_CONTENT == rsp.status_code
+    content_type, boundary = rsp.headers['Content-Type'].split('; boundary=')
+    assert 'multipart/byteranges' == content_type
+    assert len(rsp.data) == int(rsp.headers['Content-Length'])
+    parts = rsp.data.split('\r\n--%s' % boundary)
+    assert ['', '--\r\n'] == [parts[0], parts[-1]]
+    ranges = [p.split('\r\n\r\n', 1) for p in parts[1:-1]]
+    assert [('Content-Range: bytes 0-9/1000', data[0:10]),
+            ('Content-Range: bytes 500-519/1000', data[500:520])] == \
+        [(h.split('\r\n')[-1], body) for h, body in ranges]
+
+
+def test_download_file_offload(ws, storepath, sample_with_stages, monkeypatch):
+    uri, _ = archive(sample_with_stages['stages'][0], 'data.bin', 'data')
+    monkeypatch.setitem(sagittariidae.app.app.config, 'DOWNLOAD_OFFLOAD', 'x-accel-redirect')
+    rsp = ws.get(uri)
+    assert '/store/' + uri[len('/dl/'):] == rsp.headers['X-Accel-Redirect']
+    assert '' == rsp.data
+
+
+def test_download_bundle(ws, storepath, sample_with_stages):
+    stages = sample_with_stages['stages']
+    archive(stages[0], 'a.bin', 'a' * 1000)
+    archive(stages[0], 'b.bin', '')
+    archive(stages[1], 'c.bin', 'c' * 513)
+
+    rsp = ws.get('/projects/PqrX9/samples/OQn6Q/stages/%s/bundle' % stages[0].obfuscated_id)
+    assert http.HTTP_200_OK == rsp.status_code
+    assert 'application/x-tar' == rsp.headers['Content-Type']
+    assert len(rsp.data) == int(rsp.headers['Content-Length'])
+    with contextlib.closing(tarfile.open(fileobj=StringIO(rsp.data))) as tar:
+        assert [('a', 'a' * 1000), ('b', '')] == \
+            [(os.path.basename(m.name)[0], tar.extractfile(m).read()) for m in tar.getmembers()]
+
+    rsp = ws.get('/projects/PqrX9/samples/OQn6Q/bundle')
+    bundle = rsp.data
+    with contextlib.closing(tarfile.open(fileobj=StringIO(bundle))) as tar:
+        names = tar.getnames()
+    assert ['a', 'b', 'c'] == [os.path.basename(n)[0] for n in names]
+    assert all(n.startswith('sample-OQn6Q/stage-') for n in names)
+
+    # A download can be resumed at any byte of the bundle, as long as it hasn't
+    # changed.
+    etag = rsp.headers['ETag']
+    for offset in [0, 100, 512, 1600, len(bundle) - 1]:
+        rsp = ws.get('/projects/PqrX9/samples/OQn6Q/bundle',
+                     headers={'Range': 'bytes=%d-' % offset, 'If-Range': etag})
+        assert http.HTTP_206_PARTIAL_CONTENT == rsp.status_code
+        assert bundle[offset:] == rsp.data
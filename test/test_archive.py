@@ -0,0 +1,86 @@
+
+import hashlib
+import logging
+import os
+import pytest
+
+from app import archive, checksum
+
+from fixtures import tmpdir
+
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture(scope='function')
+def source(tmpdir):
+    src = os.path.join(tmpdir, 'source')
+    with open(src, 'wb') as f:
+        f.write(os.urandom(3 * 65536 + 17))
+    return src
+
+
+@pytest.mark.parametrize('strategy', archive.STRATEGIES.keys())
+def test_archive_file(tmpdir, source, strategy):
+    applies, _ = archive.STRATEGIES[strategy]
+    tgt = os.path.join(tmpdir, 'target')
+    if not applies(source, tgt, None):
+        pytest.skip('%s is not available' % strategy)
+    result = archive.archive_file(source, tgt, [strategy], logger)
+    assert strategy == result.strategy
+    assert open(source, 'rb').read() == open(tgt, 'rb').read()
+    assert not os.path.exists(tgt + '.tmp')
+
+
+def test_archive_file_falls_back(tmpdir, source, monkeypatch):
+    def fail(src, tgt, expected):
+        raise OSError(18, 'Invalid cross-device link')
+    monkeypatch.setitem(archive.STRATEGIES, 'link', (lambda src, tgt, expected: True, fail))
+    tgt = os.path.join(tmpdir, 'target')
+    result = archive.archive_file(source, tgt, ['link', 'copy'], logger)
+    assert 'copy' == result.strategy
+    assert os.path.isfile(tgt)
+
+
+def test_archive_file_is_idempotent(tmpdir, source):
+    tgt = os.path.join(tmpdir, 'target')
+    archive.archive_file(source, tgt, ['link'], logger)
+    assert 'link' == archive.archive_file(source, tgt, ['link'], logger).strategy
+
+
+def test_archive_file_verifies_copy(tmpdir, source):
+    tgt = os.path.join(tmpdir, 'target')
+    expected = ('sha256', hashlib.sha256(open(source, 'rb').read()).hexdigest())
+    # Kernel copies can't be verified, and so aren't used.
+    result = archive.archive_file(source, tgt, ['copy_file_range', 'sendfile', 'copy'], logger, expected)
+    assert 'copy' == result.strategy
+    assert open(source, 'rb').read() == open(tgt, 'rb').read()
+
+
+def test_archive_file_rejects_corrupt_copy(tmpdir, source):
+    tgt = os.path.join(tmpdir, 'target')
+    with pytest.raises(checksum.ChecksumMismatch):
+        archive.archive_file(source, tgt, ['copy'], logger, ('sha256', hashlib.sha256('').hexdigest()))
+    assert not os.path.exists(tgt)
+    assert not os.path.exists(tgt + '.tmp')
+
+
+def test_archive_deduplicated_file(tmpdir, source):
+    expected = ('sha256', hashlib.sha256(open(source, 'rb').read()).hexdigest())
+    duplicate = os.path.join(tmpdir, 'duplicate')
+    with open(duplicate, 'wb') as f:
+        f.write(open(source, 'rb').read())
+    store = os.path.join(tmpdir, 'store')
+    os.makedirs(store)
+
+    first = archive.archive_deduplicated_file(
+        source, os.path.join(store, 'first'), store, ['copy'], logger, expected)
+    second = archive.archive_deduplicated_file(
+        duplicate, os.path.join(store, 'second'), store, ['copy'], logger, expected)
+
+    assert 'copy' == first.strategy
+    assert 'deduplicated' == second.strategy
+    blob = archive.blob_path(store, *expected)
+    assert os.path.samefile(blob, os.path.join(store, 'first'))
+    assert os.path.samefile(blob, os.path.join(store, 'second'))
+    assert [expected[1]] == os.listdir(os.path.dirname(blob))
@@ -0,0 +1,64 @@
+
+import binascii
+import hashlib
+import os
+import pytest
+import zlib
+
+from app      import checksum
+from fixtures import tmpdir
+
+
+def sha256(s):
+    return hashlib.sha256(s).digest()
+
+
+def test_merkle_root_of_one_digest():
+    assert binascii.hexlify(sha256('a')) == \
+        checksum.merkle_root([sha256('a')], 'sha256')
+
+
+def test_merkle_root_promotes_odd_digest():
+    leaves = [sha256(c) for c in 'abc']
+    assert hashlib.sha256(sha256(leaves[0] + leaves[1]) + leaves[2]).hexdigest() == \
+        checksum.merkle_root(leaves, 'sha256')
+
+
+def test_unsupported_method():
+    with pytest.raises(checksum.UnsupportedChecksumMethod):
+        checksum.get_digester('md4')
+
+
+def test_zlib_methods():
+    for method, fn in [('crc32', zlib.crc32), ('adler32', zlib.adler32)]:
+        digester = checksum.get_digester(method)
+        digester.update('abc')
+        digester.copy().update('xyz')
+        digester.update('def')
+        assert '%08x' % (fn('abcdef') & 0xffffffff) == digester.hexdigest()
+
+
+def test_tree_digester_leaves():
+    digester = checksum.TreeDigester('sha256', leaf_size=4)
+    for data in ['aa', 'aabb', 'bbc']:
+        digester.update(data)
+    assert checksum.merkle_root([sha256('aaaa'), sha256('bbbb'), sha256('c')], 'sha256') == \
+        digester.hexdigest()
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_tree_checksum_of_file(tmpdir, workers):
+    fname = os.path.join(tmpdir, 'data')
+    data = ''.join(chr(i % 251) for i in range(10000))
+    with open(fname, 'wb') as f:
+        f.write(data)
+    digester = checksum.TreeDigester('sha256', leaf_size=1024)
+    digester.update(data)
+    assert digester.hexdigest() == \
+        checksum.generate_tree_checksum(fname, 'sha256-tree', leaf_size=1024, workers=workers)
+
+
+def test_tree_checksum_of_empty_file(tmpdir):
+    fname = os.path.join(tmpdir, 'empty')
+    open(fname, 'w').close()
+    assert hashlib.sha256('').hexdigest() == checksum.generate_checksum(fname, 'sha256-tree')
@@ -0,0 +1,45 @@
+import os
+import pytest
+
+from app.file import FileProcessor
+from fixtures import tmpdir
+
+
+@pytest.fixture(scope='function')
+def datafile(tmpdir):
+    fname = os.path.join(tmpdir, 'data')
+    with open(fname, 'wb') as f:
+        f.write(''.join(chr(i % 256) for i in range(10000)))
+    return fname
+
+
+@pytest.mark.parametrize('mode', [FileProcessor.READ, FileProcessor.MMAP])
+@pytest.mark.parametrize('offset,length', [(0, None), (1000, None), (999, 4097), (9000, 5000), (10000, None)])
+def test_process(datafile, mode, offset, length):
+    blocks = []
+    # The blocks are only valid during the call, so they must be copied.
+    FileProcessor(datafile, lambda b: blocks.append(str(b)), 1024, mode, offset, length).process()
+    expected = open(datafile, 'rb').read()[offset:None if length is None else offset + length]
+    assert expected == ''.join(blocks)
+    assert all(len(b) <= 1024 for b in blocks)
+
+
+@pytest.mark.parametrize('mode', [FileProcessor.READ, FileProcessor.MMAP])
+def test_process_empty_file(tmpdir, mode):
+    fname = os.path.join(tmpdir, 'empty')
+    open(fname, 'w').close()
+    blocks = []
+    FileProcessor(fname, blocks.append, mode=mode).process()
+    assert [] == blocks
+
+
+def test_configure():
+    blocksize, mode = FileProcessor.read_blocksize, FileProcessor.read_mode
+    try:
+        FileProcessor.configure(4096, FileProcessor.MMAP)
+        fp = FileProcessor('x', None)
+        assert (4096, FileProcessor.MMAP) == (fp.blocksize, fp.mode)
+        with pytest.raises(ValueError):
+            FileProcessor.configure(4096, 'carrier-pigeon')
+    finally:
+        FileProcessor.configure(blocksize, mode)
@@ -1,8 +1,16 @@
 
+import contextlib
+import datetime
 import os
 import pytest
+import sqlite3
 import werkzeug
 
+from sqlalchemy          import event
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.exc      import OperationalError
+from sqlalchemy.schema   import CreateTable
+
 import app
 import app.models as models
 
@@ -156,3 +164,239 @@ def test_add_file(storepath, sample_with_stages):
 def test_complete_file(sample_with_stages):
     ssf = models.add_file('source-file', sample_with_stages['stages'][0].obfuscated_id)
     assert models.FileStatus.staged == ssf.status
+
+
+def test_claim_files(storepath, sample_with_stages):
+    stage = sample_with_stages['stages'][0]
+    for i in range(3):
+        models.add_file('file-%d' % i, stage.obfuscated_id)
+
+    claimed = models.claim_files(models.FileStatus.staged, 'owner-1', 60, limit=2)
+    assert [1, 2] == [f.id for f in claimed]
+    assert all('owner-1' == f.claimed_by for f in claimed)
+
+    # Files that are already claimed can't be claimed by someone else.
+    claimed = models.claim_files(models.FileStatus.staged, 'owner-2', 60)
+    assert [3] == [f.id for f in claimed]
+    assert [] == models.claim_files(models.FileStatus.staged, 'owner-3', 60)
+
+
+def test_claim_files_after_lease_expiry(storepath, sample_with_stages):
+    stage = sample_with_stages['stages'][0]
+    models.add_file('file', stage.obfuscated_id)
+    assert 1 == len(models.claim_files(models.FileStatus.staged, 'owner-1', -1))
+    assert 1 == len(models.claim_files(models.FileStatus.staged, 'owner-2', 60))
+
+
+def test_transition_files(storepath, sample_with_stages):
+    stage = sample_with_stages['stages'][0]
+    for i in range(3):
+        models.add_file('file-%d' % i, stage.obfuscated_id)
+    claimed = models.claim_files(models.FileStatus.staged, 'owner', 60)
+
+    models.transition_files(claimed[:2], models.FileStatus.archived,
+                            {claimed[1].id: ('sha256', 'abc123')})
+
+    archived = models.get_files(status=models.FileStatus.archived)
+    assert [1, 2] == [f.id for f in archived]
+    assert all(f.claimed_by is None and f.claimed_until is None for f in archived)
+    assert [(None, None), ('sha256', 'abc123')] == \
+        [(f.checksum_method, f.checksum_value) for f in archived]
+    assert [3] == [f.id for f in models.get_files(status=models.FileStatus.staged)]
+
+
+def test_search_samples(sample_with_stages):
+    project = sample_with_stages['project']
+    models.add_sample(project_id='PqrX9', name='sample 2')
+    models.add_sample(project_id='PqrX9', name='other')
+
+    assert [1, 2] == models.search_samples(project.id, ['SAMPLE'])
+    assert [1] == models.search_samples(project.id, ['sample', 'tomography'])
+    assert [1] == models.search_samples(project.id, ['annotation 1'])
+    # Tokens that match nothing are ignored.
+    assert [1] == models.search_samples(project.id, ['sample', 'tomography', 'nothing'])
+    assert [] == models.search_samples(project.id, ['nothing'])
+
+
+def test_search_samples_short_token(sample_with_stages):
+    project = sample_with_stages['project']
+    assert models.search_samples(project.id, ['sa']) is None
+
+
+def test_search_samples_across_stages(sample_with_stages):
+    project = sample_with_stages['project']
+    # The annotations of different stages are indexed apart.
+    assert [] == models.search_samples(project.id, ['0 annotation'])
+    assert models.search_samples(project.id, ['0\x1fannotation']) is None
+
+
+def test_search_index_follows_changes(sample_with_stages):
+    project = sample_with_stages['project']
+    sample  = sample_with_stages['sample']
+    stage   = sample_with_stages['stages'][1]
+    method  = sample_with_stages['method']
+
+    sample.name = 'renamed'
+    stage.annotation = 'Amended'
+    method.name = 'Microscopy'
+    models.db.session.commit()
+    assert [] == models.search_samples(project.id, ['sample'])
+    assert [] == models.search_samples(project.id, ['annotation 1'])
+    assert [] == models.search_samples(project.id, ['tomography'])
+    assert [1] == models.search_samples(project.id, ['renamed', 'amended', 'microscopy'])
+
+    models.db.session.delete(stage)
+    models.db.session.commit()
+    assert [] == models.search_samples(project.id, ['amended'])
+
+    models.db.session.delete(sample_with_stages['stages'][0])
+    models.db.session.delete(sample)
+    models.db.session.commit()
+    assert [] == models.search_samples(project.id, ['renamed'])
+    assert 0 == models.db.session.execute('SELECT count(*) FROM sample_search').scalar()
+
+
+def test_rebuild_search_index(sample_with_stages):
+    project = sample_with_stages['project']
+    models.rebuild_search_index()
+    assert [1] == models.search_samples(project.id, ['annotation 0', 'x-ray'])
+
+
+def test_record_upload_parts(sample_with_stages):
+    stage = sample_with_stages['stages'][0].obfuscated_id
+    models.add_upload_session('upload-1', stage, 3, 4, 10, 'sha256')
+    for n in [3, 1, 3]:
+        models.record_upload_part('upload-1', n)
+    us = models.get_upload_session('upload-1')
+    assert '101' == us.received_parts
+    assert 2 == us.received_count
+    assert not us.is_complete
+    models.record_upload_part('upload-1', 2)
+    assert models.get_upload_session('upload-1').is_complete
+
+
+def test_get_stale_upload_sessions(sample_with_stages):
+    stage = sample_with_stages['stages'][0].obfuscated_id
+    models.add_upload_session('upload-1', stage, 1, 4, 4, 'sha256')
+    models.add_upload_session('upload-2', stage, 1, 4, 4, 'sha256')
+    models.complete_upload_session('upload-2')
+    assert [] == models.get_stale_upload_sessions(60)
+    assert ['upload-1'] == [us.identifier for us in models.get_stale_upload_sessions(-60)]
+
+
+def test_connection_pragmas(ws):
+    assert 'wal' == models.db.session.execute('PRAGMA journal_mode').scalar()
+    assert 10000 == models.db.session.execute('PRAGMA busy_timeout').scalar()
+
+
+def busy_then(results):
+    calls = []
+    def f(session):
+        calls.append(session)
+        result = results[len(calls) - 1]
+        if isinstance(result, Exception):
+            raise OperationalError('UPDATE ...', {}, result)
+        session.add(result)
+    return f, calls
+
+
+def test_with_transaction_retries_when_busy(ws, monkeypatch):
+    monkeypatch.setitem(app.app.app.config, 'DB_BUSY_BACKOFF', 0)
+    models.add_project(name='Manhattan', sample_mask='man-###')
+    f, calls = busy_then([sqlite3.OperationalError('database is locked'),
+                          models.Method(name='m', description='d')])
+    models.with_transaction(models.db.session, f)
+    assert 2 == len(calls)
+    assert ['m'] == [m.name for m in models.get_methods()]
+
+
+def test_changes_are_retried_when_busy(storepath, sample_with_stages, monkeypatch):
+    monkeypatch.setitem(app.app.app.config, 'DB_BUSY_BACKOFF', 0)
+    models.add_file('file-0', sample_with_stages['stages'][0].obfuscated_id)
+    f = models.get_files(status=models.FileStatus.staged)[0]
+
+    commit = models.db.session.commit
+    commits = []
+    def busy_once():
+        commits.append(None)
+        if len(commits) == 1:
+            raise OperationalError('COMMIT', {}, sqlite3.OperationalError('database is locked'))
+        commit()
+    monkeypatch.setattr(models.db.session, 'commit', busy_once)
+    f.mark_archived()
+    monkeypatch.undo()
+
+    assert 2 == len(commits)
+    models.db.session.expire_all()
+    assert [f.id] == [g.id for g in models.get_files(status=models.FileStatus.archived)]
+
+
+def test_with_transaction_gives_up(ws, monkeypatch):
+    monkeypatch.setitem(app.app.app.config, 'DB_BUSY_BACKOFF', 0)
+    monkeypatch.setitem(app.app.app.config, 'DB_BUSY_RETRIES', 2)
+    f, calls = busy_then([sqlite3.OperationalError('database is locked')] * 3)
+    with pytest.raises(OperationalError):
+        models.with_transaction(models.db.session, f)
+    assert 3 == len(calls)
+
+    # Other errors aren't retried at all.
+    f, calls = busy_then([sqlite3.OperationalError('no such table: x')])
+    with pytest.raises(OperationalError):
+        models.with_transaction(models.db.session, f)
+    assert 1 == len(calls)
+
+
+def test_claimable_files_skip_locked_rows_on_postgresql(ws):
+    q = models._claimable_files_(models.FileStatus.staged, datetime.datetime.utcnow(), 10)
+    assert str(q.compile(dialect=postgresql.dialect())).rstrip().endswith('FOR UPDATE SKIP LOCKED')
+    assert 'FOR UPDATE' not in str(q.compile(dialect=sqlite.dialect()))
+
+
+def test_schema_for_postgresql():
+    for table in [models.SampleStageFile.__table__, models.UploadSession.__table__]:
+        ddl = str(CreateTable(table).compile(dialect=postgresql.dialect()))
+        assert 'modified_ts TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP' in ddl
+        assert 'status file_status' in ddl
+    assert 'UTC_TIMESTAMP()' == str(models.utcnow().compile(dialect=mysql.dialect()))
+
+
+@contextlib.contextmanager
+def query_plans():
+    """
+    Collects the plans of the queries that are run in the context.
+    """
+    with app.app.app.app_context():
+        engine = models.db.engine
+    statements = []
+    def collect(conn, cursor, statement, parameters, *args):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append((statement, parameters))
+    event.listen(engine, 'before_cursor_execute', collect)
+    plans = []
+    try:
+        yield plans
+    finally:
+        event.remove(engine, 'before_cursor_execute', collect)
+        for statement, parameters in statements:
+            plans.append((statement,
+                          [row['detail'] for row in engine.execute('EXPLAIN QUERY PLAN ' + statement,
+                                                             parameters)]))
+
+
+def test_hot_queries_use_indexes(sample_with_stages):
+    stage_id = sample_with_stages['stages'][0].obfuscated_id
+    models.add_file(os.path.join('dir', 'file'), stage_id)
+    with query_plans() as plans:
+        models.get_samples(obfuscated_id='PqrX9')
+        models.get_sample_stages('OQn6Q')
+        models.get_files(sample_stage_id=stage_id)
+        models.get_files(status=models.FileStatus.staged)
+        models.claim_files(models.FileStatus.staged, 'owner', 60)
+        models.get_stale_upload_sessions(0)
+    for statement, plan in plans:
+        # Every table must be searched by way of an index (or its primary
+        # key); a `SCAN` reads the whole table, or the whole of an index.
+        scans = [step for step in plan
+                 if step.startswith('SCAN') or (step.startswith('SEARCH') and 'USING' not in step)]
+        assert [] == scans, statement
+        assert any(step.startswith('SEARCH') for step in plan), statement
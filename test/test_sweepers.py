@@ -1,9 +1,14 @@
 
+import datetime
+import hashlib
 import os
 import pytest
 import random
+import time
 
 import app          as sagittariidae
+import app.archive  as archive
+import app.checksum as checksum
 import app.models   as models
 import app.sweepers as sweepers
 
@@ -52,6 +57,36 @@ def test_StagedFileSweeper_move_file(sample_with_stages, stage_file):
     assert exp_status == act_status
 
 
+def test_StagedFileSweeper_verifies_copy(sample_with_stages, stage_file, monkeypatch):
+    # Force a copy, which is verified as it's made.
+    monkeypatch.setitem(sagittariidae.app.app.config, 'ARCHIVE_STRATEGIES', ['copy'])
+    touch(stage_file['source'])
+    with open(stage_file['source'], 'w') as f:
+        f.write('data')
+    checksum.write_sidecar(stage_file['source'], 'sha256', hashlib.sha256('data').hexdigest())
+
+    sweepers.make_sweeper(sweepers.StagedFileSweeper).sweep()
+
+    archived = models.get_files(status=models.FileStatus.archived)
+    assert 1 == len(archived)
+    assert ('sha256', hashlib.sha256('data').hexdigest()) == \
+        (archived[0].checksum_method, archived[0].checksum_value)
+
+
+def test_StagedFileSweeper_rejects_corrupt_copy(sample_with_stages, stage_file, monkeypatch):
+    monkeypatch.setitem(sagittariidae.app.app.config, 'ARCHIVE_STRATEGIES', ['copy'])
+    touch(stage_file['source'])
+    with open(stage_file['source'], 'w') as f:
+        f.write('data')
+    checksum.write_sidecar(stage_file['source'], 'sha256', hashlib.sha256('other data').hexdigest())
+
+    stats = sweepers.StagedFileSweeper(workers=1).run()
+
+    assert 1 == stats.failures
+    assert not os.path.exists(stage_file['target'])
+    assert 0 == len(models.get_files(status=models.FileStatus.archived))
+
+
 def test_ArchivedFileDirSweeper_delete_dirs(sample_with_stages, stage_file):
     filepath = stage_file['source']
     dirpath = os.path.dirname(filepath)
@@ -78,3 +113,186 @@ def test_ArchivedFileDirSweeper_delete_dirs(sample_with_stages, stage_file):
         sample_stage_id=stage.obfuscated_id, status=exp_status)[0].status
     assert exp_status == act_status
     assert os.path.exists(os.path.dirname(dirpath)), "Parent of upload directory removed; this is a Bad Thing (tm)!"
+
+
+def test_StagedFileSweeper_concurrent(storepath, sample_with_stages):
+    stage = sample_with_stages['stages'][0]
+    upload_path = sagittariidae.app.app.config['UPLOAD_PATH']
+    for i in range(5):
+        ssf = models.add_file(os.path.join('dir%d' % i, 'file-%d' % i), stage.obfuscated_id)
+        fname = os.path.join(upload_path, ssf.relative_source_path)
+        touch(fname)
+        with open(fname, 'w') as f:
+            f.write('x' * (i + 1))
+
+    stats = sweepers.StagedFileSweeper(workers=3).run()
+
+    assert 5 == stats.files
+    assert 0 == stats.failures
+    assert 1 + 2 + 3 + 4 + 5 == stats.bytes
+    assert 5 == len(models.get_files(
+        sample_stage_id=stage.obfuscated_id, status=models.FileStatus.archived))
+
+
+def test_SweeperDaemon_wakes_on_new_file(storepath, sample_with_stages):
+    os.makedirs(sagittariidae.app.app.config['UPLOAD_PATH'])
+    daemon = sweepers.SweeperDaemon([])
+    daemon.poll_interval  = 60
+    daemon.check_interval = 0.01
+    mtime = daemon._wakeup_mtime_()
+    assert mtime is None
+
+    models.add_file(os.path.join('dir', 'uploaded-file'),
+                    sample_with_stages['stages'][0].obfuscated_id)
+
+    # `wait` returns as soon as it sees that the wakeup file has been touched,
+    # long before the poll interval has elapsed.
+    started = time.time()
+    assert daemon.wait(mtime) is not None
+    assert time.time() - started < 1
+
+
+def test_SweeperDaemon_stop(storepath):
+    daemon = sweepers.SweeperDaemon([])
+    daemon.stop()
+    started = time.time()
+    daemon.wait(None)
+    assert time.time() - started < 1
+
+
+def test_AbandonedUploadSweeper_removes_stale_dirs(sample_with_stages, stage_file):
+    config = sagittariidae.app.app.config
+    upload_path = config['UPLOAD_PATH']
+    stale = time.time() - config['UPLOAD_ABANDONED_AGE'] - 60
+    def make_upload_dir(name, mtime=None):
+        fname = os.path.join(upload_path, name, '1.part')
+        touch(fname)
+        with open(fname, 'w') as f:
+            f.write('x' * 4096)
+        if mtime is not None:
+            os.utime(fname, (mtime, mtime))
+            os.utime(os.path.dirname(fname), (mtime, mtime))
+        return os.path.dirname(fname)
+    def add_upload_session(identifier, mtime=None):
+        models.add_upload_session(identifier, sample_with_stages['stages'][0].obfuscated_id,
+                                  1, 4096, 4096, 'sha256')
+        if mtime is not None:
+            models.db.session.query(models.UploadSession)\
+                             .filter_by(identifier=identifier)\
+                             .update({models.UploadSession.modified_ts:
+                                          datetime.datetime.utcfromtimestamp(mtime)},
+                                     synchronize_session=False)
+            models.db.session.commit()
+
+    # Uploads that were never prepared are found by the age of their
+    # directories ...
+    abandoned = make_upload_dir('abandoned', stale)
+    active    = make_upload_dir('active')
+    # ... and prepared uploads by their sessions, whatever the age of their
+    # directories; a session is removed even if its directory is not there.
+    abandoned_session = make_upload_dir('abandoned-session')
+    add_upload_session('abandoned-session', stale)
+    add_upload_session('abandoned-session-without-dir', stale)
+    active_session = make_upload_dir('active-session', stale)
+    add_upload_session('active-session')
+    # The file that is waiting to be archived is as old as the abandoned upload.
+    touch(stage_file['source'])
+    os.utime(stage_file['source'], (stale, stale))
+    os.utime(os.path.dirname(stage_file['source']), (stale, stale))
+    models.notify_sweepers()
+
+    stats = sweepers.AbandonedUploadSweeper().run()
+
+    assert 3 == stats.files
+    assert 2 * 4096 <= stats.bytes
+    assert not os.path.exists(abandoned)
+    assert not os.path.exists(abandoned_session)
+    assert os.path.isdir(active)
+    assert os.path.isdir(active_session)
+    assert os.path.isfile(stage_file['source'])
+    assert os.path.isfile(models.sweeper_wakeup_path())
+    assert None is models.get_upload_session('abandoned-session')
+    assert None is models.get_upload_session('abandoned-session-without-dir')
+    assert None is not models.get_upload_session('active-session')
+
+
+def test_Throttle():
+    now = [0.0]
+    slept = []
+    def sleep(t):
+        slept.append(t)
+        now[0] += t
+    throttle = sweepers.Throttle(100, clock=lambda: now[0], sleep=sleep)
+    throttle.consume(50)
+    assert [0.5] == slept
+    now[0] += 2.0
+    throttle.consume(50)
+    assert [0.5] == slept
+
+
+@pytest.fixture(scope='function')
+def archived_files(storepath, sample_with_stages):
+    config = sagittariidae.app.app.config
+    os.makedirs(config['UPLOAD_PATH'])
+    stage = sample_with_stages['stages'][0]
+    for i in range(3):
+        models.add_file(os.path.join('dir%d' % i, 'file-%d' % i), stage.obfuscated_id)
+    files = models.claim_files(models.FileStatus.staged, 'owner', 60)
+    checksums = {}
+    os.makedirs(os.path.join(config['STORE_PATH'], os.path.dirname(files[0].relative_target_path)))
+    for f in files:
+        data = 'data %d' % f.id
+        with open(os.path.join(config['STORE_PATH'], f.relative_target_path), 'w') as fh:
+            fh.write(data)
+        checksums[f.id] = ('sha256', hashlib.sha256(data).hexdigest())
+    models.transition_files(files, models.FileStatus.complete, checksums)
+    return [(f.id, os.path.join(config['STORE_PATH'], f.relative_target_path)) for f in files]
+
+
+def verifications():
+    return [(f.verified_ts is not None, f.verify_error is not None)
+            for f in models.get_files(status=models.FileStatus.complete)]
+
+
+def test_ArchiveScrubber_verifies_files(archived_files):
+    with open(archived_files[1][1], 'w') as f:
+        f.write('bit rot')
+
+    stats = sweepers.ArchiveScrubber().run()
+
+    assert 2 == stats.files
+    assert 1 == stats.failures
+    assert [(True, False), (True, True), (True, False)] == verifications()
+    assert not os.path.exists(sweepers.ArchiveScrubber().cursor_path)
+
+
+def test_ArchiveScrubber_resumes(archived_files):
+    scrubber = sweepers.ArchiveScrubber()
+    scrubber._save_cursor_(archived_files[0][0])
+
+    assert 2 == scrubber.run().files
+    assert [(False, False), (True, False), (True, False)] == verifications()
+
+
+def test_StagedFileSweeper_deduplicates(storepath, sample_with_stages, monkeypatch):
+    monkeypatch.setitem(sagittariidae.app.app.config, 'DEDUPLICATE_ARCHIVE', True)
+    stage = sample_with_stages['stages'][0]
+    upload_path = sagittariidae.app.app.config['UPLOAD_PATH']
+    for i, method in enumerate(['sha256', 'sha256', 'crc32']):
+        ssf = models.add_file(os.path.join('dir%d' % i, 'file-%d' % i), stage.obfuscated_id)
+        fname = os.path.join(upload_path, ssf.relative_source_path)
+        touch(fname)
+        with open(fname, 'w') as f:
+            f.write('data')
+        checksum.write_sidecar(fname, method, checksum.generate_checksum(fname, method))
+
+    stats = sweepers.StagedFileSweeper(workers=1).run()
+
+    assert 3 == stats.files
+    assert 0 == stats.failures
+    targets = [os.path.join(sagittariidae.app.app.config['STORE_PATH'], f.relative_target_path)
+               for f in models.get_files(status=models.FileStatus.archived)]
+    # Only the strong checksums are used to deduplicate files.
+    blob = archive.blob_path(sagittariidae.app.app.config['STORE_PATH'],
+                             'sha256', hashlib.sha256('data').hexdigest())
+    assert [True, True, False] == [os.path.samefile(blob, t) for t in targets]
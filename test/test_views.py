@@ -1,4 +1,5 @@
 
+import datetime
 import pytest
 
 from sqlalchemy import Column, Integer
@@ -36,3 +37,18 @@ def test_uri_name(json_encoder):
             'foo ~ bar' : 'foo-bar'}
     for kv in iter(spec.items()):
         assert kv[1] == json_encoder._uri_name('FoOby', kv[0]).split('-', 1)[1]
+
+
+def test_timestamps_are_encoded_alike(json_encoder):
+    # As they are returned by SQLite and by PostgreSQL.
+    class UTC(datetime.tzinfo):
+        def utcoffset(self, dt):
+            return datetime.timedelta(0)
+    class EST(datetime.tzinfo):
+        def utcoffset(self, dt):
+            return datetime.timedelta(hours=-5)
+    naive = datetime.datetime(2016, 7, 1, 12, 30, 15)
+    for ts in [naive,
+               naive.replace(microsecond=250, tzinfo=UTC()),
+               datetime.datetime(2016, 7, 1, 7, 30, 15, tzinfo=EST())]:
+        assert '2016-07-01T12:30:15' == json_encoder._encodeTimestamp(ts)